@@ -453,6 +453,26 @@ def link_devices(source_device_id, target_device_id):
             "Resource": [
             "arn:aws:iot:us-east-1:*:topic/$aws/things/{}/shadow/*".format(target_device_id),
             ]
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+            "iot:Subscribe"
+            ],
+            "Resource": [
+            "arn:aws:iot:us-east-1:*:topicfilter/$aws/things/{}/shadow/update/accepted".format(target_device_id),
+            "arn:aws:iot:us-east-1:*:topicfilter/$aws/things/{}/shadow/update/rejected".format(target_device_id),
+            "arn:aws:iot:us-east-1:*:topicfilter/$aws/things/{}/shadow/get/+".format(target_device_id)
+            ]
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+            "iot:Receive"
+            ],
+            "Resource": [
+            "arn:aws:iot:us-east-1:*:topic/$aws/things/{}/shadow/*".format(target_device_id)
+            ]
         }
         ]
     }
@@ -0,0 +1,41 @@
+import time
+
+import pytest
+
+import mqtt_transport
+import virtual_device
+
+
+@pytest.fixture
+def device_config():
+    """Build the configuration of a device on the local transport, `extra` keys added."""
+    def config(name, **extra):
+        cfg = {"device_name": name, "iot_endpoint": "ep", "cert": "cert", "key": "key", "root_ca": "ca",
+               "transport": mqtt_transport.TRANSPORT_LOCAL}
+        cfg.update(extra)
+
+        return cfg
+
+    return config
+
+
+@pytest.fixture
+def wait_until():
+    """Poll `condition` until it is true, failing after `timeout` seconds."""
+    def wait(condition, timeout=5):
+        deadline = time.monotonic() + timeout
+
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    return wait
+
+
+@pytest.fixture
+def local_devices(tmp_path, monkeypatch):
+    """Devices started by the test keep their files under tmp_path and connect at once."""
+    monkeypatch.setattr(virtual_device, "DEFAULT_FILES_ROOT", str(tmp_path))
+    # No external IP lookup, and no settling time after connecting
+    monkeypatch.setattr(virtual_device.VirtualDevice, "publish_external_ip", lambda self: None)
+    monkeypatch.setattr(virtual_device, "SETUP_DELAY", 0)
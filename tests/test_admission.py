@@ -0,0 +1,37 @@
+from admission import AdmissionController
+
+
+def test_token_bucket_pacing():
+    now = [0.0]
+    controller = AdmissionController(rate=10, burst=2, clock=lambda: now[0])
+
+    # The burst goes through, then one admission every 1/rate seconds, queued in arrival order
+    assert [round(controller.reserve(), 3) for _ in range(5)] == [0, 0, 0.1, 0.2, 0.3]
+
+    now[0] = 1.0
+    assert controller.reserve() == 0
+
+
+def test_time_to_fully_connected():
+    now = [0.0]
+    controller = AdmissionController(clock=lambda: now[0])
+
+    for name in ("a", "b", "c"):
+        controller.expect(name)
+
+    now[0] = 2.0
+    controller.on_connected("a")
+    controller.forget("b")
+    assert controller.time_to_fully_connected is None
+
+    now[0] = 3.5
+    controller.on_connected("c")
+    assert controller.get_stats()["time_to_fully_connected"] == 3.5
+    assert controller.get_stats()["connecting"] == 0
+
+
+def test_zero_burst_paces_every_admission():
+    now = [0.0]
+    controller = AdmissionController(rate=10, burst=0, clock=lambda: now[0])
+
+    assert [round(controller.reserve(), 3) for _ in range(3)] == [0.1, 0.2, 0.3]
@@ -0,0 +1,35 @@
+import pytest
+
+import app
+import mqtt_transport
+import virtual_device
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(virtual_device, "DEFAULT_FILES_ROOT", str(tmp_path))
+    monkeypatch.setattr(app, "host", app.DeviceHost())
+    flask_app = app.create_app({"devices": []})
+    app.host.add_device({"device_name": "dev1", "iot_endpoint": "ep", "cert": "cert", "key": "key", "root_ca": "ca",
+                         "transport": mqtt_transport.TRANSPORT_LOCAL})
+
+    return flask_app.test_client()
+
+
+def test_log_pages(client):
+    assert client.get("/log?limit=5").status_code == 200
+    assert client.get("/log?since=abc").status_code == 400
+    assert client.get("/log?limit=ten").status_code == 400
+    assert client.get("/log?limit=0").status_code == 400
+    assert client.get("/log/stream", headers={"Last-Event-ID": "x"}).status_code == 400
+
+
+def test_unknown_device_is_not_found(client):
+    response = client.get("/log?device=dev2")
+    assert response.status_code == 404
+    assert b"Unknown device &#39;dev2&#39;" in response.data
+
+    app.host.remove_device("dev1")
+    response = client.get("/")
+    assert response.status_code == 404
+    assert b"No devices are hosted" in response.data
@@ -0,0 +1,58 @@
+import pytest
+
+from device_host import DeviceHost
+
+
+@pytest.fixture
+def host(local_devices):
+    host = DeviceHost()
+    yield host
+    host.stop_all(timeout=5)
+
+
+def test_add_and_get_device(host, device_config):
+    with pytest.raises(KeyError):
+        host.get_device()
+
+    first = host.add_device(device_config("dev1"))
+    host.load({"devices": [device_config("dev2", **{"device-type": "bulb"})]})
+
+    assert host.get_device() is first
+    assert host.get_device("dev2").name == "dev2"
+    assert host.names() == ["dev1", "dev2"]
+    assert [device["type"] for device in host.describe()] == ["generic", "bulb"]
+
+    with pytest.raises(KeyError):
+        host.get_device("dev3")
+
+    with pytest.raises(ValueError):
+        host.add_device(device_config("dev1"))
+
+    with pytest.raises(ValueError):
+        host.add_device(device_config("dev3", **{"device-type": "toaster"}))
+
+
+def test_start_stop_and_restart(host, device_config, wait_until):
+    vd = host.add_device(device_config("dev1"))
+
+    host.start_device("dev1")
+    wait_until(lambda: vd._mqtt_client is not None and vd._mqtt_client.is_connected())
+    assert host.is_running("dev1")
+    first = vd._mqtt_client
+
+    # One admission token per CONNECT, the startup requests take none
+    wait_until(lambda: any(topic == "$aws/things/dev1/shadow/get" for topic, _, _ in first.published))
+    assert host.admission.get_stats()["admitted"] == 1
+
+    host.stop_device("dev1", timeout=5)
+    assert not host.is_running("dev1")
+    assert not first.is_connected()
+
+    # A stopped device starts again on a new connection
+    host.start_device("dev1")
+    wait_until(lambda: vd._mqtt_client is not first and vd._mqtt_client.is_connected())
+    assert host.is_running("dev1")
+    assert host.get_stats()[0]["running"]
+
+    host.remove_device("dev1")
+    assert host.names() == []
@@ -0,0 +1,135 @@
+import threading
+
+import pytest
+
+import device_log
+
+
+class Expensive(object):
+    formatted = 0
+
+    def __str__(self):
+        Expensive.formatted += 1
+        return "expensive"
+
+
+def test_records_are_formatted_lazily():
+    log = device_log.RingLog(size=10, level=device_log.INFO, echo=False)
+
+    log.log(device_log.DEBUG, "skipped {}", (Expensive(),))
+    log.log(device_log.INFO, "kept {} {}", (Expensive(), device_log.Json({"b": 1, "a": 2}, sort_keys=True)))
+
+    assert Expensive.formatted == 0
+    records = log.records()
+    assert [record.message() for record in records] == ['kept expensive {"a": 2, "b": 1}']
+    assert records[0].format().endswith(" - INFO - kept expensive {\"a\": 2, \"b\": 1}")
+
+
+def test_ring_keeps_the_last_records():
+    consumed = []
+    log = device_log.RingLog(size=3, echo=False)
+    log.sinks.append(consumed.append)
+
+    for i in range(5):
+        log.log(device_log.WARNING, "record {}", (i,))
+
+    assert [record.message() for record in log.records()] == ["record 2", "record 3", "record 4"]
+    assert len(consumed) == 5
+
+
+def test_bad_template_and_level():
+    log = device_log.RingLog(size=3, echo=False)
+    log.log(device_log.ERROR, "missing {} {}", (1,))
+
+    assert log.records()[0].message() == "missing {} {} (1,)"
+
+    log.log(device_log.ERROR, "delay {:.1f}", (None,))
+    assert log.records()[1].message() == "delay {:.1f} (None,)"
+
+    with pytest.raises(ValueError):
+        device_log.parse_level("verbose")
+
+
+def test_since_cursor():
+    log = device_log.RingLog(size=4, echo=False)
+
+    for i in range(6):
+        log.log(device_log.INFO, "record {}", (i,))
+
+    # Records 0 and 1 were overwritten
+    records, cursor = log.since(0, 3)
+    assert [record.seq for record in records] == [2, 3, 4]
+    assert cursor == 5
+
+    records, cursor = log.since(cursor, 10)
+    assert [record.seq for record in records] == [5]
+    assert log.since(cursor, 10) == ([], 6)
+
+    assert [record.seq for record in log.tail(2)[0]] == [4, 5]
+    assert log.since(100, 10) == ([], 6)
+
+
+def test_record_is_readable_once_written(monkeypatch):
+    log = device_log.RingLog(size=10, echo=False)
+    building = threading.Event()
+    release = threading.Event()
+    record_class = device_log.LogRecord
+
+    def slow_record(seq, *args):
+        if seq == 0:
+            building.set()
+            release.wait(5)
+
+        return record_class(seq, *args)
+
+    monkeypatch.setattr(device_log, "LogRecord", slow_record)
+    first = threading.Thread(target=log.log, args=(device_log.INFO, "first"))
+    first.start()
+    building.wait(5)
+    second = threading.Thread(target=log.log, args=(device_log.INFO, "second"))
+    second.start()
+    second.join(0.2)
+
+    # The second record is not readable before the first one, which would be skipped
+    records, cursor = log.since(0, 10)
+    release.set()
+    first.join()
+    second.join()
+
+    more, _ = log.since(cursor, 10)
+    assert [record.seq for record in records + more] == [0, 1]
+
+
+def test_log_shipper_batches_and_drops():
+    writes = []
+    shipper = device_log.LogShipper(write=writes.append, max_size=3, batch_size=2)
+    log = device_log.RingLog(size=10, echo=False)
+    log.sinks.append(shipper.submit)
+
+    for i in range(5):
+        log.log(device_log.INFO, "record {}", (i,))
+
+    # Not started: nothing written until a flush
+    assert writes == [] and len(shipper) == 3
+    shipper.flush()
+
+    lines = "".join(writes).splitlines()
+    assert len(writes) == 2
+    assert lines[0].endswith("log shipper - 2 records dropped")
+    assert [line.split(" - ")[-1] for line in lines[1:]] == ["record 0", "record 1", "record 2"]
+    assert shipper.get_counters()["log_shipped"] == 3
+
+
+def test_log_shipper_thread_survives_a_bad_template():
+    writes = []
+    shipped = threading.Event()
+    shipper = device_log.LogShipper(write=lambda text: writes.append(text) or shipped.set(), interval=0.01)
+    shipper.start()
+
+    shipper.submit(device_log.LogRecord(0, 0, device_log.INFO, "delay {:.1f}", (None,)))
+    assert shipped.wait(5)
+    shipped.clear()
+
+    shipper.submit(device_log.LogRecord(1, 0, device_log.INFO, "next", ()))
+    assert shipped.wait(5)
+    assert writes[0].endswith("delay {:.1f} (None,)\n") and writes[1].endswith("next\n")
@@ -0,0 +1,83 @@
+import queue
+
+import pytest
+
+import fleet
+
+
+def test_burst_shares_add_up_to_the_fleet_burst():
+    assert fleet.shard_bursts(10, 4) == [3, 3, 2, 2]
+    assert fleet.shard_bursts(2, 4) == [1, 1, 0, 0]
+
+    supervisor = fleet.FleetSupervisor(["cfg-{}".format(i) for i in range(8)], workers=8, connect_rate=40, connect_burst=4)
+    assert sum(shard["connect_burst"] for shard in supervisor._shards.values()) == 4
+    assert supervisor._connect_rate == 5
+
+
+class FakeProcess(object):
+
+    def __init__(self):
+        self.pid = 1
+        self.exitcode = None
+
+    def is_alive(self):
+        return self.exitcode is None
+
+
+@pytest.fixture
+def supervisor(monkeypatch, device_config):
+    supervisor = fleet.FleetSupervisor([device_config("dev{}".format(i)) for i in range(6)], workers=3)
+    spawned = []
+
+    def spawn(shard_id):
+        spawned.append(shard_id)
+        supervisor._shards[shard_id]["process"] = FakeProcess()
+        supervisor._shards[shard_id]["commands"] = queue.Queue()
+
+    monkeypatch.setattr(supervisor, "_spawn", spawn)
+    supervisor.start()
+    supervisor.spawned = spawned
+
+    return supervisor
+
+
+def test_configs_are_sharded_round_robin(supervisor):
+    assert fleet.shard_configs(list(range(5)), 2) == [[0, 2, 4], [1, 3]]
+    assert [[cfg["device_name"] for cfg in shard["configs"]] for shard in supervisor._shards.values()] == \
+        [["dev0", "dev3"], ["dev1", "dev4"], ["dev2", "dev5"]]
+    assert supervisor.status()["totals"]["devices"] == 6
+
+
+def test_crashed_shard_restarts_then_is_rebalanced(supervisor, device_config):
+    for restart in range(fleet.MAX_RESTARTS):
+        supervisor._shards[0]["process"].exitcode = 1
+        supervisor._handle_crash(0)
+        assert not supervisor._shards[0]["retired"]
+
+    assert supervisor.spawned == [0, 1, 2] + [0] * fleet.MAX_RESTARTS
+
+    # One crash too many within the window: its devices move to the other shards
+    supervisor._shards[0]["process"].exitcode = 1
+    supervisor._handle_crash(0)
+
+    assert supervisor._shards[0]["retired"] and supervisor._shards[0]["configs"] == []
+    assert supervisor._shards[1]["commands"].get_nowait() == (fleet.CMD_ADD, [device_config("dev0")])
+    assert supervisor._shards[2]["commands"].get_nowait() == (fleet.CMD_ADD, [device_config("dev3")])
+
+    status = supervisor.status()
+    assert status["totals"]["devices"] == 6
+    assert status["shards"][0]["restarts"] == fleet.MAX_RESTARTS + 1
+
+
+def test_bad_config_does_not_take_the_shard_down(local_devices, device_config):
+    commands = queue.Queue()
+    reports = queue.Queue()
+
+    commands.put((fleet.CMD_ADD, [device_config("dev2"), {"iot_endpoint": "ep"}]))
+    commands.put((fleet.CMD_STOP, None))
+    fleet.run_shard(0, [device_config("dev1", **{"device-type": "toaster"}), device_config("dev0")], commands, reports, 50, 10)
+
+    shard_id, pid, ts, stats, admission_stats, errors = reports.get_nowait()
+    assert sorted(device["name"] for device in stats) == ["dev0", "dev2"]
+    assert errors == [{"device": "dev1", "error": "ValueError: Unknown device type 'toaster'"},
+                      {"device": None, "error": "KeyError: 'device_name'"}]
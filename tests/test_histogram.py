@@ -0,0 +1,39 @@
+from histogram import Histogram
+from publish_queue import InflightWindow
+
+
+def test_histogram_quantiles():
+    h = Histogram(buckets=(0.01, 0.1, 1))
+
+    for value in (0.005, 0.005, 0.05, 0.5, 5):
+        h.observe(value)
+
+    assert h.cumulative_counts() == [(0.01, 2), (0.1, 3), (1, 4), (float("inf"), 5)]
+    assert h.quantile(0.5) == 0.1
+    assert h.snapshot()["p99"] == "+Inf"
+    assert Histogram().quantile(0.5) is None
+
+
+def test_inflight_window():
+    now = [0.0]
+    acks = []
+    window = InflightWindow(size=2, timeout=10, on_ack=lambda: acks.append(1), clock=lambda: now[0])
+
+    first = window.track()
+    window.track()
+    assert window.is_full()
+
+    now[0] = 0.05
+    first()
+    first()
+    assert not window.is_full()
+    assert acks == [1]
+    assert window.latency.count == 1
+
+    # The second ack never comes, its slot is freed after the timeout
+    now[0] = 5
+    window.track()
+    assert window.is_full()
+    now[0] = 10.1
+    assert not window.is_full()
+    assert window.get_counters()["ack_timeouts"] == 1
@@ -0,0 +1,33 @@
+from histogram import Histogram
+from instruments import classify_topic
+from prometheus import Exposition, COUNTER
+
+
+def test_classify_topic():
+    assert classify_topic("$aws/things/dev1/defender/metrics/json") == "device_defender"
+    assert classify_topic("$aws/things/dev1/shadow/get/accepted") == "shadow"
+    assert classify_topic("cmd/dev1/tamper") == "command"
+    assert classify_topic("dt/ac/company1/area1/dev1/temp") == "telemetry"
+
+
+def test_exposition():
+    e = Exposition()
+    e.add("messages_published_total", COUNTER, "Published", 3, device="dev1", topic_class="telemetry")
+    h = Histogram(buckets=(0.1, 1))
+    h.observe(0.5)
+    e.add_histogram("latency_seconds", "Latency", h, device="dev1")
+    e.add("messages_published_total", COUNTER, "Published", 1, device="dev\"2", topic_class="shadow")
+
+    assert e.render().splitlines() == [
+        "# HELP virtual_device_messages_published_total Published",
+        "# TYPE virtual_device_messages_published_total counter",
+        'virtual_device_messages_published_total{device="dev1",topic_class="telemetry"} 3',
+        'virtual_device_messages_published_total{device="dev\\"2",topic_class="shadow"} 1',
+        "# HELP virtual_device_latency_seconds Latency",
+        "# TYPE virtual_device_latency_seconds histogram",
+        'virtual_device_latency_seconds_bucket{device="dev1",le="0.1"} 0',
+        'virtual_device_latency_seconds_bucket{device="dev1",le="1.0"} 1',
+        'virtual_device_latency_seconds_bucket{device="dev1",le="+Inf"} 1',
+        'virtual_device_latency_seconds_sum{device="dev1"} 0.5',
+        'virtual_device_latency_seconds_count{device="dev1"} 1'
+    ]
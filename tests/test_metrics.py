@@ -0,0 +1,53 @@
+import json
+
+import cbor
+
+import tags
+from metrics import Metrics
+
+
+# Long tag name -> short tag name
+SHORT_NAMES = dict(value for name, value in vars(tags.Tags).items() if name.isupper())
+
+
+def sample_metrics(short_names, last_metric=None):
+    m = Metrics(short_names, last_metric)
+    m.add_network_stats(1000, 10, 2000, 20)
+    m.add_network_connection("10.0.0.1", 443, "eth0", 50000)
+    m.add_listening_ports("TCP", [22, 80])
+    m.add_listening_ports("UDP", [53])
+    m._timestamp = 1600000000
+
+    return m
+
+
+def shorten(value):
+    if isinstance(value, dict):
+        return {SHORT_NAMES[key]: shorten(item) for key, item in value.items()}
+
+    if isinstance(value, list):
+        return [shorten(item) for item in value]
+
+    return value
+
+
+def test_cbor_report_matches_json_report():
+    report = json.loads(sample_metrics(False).to_json_string())
+    short_report = cbor.loads(sample_metrics(True).to_cbor())
+
+    assert short_report == shorten(report)
+    assert short_report["hed"] == {"rid": 1600000000, "v": "1.0"}
+    assert short_report["met"]["tc"]["ec"] == {"cs": [{"rad": "10.0.0.1:443", "li": "eth0", "lp": 50000}], "t": 1}
+    assert short_report["met"]["tp"] == {"pts": [22, 80], "t": 2}
+
+    # The long names round-trip through CBOR as well
+    assert cbor.loads(sample_metrics(False).to_cbor()) == report
+    assert len(sample_metrics(True).to_cbor()) < len(sample_metrics(False).to_json_string())
+
+
+def test_delta_network_stats():
+    previous = sample_metrics(True)
+    m = Metrics(True, previous)
+    m.add_network_stats(1500, 15, 2600, 26)
+
+    assert m.network_stats == {"bi": 500, "bo": 600, "pi": 5, "po": 6}
@@ -0,0 +1,221 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import mqtt_transport
+from mqtt_transport import AsyncioTransport, topic_matches
+
+
+def test_topic_matches():
+    assert topic_matches("$aws/things/dev-1/shadow/get/+", "$aws/things/dev-1/shadow/get/accepted")
+    assert topic_matches("$aws/things/dev-1/jobs/get/#", "$aws/things/dev-1/jobs/get/accepted")
+    assert topic_matches("$aws/things/dev-1/jobs/get/#", "$aws/things/dev-1/jobs/get")
+    assert not topic_matches("$aws/things/dev-1/jobs/+/get/+", "$aws/things/dev-1/jobs/get/accepted")
+    assert not topic_matches("cmd/ac/dev-1/req", "cmd/ac/dev-2/req")
+
+
+def test_encode_length():
+    assert mqtt_transport._encode_length(0) == b"\x00"
+    assert mqtt_transport._encode_length(127) == b"\x7f"
+    assert mqtt_transport._encode_length(321) == b"\xc1\x02"
+
+
+async def _fake_broker(reader, writer):
+    # Accepts the connection and echoes every publish back to the client
+    while True:
+        try:
+            header, body = await mqtt_transport.read_packet(reader)
+        except asyncio.IncompleteReadError:
+            return
+
+        if header & 0xF0 == mqtt_transport.CONNECT:
+            writer.write(bytes([mqtt_transport.CONNACK, 2, 0, 0]))
+        elif header & 0xF0 == mqtt_transport.SUBSCRIBE:
+            writer.write(bytes([mqtt_transport.SUBACK, 3]) + body[:2] + b"\x00")
+        elif header & 0xF0 == mqtt_transport.PUBLISH and b"drop" in body:
+            # A broker outage
+            writer.close()
+            return
+        elif header & 0xF0 == mqtt_transport.PUBLISH:
+            writer.write(bytes([header]) + mqtt_transport._encode_length(len(body)) + body)
+        elif header & 0xF0 == mqtt_transport.DISCONNECT:
+            writer.close()
+            return
+
+
+def test_asyncio_transport_round_trip():
+    loop = mqtt_transport.get_shared_loop()
+    server = asyncio.run_coroutine_threadsafe(asyncio.start_server(_fake_broker, "127.0.0.1", 0), loop).result(5)
+    port = server.sockets[0].getsockname()[1]
+
+    received = []
+    done = threading.Event()
+
+    async def on_message(client, userdata, message):
+        received.append((message.topic, message.payload))
+        done.set()
+
+    transport = AsyncioTransport("dev-1", "127.0.0.1", port)
+    assert transport.connect(30)
+
+    transport.subscribe("$aws/things/dev-1/shadow/get/+", 0, on_message)
+    transport.publish("$aws/things/dev-1/shadow/get/accepted", '{"state": {}}', 0)
+
+    assert done.wait(5)
+    assert received == [("$aws/things/dev-1/shadow/get/accepted", b'{"state": {}}')]
+
+    transport.disconnect()
+    server.close()
+
+
+def test_asyncio_transport_dispatches_in_order_one_at_a_time():
+    loop = mqtt_transport.get_shared_loop()
+    server = asyncio.run_coroutine_threadsafe(asyncio.start_server(_fake_broker, "127.0.0.1", 0), loop).result(5)
+    port = server.sockets[0].getsockname()[1]
+
+    received = []
+    running = []
+    done = threading.Event()
+
+    def on_message(client, userdata, message):
+        running.append(message.payload)
+        assert len(running) == 1
+        # Later messages would overtake a slow callback run concurrently
+        time.sleep(0.02 if int(message.payload) % 2 == 0 else 0)
+        received.append(int(message.payload))
+        running.remove(message.payload)
+
+        if len(received) == 10:
+            done.set()
+
+    transport = AsyncioTransport("dev-1", "127.0.0.1", port)
+    assert transport.connect(30)
+    transport.subscribe("dt/dev-1/+", 0, on_message)
+
+    for i in range(10):
+        transport.publish("dt/dev-1/temp", str(i), 0)
+
+    assert done.wait(5)
+    assert received == list(range(10))
+
+    transport.disconnect()
+    server.close()
+
+
+def test_asyncio_transport_reconnects_with_the_given_delays():
+    loop = mqtt_transport.get_shared_loop()
+    server = asyncio.run_coroutine_threadsafe(asyncio.start_server(_fake_broker, "127.0.0.1", 0), loop).result(5)
+    port = server.sockets[0].getsockname()[1]
+
+    events = []
+    reconnected = threading.Event()
+
+    def reconnect_delay():
+        events.append("delay")
+        return 0
+
+    def on_reconnected():
+        events.append("reconnected")
+        reconnected.set()
+
+    transport = AsyncioTransport("dev-1", "127.0.0.1", port)
+    transport.configure_reconnect(reconnect_delay, on_reconnected, lambda: events.append("lost"))
+    assert transport.connect(30)
+
+    transport.publish("drop", "", 0)
+
+    assert reconnected.wait(5)
+    assert events == ["lost", "delay", "reconnected"]
+    assert transport.is_connected()
+
+    transport.disconnect()
+    server.close()
+
+
+def test_asyncio_transport_reconnects_after_a_dropped_connect():
+    loop = mqtt_transport.get_shared_loop()
+    connects = []
+
+    async def broker(reader, writer):
+        # The second CONNECT is dropped without a CONNACK, as a throttled one would be
+        header, body = await mqtt_transport.read_packet(reader)
+        connects.append(header)
+
+        if len(connects) == 2:
+            writer.close()
+            return
+
+        writer.write(bytes([mqtt_transport.CONNACK, 2, 0, 0]))
+        await _fake_broker(reader, writer)
+
+    server = asyncio.run_coroutine_threadsafe(asyncio.start_server(broker, "127.0.0.1", 0), loop).result(5)
+    port = server.sockets[0].getsockname()[1]
+
+    logged = []
+    reconnected = threading.Event()
+    transport = AsyncioTransport("dev-1", "127.0.0.1", port)
+    transport.configure_log(lambda template, *args, level: logged.append(template.format(*args)))
+    transport.configure_reconnect(lambda: 0, reconnected.set)
+    assert transport.connect(30)
+
+    transport.publish("drop", "", 0)
+
+    assert reconnected.wait(5)
+    assert len(connects) == 3
+    assert logged == [" transport - Reconnection failed 'IncompleteReadError: 0 bytes read on a total of 1 expected bytes'"]
+
+    transport.disconnect()
+    server.close()
+
+
+def test_asyncio_transport_detects_a_silent_broker():
+    loop = mqtt_transport.get_shared_loop()
+
+    async def broker(reader, writer):
+        # Half-open: the CONNACK, then nothing, PINGRESP included
+        await mqtt_transport.read_packet(reader)
+        writer.write(bytes([mqtt_transport.CONNACK, 2, 0, 0]))
+
+        try:
+            while await reader.read(1024):
+                pass
+        except ConnectionError:
+            pass
+
+    server = asyncio.run_coroutine_threadsafe(asyncio.start_server(broker, "127.0.0.1", 0), loop).result(5)
+    port = server.sockets[0].getsockname()[1]
+
+    lost = threading.Event()
+    transport = AsyncioTransport("dev-1", "127.0.0.1", port)
+    transport.configure_reconnect(lambda: 60, on_connection_lost=lost.set)
+    start = time.monotonic()
+    assert transport.connect(1)
+
+    assert lost.wait(5)
+    assert 1.5 <= time.monotonic() - start < 3
+    assert not transport.is_connected()
+
+    transport.disconnect()
+    server.close()
+
+
+def test_local_transport_basic_ingest():
+    transport = mqtt_transport.LocalTransport("dev-1", basic_ingest_rules=["telemetry_rule"])
+    received = []
+    transport.subscribe("dt/ac/company1/area1/dev-1/temp", 0, lambda client, userdata, message: received.append(message))
+
+    transport.publish("$aws/rules/telemetry_rule/dt/ac/company1/area1/dev-1/temp", '{"temp": 30}', 0)
+
+    assert transport.ingested["telemetry_rule"] == [("dt/ac/company1/area1/dev-1/temp", '{"temp": 30}')]
+    assert received == []
+
+    with pytest.raises(ValueError):
+        transport.publish("$aws/rules/other_rule/dt/ac/company1/area1/dev-1/temp", '{"temp": 30}', 0)
+
+    with pytest.raises(ValueError):
+        transport.publish("$aws/rules/telemetry_rule/dt/+/temp", '{"temp": 30}', 0)
+
+    with pytest.raises(ValueError):
+        transport.publish("$aws/rules/telemetry_rule", '{"temp": 30}', 0)
@@ -0,0 +1,68 @@
+import marshal
+import threading
+
+import pytest
+
+import profiler
+
+
+def test_sample_stacks_sees_other_threads():
+    stop = threading.Event()
+
+    def waiting_thread():
+        stop.wait()
+
+    thread = threading.Thread(target=waiting_thread, name="device-1")
+    thread.start()
+
+    try:
+        stacks = profiler.sample_stacks(0.05, interval=0.01, by_thread=True)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert any(stack.startswith("device-1;") and "test_profiler.py:waiting_thread" in stack for stack in stacks)
+    assert profiler.collapse({"a;b": 2, "a": 1}) == "a 1\na;b 2\n"
+
+
+def test_single_profile_at_a_time():
+    with pytest.raises(ValueError):
+        profiler.sample_stacks(0)
+
+    profiler._running.acquire()
+
+    try:
+        with pytest.raises(ValueError):
+            profiler.sample_stacks(0.01)
+    finally:
+        profiler._running.release()
+
+
+class Device(object):
+
+    def __init__(self, busy):
+        self.busy = busy
+        self.profile = None
+
+    def set_profile(self, profile):
+        self.profile = profile
+
+        if profile is not None and self.busy:
+            profiler.profiled(profile, busy_handler)()
+
+
+def busy_handler():
+    return sum(range(1000))
+
+
+def test_profile_devices_skips_empty_profiles():
+    # No device, or idle devices only: empty statistics rather than an error
+    assert marshal.loads(profiler.profile_devices([], 0.01)) == {}
+    assert marshal.loads(profiler.profile_devices([Device(False), Device(False)], 0.01)) == {}
+
+    devices = [Device(False), Device(True), Device(True)]
+    stats = marshal.loads(profiler.profile_devices(devices, 0.01))
+
+    calls = [value for (filename, line, name), value in stats.items() if name == "busy_handler"]
+    assert len(calls) == 1 and calls[0][1] == 2
+    assert all(vd.profile is None for vd in devices)
@@ -0,0 +1,62 @@
+import pytest
+
+from publish_queue import PublishQueue, POLICY_DROP_NEWEST, POLICY_PRIORITY, PRIORITY_CRITICAL, PRIORITY_EVENT
+
+
+def drain(queue):
+    topics = []
+    item = queue.get()
+
+    while item is not None:
+        topics.append(item.topic)
+        item = queue.get()
+
+    return topics
+
+
+def test_drop_oldest_is_fifo():
+    queue = PublishQueue(max_size=3)
+
+    for i in range(5):
+        queue.put("t{}".format(i), b"")
+
+    assert drain(queue) == ["t2", "t3", "t4"]
+    assert queue.get_counters()["queue_dropped"] == 2
+
+
+def test_drop_newest():
+    queue = PublishQueue(max_size=2, policy=POLICY_DROP_NEWEST)
+
+    assert [queue.put(topic, b"") for topic in ("a", "b", "c")] == [True, True, False]
+    assert drain(queue) == ["a", "b"]
+
+
+def test_priority():
+    queue = PublishQueue(max_size=3, policy=POLICY_PRIORITY)
+    queue.put("telemetry1", b"")
+    queue.put("telemetry2", b"")
+    queue.put("event", b"", priority=PRIORITY_EVENT)
+
+    # Full: the oldest telemetry makes room for the tamper message
+    assert queue.put("tamper", b"", priority=PRIORITY_CRITICAL)
+    # Same class: the oldest telemetry is dropped
+    queue.put("telemetry3", b"")
+    # Only more important messages left: the telemetry itself is dropped
+    queue.configure(2, POLICY_PRIORITY)
+    assert not queue.put("telemetry4", b"")
+
+    assert drain(queue) == ["tamper", "event"]
+    assert queue.dropped == 4
+
+
+def test_configure():
+    queue = PublishQueue(max_size=4)
+
+    for topic in "abcd":
+        queue.put(topic, b"")
+
+    queue.configure(2, POLICY_DROP_NEWEST)
+    assert drain(queue) == ["a", "b"]
+
+    with pytest.raises(ValueError):
+        queue.configure(0, POLICY_PRIORITY)
@@ -0,0 +1,56 @@
+from reconnect import ReconnectPolicy
+
+
+def test_capped_full_jitter():
+    policy = ReconnectPolicy(base_delay=1, max_delay=10, rand=lambda: 1.0)
+
+    assert [policy.next_delay() for _ in range(6)] == [1, 2, 4, 8, 10, 10]
+
+    policy.on_connected()
+    assert policy.next_delay() == 1
+
+    policy = ReconnectPolicy(base_delay=1, max_delay=10, rand=lambda: 0.25)
+    assert [policy.next_delay() for _ in range(3)] == [0.25, 0.5, 1.0]
+
+
+def test_counters():
+    now = [100.0]
+    policy = ReconnectPolicy(clock=lambda: now[0])
+
+    policy.on_attempt()
+    policy.next_delay()
+    policy.on_attempt()
+    policy.on_connected()
+    now[0] += 5
+    assert policy.connected_duration == 5
+
+    policy.on_disconnected()
+    now[0] += 100
+    policy.on_connected()
+    now[0] += 1
+
+    assert policy.get_counters() == {"connect_attempts": 2, "connect_failures": 1, "connections": 2, "connected_seconds": 6}
+
+
+def test_interrupt():
+    policy = ReconnectPolicy()
+    policy.interrupt()
+
+    assert not policy.wait(10)
+
+
+def test_connection_loss_is_not_a_failure():
+    policy = ReconnectPolicy(base_delay=1, max_delay=10, rand=lambda: 1.0)
+    policy.on_connected()
+    policy.on_connection_lost()
+
+    assert [policy.next_delay() for _ in range(3)] == [1, 2, 4]
+    assert policy.get_counters()["connect_failures"] == 2
+
+
+def test_stale_interrupt_is_cleared():
+    policy = ReconnectPolicy()
+    policy.interrupt()
+    policy.clear_interrupt()
+
+    assert policy.wait(0.01)
@@ -0,0 +1,89 @@
+from reported_state import ReportedStateEngine, count_keys, diff_reported
+
+
+def test_reports_only_changed_keys_in_batches():
+    now = [0]
+    updates = []
+    engine = ReportedStateEngine(updates.append, {"status": "off", "color": {"r": 255, "g": 255, "b": 255}}, window=1,
+                                 clock=lambda: now[0])
+
+    engine.sync({"status": "off", "color": {"r": 255, "g": 255, "b": 255}})
+    assert engine.next_flush() is None
+
+    engine.apply({"status": "on"})
+    engine.apply({"color": {"g": 0}})
+    assert not engine.flush()
+
+    now[0] = 1
+    assert engine.flush()
+    assert updates[0]["state"]["reported"] == {"status": "on", "color": {"g": 0}}
+
+    # Changes wait for the reply, and a change undone before the flush is not reported
+    engine.apply({"status": "off"})
+    now[0] = 3
+    assert not engine.flush()
+
+    engine.on_accepted({"clientToken": updates[0]["clientToken"]})
+    engine.apply({"status": "on"})
+    assert engine.flush() is False and len(updates) == 1
+
+    counters = engine.get_counters()
+    assert counters["reported_keys"] == 2
+    assert counters["reported_document_keys"] == count_keys(engine.actual) == 4
+
+
+def test_desired_delta_is_followed_and_rejections_retried():
+    now = [0]
+    updates = []
+    engine = ReportedStateEngine(updates.append, window=0, clock=lambda: now[0])
+
+    engine.sync({"status": "off", "ip": "10.0.0.1"}, delta={"status": "on"})
+    assert engine.actual == {"status": "on"}
+    assert engine.flush()
+    # The reported state belongs to the actuator, keys it does not have are deleted
+    assert updates[0]["state"]["reported"] == {"status": "on", "ip": None}
+
+    engine.on_rejected({"clientToken": updates[0]["clientToken"], "code": 500})
+    assert engine.next_flush() == 0
+    assert engine.flush()
+    assert updates[1]["state"]["reported"] == {"status": "on", "ip": None}
+    assert engine.get_counters()["reported_failed"] == 1
+
+    engine.on_accepted({"clientToken": updates[1]["clientToken"]})
+    assert not diff_reported(engine.actual, {"status": "on"})
+
+
+def test_deleted_keys_are_reported_as_null():
+    assert diff_reported({"color": {"r": 0}}, {"color": {"r": 0, "g": 0}, "status": "on"}) == {"color": {"g": None}, "status": None}
+
+    now = [0]
+    updates = []
+    engine = ReportedStateEngine(updates.append, {"status": "on", "color": {"r": 0}}, window=0, clock=lambda: now[0])
+    engine.sync({"status": "on", "color": {"r": 0}})
+    assert engine.next_flush() is None
+
+    engine.apply({"color": None})
+    assert engine.flush()
+    assert updates[0]["state"]["reported"] == {"color": None}
+
+
+def test_rejections_are_retried_a_bounded_number_of_times():
+    now = [0]
+    updates = []
+    engine = ReportedStateEngine(updates.append, {"status": "on"}, window=0, max_retries=2, clock=lambda: now[0])
+
+    # A client error is not retried
+    assert engine.flush()
+    engine.on_rejected({"clientToken": updates[-1]["clientToken"], "code": 400})
+    assert engine.next_flush() is None
+
+    # A service error is, up to max_retries
+    engine.apply({"status": "off"})
+    for _ in range(3):
+        assert engine.flush()
+        engine.on_rejected({"clientToken": updates[-1]["clientToken"], "code": 503})
+
+    assert engine.next_flush() is None and not engine.flush()
+    counters = engine.get_counters()
+    assert counters["reported_failed"] == 4
+    assert counters["reported_retried"] == 2
@@ -0,0 +1,53 @@
+import threading
+import time
+
+from scheduler import Scheduler
+
+
+def test_wait_returns_due_events_in_order():
+    s = Scheduler()
+    s.schedule("b", 0.02)
+    s.schedule("a", 0)
+
+    assert s.wait() == ["a"]
+    assert s.wait() == ["b"]
+
+
+def test_schedule_replaces_previous_deadline():
+    s = Scheduler()
+    s.schedule("telemetry", 60)
+    s.schedule("telemetry", 0)
+
+    assert s.wait(timeout=1) == ["telemetry"]
+    assert s.wait(timeout=0.05) == []
+
+
+def test_cancel():
+    s = Scheduler()
+    s.schedule("telemetry", 0)
+    s.cancel("telemetry")
+
+    assert not s.is_scheduled("telemetry")
+    assert s.wait(timeout=0.05) == []
+
+
+def test_wake_interrupts_wait():
+    s = Scheduler()
+    s.schedule("telemetry", 60)
+
+    threading.Timer(0.05, s.wake).start()
+    started = time.monotonic()
+
+    assert s.wait() == []
+    assert time.monotonic() - started < 5
+    assert s.is_scheduled("telemetry")
+
+
+def test_last_lag():
+    now = [0.0]
+    s = Scheduler(clock=lambda: now[0])
+    s.schedule("telemetry", 1)
+    now[0] = 1.25
+
+    assert s.wait() == ["telemetry"]
+    assert s.last_lag == 0.25
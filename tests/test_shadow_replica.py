@@ -0,0 +1,141 @@
+import concurrent.futures
+import json
+
+import pytest
+
+import mqtt_transport
+from shadow_replica import ShadowReplica, diff_state
+from mqtt_transport import MqttMessage
+from virtual_device import EVENT_SHADOW_GET_TIMEOUT, VirtualDevice
+
+
+def test_deltas_documents_and_stale_messages():
+    gets = []
+    changes = []
+    replica = ShadowReplica(request_get=lambda: gets.append(1), on_change=lambda: changes.append(1))
+
+    replica.apply_document({"state": {"desired": {"status": "off"}, "reported": {"status": "off"}}, "version": 3})
+    assert replica.synced
+
+    assert replica.apply_delta({"state": {"status": "on"}, "version": 4})
+    document = replica.get_document()
+    assert document["version"] == 4
+    assert document["state"]["desired"] == {"status": "on"}
+    assert document["state"]["delta"] == {"status": "on"}
+
+    # The documents of the same update, then a late delta
+    assert replica.apply_documents({"current": {"state": {"desired": {"status": "on"}, "reported": {"status": "on"}}, "version": 4}})
+    assert replica.get_document()["state"]["delta"] == {}
+    assert not replica.apply_delta({"state": {"status": "on"}, "version": 4})
+
+    assert gets == []
+    assert len(changes) == 3
+    assert replica.get_counters()["shadow_stale"] == 1
+
+
+def test_version_gap_reconciles_once():
+    now = [0]
+    gets = []
+    replica = ShadowReplica(request_get=lambda: gets.append(1), clock=lambda: now[0])
+    replica.apply_document({"state": {"desired": {"a": {"b": 1}}}, "version": 1})
+
+    replica.apply_delta({"state": {"a": {"c": 2}}, "version": 3})
+    replica.apply_delta({"state": {"a": {"b": None}}, "version": 5})
+
+    assert gets == [1]
+    assert not replica.synced
+    assert replica.get_document()["state"]["desired"] == {"a": {"c": 2}}
+
+    replica.apply_document({"state": {"desired": {"a": {"c": 2}}}, "version": 5})
+    assert replica.synced
+
+
+def test_diff_state():
+    assert diff_state({"a": 1, "b": {"c": 1, "d": 2}}, {"a": 1, "b": {"c": 1}}) == {"b": {"d": 2}}
+
+
+def test_get_requests_coalesce_and_resolve():
+    now = [0]
+    replica = ShadowReplica(clock=lambda: now[0])
+
+    future, token = replica.request()
+    shared, no_token = replica.request()
+    assert token is not None and no_token is None and shared is future
+
+    # Replies to other clients do not complete the get
+    replica.apply_document({"state": {"reported": {"temp": 20}}, "version": 1})
+    replica.resolve("other-client")
+    assert not future.done()
+
+    replica.resolve(token)
+    assert future.result(0)["state"]["reported"] == {"temp": 20}
+
+    # Recent enough replica: no get
+    now[0] = 3
+    cached, no_token = replica.request(max_age=5)
+    assert no_token is None and cached.result(0)["version"] == 1
+    assert replica.request(max_age=1)[1] is not None
+
+
+def test_get_request_timeout_and_rejection():
+    now = [0]
+    replica = ShadowReplica(clock=lambda: now[0])
+
+    first, _ = replica.request(timeout=5)
+    now[0] = 6
+    second, token = replica.request(timeout=5)
+
+    with pytest.raises(concurrent.futures.TimeoutError):
+        first.result(0)
+
+    replica.reject(token, {"code": 404, "message": "No shadow exists"})
+
+    with pytest.raises(RuntimeError):
+        second.result(0)
+
+
+def test_get_request_expires_without_later_request():
+    now = [0]
+    replica = ShadowReplica(clock=lambda: now[0])
+
+    future, token = replica.request(timeout=5)
+    now[0] = 4
+    assert replica.expire() == 1 and not future.done()
+
+    now[0] = 5
+    assert replica.expire() is None
+
+    with pytest.raises(concurrent.futures.TimeoutError):
+        future.result(0)
+
+    # A late reply completes nothing
+    replica.resolve(token)
+    assert replica.get_counters()["shadow_gets_timeouts"] == 1
+
+
+def test_device_shadow_get_times_out(tmp_path):
+    vd = VirtualDevice("dev1", "ep", str(tmp_path))
+    vd._mqtt_client = mqtt_transport.LocalTransport("dev1")
+    vd._mqtt_client.connect()
+
+    future = vd.get_shadow(timeout=0)
+    assert vd._scheduler.is_scheduled(EVENT_SHADOW_GET_TIMEOUT)
+    vd.expire_shadow_get()
+
+    with pytest.raises(concurrent.futures.TimeoutError):
+        future.result(0)
+
+
+def test_device_shadow_get_resolves_on_the_event_loop(tmp_path):
+    vd = VirtualDevice("dev1", "ep", str(tmp_path))
+    vd._mqtt_client = mqtt_transport.LocalTransport("dev1")
+    vd._mqtt_client.connect()
+    vd.setup_shadow_callbacks(vd.name)
+
+    future = vd.get_shadow()
+    token = json.loads(vd._mqtt_client.published[-1][1])["clientToken"]
+    document = {"state": {"desired": {"status": "on"}}, "version": 3, "clientToken": token}
+    vd.dispatch_message(None, None, MqttMessage("$aws/things/dev1/shadow/get/accepted", json.dumps(document).encode()))
+
+    assert future.result(5)["version"] == 3
+    assert vd._shadow.version == 3
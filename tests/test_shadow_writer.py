@@ -0,0 +1,85 @@
+from shadow_writer import ShadowUpdateWriter
+
+
+def make_writer(now, window=1):
+    updates = []
+    gets = []
+    writer = ShadowUpdateWriter(updates.append, gets.append, window=window, max_retries=1, clock=lambda: now[0])
+
+    return writer, updates, gets
+
+
+def test_updates_coalesce_within_window():
+    now = [0]
+    writer, updates, _ = make_writer(now)
+
+    writer.update({"status": "on"})
+    writer.update({"status": "off", "color": "red"})
+    assert writer.next_flush() == 1
+    assert not writer.flush()
+
+    now[0] = 1
+    assert writer.flush()
+    assert len(updates) == 1
+    assert updates[0]["state"]["desired"] == {"status": "off", "color": "red"}
+    assert "version" not in updates[0]
+    assert writer.coalesced == 1
+
+    # Changes wait for the reply of the update in flight
+    writer.update({"status": "on"})
+    now[0] = 3
+    assert not writer.flush()
+
+    writer.on_accepted({"clientToken": updates[0]["clientToken"], "version": 7})
+    assert writer.next_flush() == 0
+    assert writer.flush()
+    assert updates[1]["version"] == 7
+    assert updates[1]["state"]["desired"] == {"status": "on"}
+
+
+def test_version_conflict_retries_with_fresh_version():
+    now = [0]
+    writer, updates, gets = make_writer(now, window=0)
+    writer.version = 3
+
+    writer.update({"status": "on"})
+    writer.flush()
+    writer.on_rejected({"clientToken": updates[0]["clientToken"], "code": 409, "message": "Version conflict"})
+    assert len(gets) == 1 and writer.next_flush() is not None
+
+    # A press during the retry wins over the conflicting one
+    writer.update({"status": "off"})
+    assert not writer.flush()
+    writer.on_get_reply({"clientToken": gets[0]["clientToken"], "version": 5})
+
+    assert writer.flush()
+    assert updates[1]["version"] == 5
+    assert updates[1]["state"]["desired"] == {"status": "off"}
+
+    # Past max_retries the update is given up
+    writer.on_rejected({"clientToken": updates[1]["clientToken"], "code": 409})
+
+    counters = writer.get_counters()
+    assert counters["shadow_updates_conflicts"] == 2
+    assert counters["shadow_updates_retried"] == 1
+    assert counters["shadow_updates_failed"] == 1
+    assert len(gets) == 1 and writer.next_flush() is None
+
+
+def test_reset_forgets_the_previous_shadow():
+    now = [0]
+    writer, updates, _ = make_writer(now, window=0)
+    writer.version = 3
+
+    writer.update({"status": "on"})
+    writer.flush()
+    writer.update({"status": "off"})
+    writer.reset()
+
+    # Neither the pending change nor the reply awaited for the previous shadow hold the next update
+    assert writer.next_flush() is None
+    writer.update({"color": "red"})
+    assert writer.flush()
+    assert updates[1]["state"]["desired"] == {"color": "red"}
+    assert "version" not in updates[1]
+    assert not writer.on_accepted({"clientToken": updates[0]["clientToken"]})
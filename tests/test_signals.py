@@ -0,0 +1,33 @@
+import pytest
+
+from signals import SignalBank
+
+
+def test_samples_continue_across_refills():
+    bank = SignalBank(block_size=8, seed=1)
+    step = bank.register("step", step=5.0, period=4)
+    sine = bank.register("sine", noise=0)
+
+    # The other device forces refills while the step device is in the middle of its row
+    values = []
+    for _ in range(20):
+        values.append(step.next())
+        sine.next()
+        sine.next()
+
+    assert values == [0.0] * 4 + [5.0] * 4 + [0.0] * 4 + [5.0] * 4 + [0.0] * 4
+
+
+def test_release_reuses_slots_and_grows():
+    bank = SignalBank(block_size=4, seed=1)
+    signals = [bank.register("noise") for _ in range(40)]
+    assert len(bank) == 40
+
+    signals[3].release()
+    assert bank.register("drift", noise=0).slot == signals[3].slot
+    assert [s.next() for s in signals[:3]]
+
+
+def test_unknown_profile():
+    with pytest.raises(ValueError):
+        SignalBank().register("square")
@@ -0,0 +1,14 @@
+import json
+
+from telemetry_batch import encode_batch, decode_batch
+
+
+def test_round_trip():
+    samples = [(1600000000.5, {"temp": 30}), (1600000001.5, {"temp": 31})]
+
+    assert decode_batch(encode_batch(samples)) == samples
+    assert decode_batch(encode_batch(samples).encode("utf8")) == samples
+
+
+def test_decode_single_message():
+    assert decode_batch(json.dumps({"temp": 30})) == [(None, {"temp": 30})]
@@ -0,0 +1,134 @@
+import json
+import threading
+
+import cbor
+import pytest
+
+import mqtt_transport
+from mqtt_transport import MqttMessage
+from topic_dispatch import CODEC_CBOR, CODEC_RAW, TopicRouter, filter_covers, split_filter
+from virtual_device import VirtualDevice
+
+
+def test_routes_and_codecs():
+    router = TopicRouter()
+    router.add("$aws/things/dev1/shadow/get/+", "shadow_get")
+    router.add("$aws/things/dev1/defender/metrics/cbor/+", "defender", CODEC_CBOR)
+    router.add("$aws/things/dev1/jobs/#", "jobs")
+    router.add("cmd/ac/dev1/req", "cmd", CODEC_RAW)
+
+    assert router.match("$aws/things/dev1/shadow/get/accepted").handler == "shadow_get"
+    assert router.match("$aws/things/dev1/jobs/j1/get/accepted").handler == "jobs"
+    assert router.match("$aws/things/dev2/shadow/get/accepted") is None
+    assert router.match("cmd/ac/dev1/req/extra") is None
+
+    # Decoded straight from bytes, apostrophes and all
+    route, message = router.decode(MqttMessage("$aws/things/dev1/shadow/get/accepted", json.dumps({"name": "Charlie's"}).encode()))
+    assert message.payload == {"name": "Charlie's"}
+    assert message.size == 21
+
+    route, message = router.decode(MqttMessage("$aws/things/dev1/defender/metrics/cbor/accepted", cbor.dumps({"status": "ACCEPTED"})))
+    assert message.payload == {"status": "ACCEPTED"}
+
+    assert router.decode(MqttMessage("cmd/ac/dev1/req", b"\x00\x01"))[1].payload == b"\x00\x01"
+
+    with pytest.raises(ValueError):
+        router.decode(MqttMessage("$aws/things/dev1/jobs/get/accepted", b"{'single': 'quotes'}"))
+
+    with pytest.raises(ValueError):
+        split_filter("a/#/b")
+
+
+def test_most_specific_route_wins():
+    router = TopicRouter()
+    router.add("$aws/things/dev1/#", "all")
+    router.add("$aws/things/dev1/jobs/+/get/+", "job_get")
+    router.add("$aws/things/dev1/jobs/get/+", "jobs_get")
+    router.add("#", "anything")
+
+    assert router.match("$aws/things/dev1/jobs/get/accepted").handler == "jobs_get"
+    assert router.match("$aws/things/dev1/jobs/j1/get/accepted").handler == "job_get"
+    assert router.match("$aws/things/dev1/jobs/start-next").handler == "all"
+    assert router.match("$aws/things/dev1").handler == "all"
+    assert router.match("cmd/ac/dev1/req").handler == "anything"
+    # Wildcards at the first level do not match $ topics
+    assert router.match("$aws/things/dev2/shadow/get") is None
+    assert len(router) == 4
+
+    assert filter_covers("$aws/things/dev1/#", "$aws/things/dev1/jobs/+/get/+")
+    assert filter_covers("a/+/c", "a/b/c")
+    assert not filter_covers("$aws/things/dev1/#", "$aws/things/dev2/shadow/get/+")
+    assert not filter_covers("a/+", "a/#")
+
+
+def test_device_dispatch(tmp_path):
+    vd = VirtualDevice("dev1", "ep", str(tmp_path))
+    vd._mqtt_client = mqtt_transport.LocalTransport("dev1")
+    received = []
+
+    def handle_cmd_callback(message):
+        received.append(message.payload)
+
+    vd.subscribe("cmd/ac/dev1/+", handle_cmd_callback)
+    vd._mqtt_client.publish("cmd/ac/dev1/req", json.dumps({"type": "ping"}), 0)
+    vd._mqtt_client.publish("cmd/ac/dev1/req", "not json", 0)
+
+    counts = vd.instruments.snapshot()
+    assert received == [{"type": "ping"}]
+    assert counts["received"] == {"command": 2}
+    assert counts["decode_errors"] == 1
+    assert counts["callback_duration"]["handle_cmd_callback"].count == 1
+
+    # Routes under the subscription of the thing topics need no subscription of their own
+    vd.subscribe_transport("$aws/things/dev1/#")
+    vd.subscribe("$aws/things/dev1/shadow/get/+", handle_cmd_callback)
+    vd.dispatch_message(None, None, MqttMessage("$aws/things/dev1/shadow/get/accepted", b'{"version": 1}'))
+    vd.dispatch_message(None, None, MqttMessage("$aws/things/dev1/shadow/get", b"{}"))
+
+    stats = vd.get_stats()
+    assert received[-1] == {"version": 1}
+    assert stats["subscriptions"] == 2 and stats["routes"] == 2
+    assert vd.instruments.snapshot()["unrouted"] == 1
+
+
+def test_restart_subscribes_again(tmp_path, monkeypatch):
+    monkeypatch.setattr("virtual_device.SETUP_DELAY", 0)
+    vd = VirtualDevice("dev1", "ep", str(tmp_path))
+    vd.transport = mqtt_transport.TRANSPORT_LOCAL
+
+    assert vd.setup()
+    first = vd._mqtt_client
+    assert vd.setup()
+
+    # The new connection has the subscriptions of the first one, once
+    assert vd._mqtt_client is not first
+    assert list(vd._mqtt_client._subscriptions) == list(first._subscriptions)
+    assert "cmd/ac/dev1/req" in vd._mqtt_client._subscriptions
+    assert len(vd._subscriptions) == len(set(vd._subscriptions))
+
+
+def test_handler_errors_are_logged_and_counted(tmp_path, wait_until):
+    vd = VirtualDevice("dev1", "ep", str(tmp_path))
+    vd._mqtt_client = mqtt_transport.LocalTransport("dev1")
+    done = threading.Event()
+
+    def handle_cmd_callback(message):
+        raise KeyError("execution")
+
+    async def handle_jobs_callback(message):
+        try:
+            return message.payload["execution"]
+        finally:
+            done.set()
+
+    vd.subscribe("cmd/ac/dev1/req", handle_cmd_callback)
+    vd.subscribe("$aws/things/dev1/jobs/start-next/+", handle_jobs_callback)
+    vd.dispatch_message(None, None, MqttMessage("cmd/ac/dev1/req", b"{}"))
+    vd.dispatch_message(None, None, MqttMessage("$aws/things/dev1/jobs/start-next/rejected", b'{"code": "InvalidRequest"}'))
+
+    assert done.wait(5)
+    wait_until(lambda: len(vd.instruments.snapshot()["callback_errors"]) == 2)
+
+    assert vd.instruments.snapshot()["callback_errors"] == {"handle_cmd_callback": 1, "handle_jobs_callback": 1}
+    assert any("Handler 'handle_jobs_callback' failed on topic '$aws/things/dev1/jobs/start-next/rejected' 'KeyError: 'execution''"
+               in record.message() for record in vd._log.records())
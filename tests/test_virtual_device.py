@@ -0,0 +1,217 @@
+import json
+
+import pytest
+
+import mqtt_transport
+import prometheus
+import publish_queue
+import telemetry_batch
+import virtual_device
+from admission import AdmissionController
+from scheduler import Scheduler
+from virtual_device import VirtualDevice
+
+
+@pytest.fixture
+def vd(tmp_path):
+    vd = VirtualDevice("dev1", "ep", str(tmp_path))
+    vd._mqtt_client = mqtt_transport.LocalTransport("dev1")
+    vd._mqtt_client.connect()
+
+    return vd
+
+
+def send_telemetry(vd):
+    vd.send_telemetry()
+    vd.drain_publish_queue()
+
+    return vd._mqtt_client.published[-1]
+
+
+def test_telemetry_payload_and_topic_are_cached(vd, monkeypatch):
+    dumps = []
+    json_dumps = json.dumps
+    monkeypatch.setattr(virtual_device.json, "dumps", lambda *args, **kwargs: dumps.append(args) or json_dumps(*args, **kwargs))
+
+    topic, payload, _ = send_telemetry(vd)
+    assert topic == "dt/ac/company1/area1/dev1/temp"
+    assert send_telemetry(vd)[1] is payload
+    assert dumps == []
+
+    # Only the setters invalidate the cache
+    vd.payload = {"temperature": 21}
+    assert len(dumps) == 1
+    assert json.loads(send_telemetry(vd)[1]) == {"temperature": 21}
+
+    vd.mqtt_telemetry_topic = "dt/{}/climate"
+    assert send_telemetry(vd)[0] == "dt/dev1/climate"
+
+    # The unit is not part of the payload, changing it keeps the cached bytes
+    vd.change_unit({"unit": "imperial"})
+    assert send_telemetry(vd)[1] is vd._payload_bytes
+    assert len(dumps) == 1
+
+
+def test_telemetry_through_basic_ingest(vd):
+    vd._mqtt_client = mqtt_transport.LocalTransport("dev1", basic_ingest_rules=["telemetry_rule"])
+    vd._mqtt_client.connect()
+
+    vd.set_basic_ingest_rule("telemetry_rule")
+    topic, payload, _ = send_telemetry(vd)
+
+    assert topic == "$aws/rules/telemetry_rule/dt/ac/company1/area1/dev1/temp"
+    assert vd._mqtt_client.ingested["telemetry_rule"] == [("dt/ac/company1/area1/dev1/temp", payload)]
+
+    with pytest.raises(ValueError):
+        vd.set_basic_ingest_rule("telemetry-rule")
+
+    # Back to the message broker
+    vd.set_basic_ingest_rule(None)
+    assert send_telemetry(vd)[0] == "dt/ac/company1/area1/dev1/temp"
+
+
+def test_signal_is_off_by_default(tmp_path):
+    vd = VirtualDevice("dev2", "ep", str(tmp_path))
+    assert vd.sample_payload() is vd.payload
+
+    vd.set_signal("step")
+    assert vd.sample_payload() is not vd.payload
+    vd.set_signal("off")
+
+
+def test_publishes_wait_in_the_queue_while_disconnected(vd):
+    vd.set_publish_queue(3, publish_queue.POLICY_PRIORITY, 0)
+    vd._mqtt_client.disconnect()
+
+    for i in range(3):
+        vd.add_pending_payload("dt/dev1/temp", str(i), publish_queue.PRIORITY_TELEMETRY)
+
+    vd.add_pending_payload("cmd/dev1/tamper", "tamper", publish_queue.PRIORITY_CRITICAL)
+
+    # Nothing reaches the transport, and the queue policy drops telemetry first
+    vd.send_pending_payload()
+    assert vd._mqtt_client.published == []
+    assert vd.get_stats()["queue_dropped"] == 1
+    assert vd._scheduler.is_scheduled(virtual_device.EVENT_PENDING_PAYLOAD)
+
+    vd._mqtt_client.connect()
+
+    for _ in range(3):
+        vd.send_pending_payload()
+
+    assert [payload for _, payload, _ in vd._mqtt_client.published] == ["tamper", "1", "2"]
+
+
+def test_automatic_reconnections_follow_the_policy(tmp_path, monkeypatch):
+    monkeypatch.setattr(virtual_device, "SETUP_DELAY", 0)
+    vd = VirtualDevice("dev1", "ep", str(tmp_path))
+    vd.transport = mqtt_transport.TRANSPORT_LOCAL
+    vd._reconnect_policy._rand = lambda: 1.0
+
+    assert vd.setup()
+    vd._mqtt_client.lose_connection()
+    vd.add_pending_payload("dt/dev1/temp", "{}")
+    vd._mqtt_client.reconnect()
+
+    assert vd._mqtt_client.reconnect_delays == [1]
+    assert vd._scheduler.is_scheduled(virtual_device.EVENT_PENDING_PAYLOAD)
+    counters = vd._reconnect_policy.get_counters()
+    assert counters["connect_attempts"] == 2 and counters["connections"] == 2 and counters["connect_failures"] == 0
+
+    # An interrupt left by stop() does not cut the waits of the next run short
+    vd.stop()
+    vd._stop = False
+    assert vd.setup()
+    assert vd._reconnect_policy.wait(0.01)
+
+
+def test_automatic_reconnections_go_through_admission(tmp_path, monkeypatch):
+    monkeypatch.setattr(virtual_device, "SETUP_DELAY", 0)
+    now = [0.0]
+    vd = VirtualDevice("dev1", "ep", str(tmp_path))
+    vd.transport = mqtt_transport.TRANSPORT_LOCAL
+    vd.admission = AdmissionController(rate=10, burst=1, clock=lambda: now[0])
+    vd._reconnect_policy._rand = lambda: 0.0
+
+    assert vd.setup()
+    vd._mqtt_client.lose_connection()
+    assert vd.admission.get_stats()["connecting"] == 1
+
+    # The connection took the only token, the reconnection waits for the next one
+    vd._mqtt_client.reconnect()
+    assert vd._mqtt_client.reconnect_delays == [0.1]
+
+    stats = vd.admission.get_stats()
+    assert stats["admitted"] == 2 and stats["connected"] == 2 and stats["connecting"] == 0
+
+
+def test_connected_gauge_follows_the_connection(vd):
+    def connected_gauge():
+        exposition = prometheus.Exposition()
+        prometheus.collect_device(exposition, vd, "generic")
+
+        return [line for line in exposition.render().splitlines() if line.startswith("virtual_device_connected{")]
+
+    assert connected_gauge() == ['virtual_device_connected{device="dev1",type="generic"} 1']
+
+    vd._mqtt_client.lose_connection()
+    assert connected_gauge() == ['virtual_device_connected{device="dev1",type="generic"} 0']
+
+
+def telemetry_batches(vd):
+    vd.drain_publish_queue()
+
+    return [telemetry_batch.decode_batch(payload) for topic, payload, _ in vd._mqtt_client.published
+            if topic == "dt/ac/company1/area1/dev1/temp"]
+
+
+def run_due_events(vd):
+    for event in vd._scheduler.wait(0):
+        vd._event_handlers[event]()
+
+
+def test_telemetry_batches_by_size_window_and_reconfiguration(vd):
+    now = [0.0]
+    vd._scheduler = Scheduler(clock=lambda: now[0])
+
+    # A batch goes out at batch_size samples
+    vd.set_batching(3, 0)
+    vd.send_telemetry()
+    vd.send_telemetry()
+    assert telemetry_batches(vd) == []
+
+    vd.send_telemetry()
+    batches = telemetry_batches(vd)
+    assert len(batches) == 1 and [payload for _, payload in batches[0]] == [vd.payload] * 3
+
+    # Or batch_window seconds after its first sample
+    vd.set_batching(0, 5)
+    run_due_events(vd)
+    vd.send_telemetry()
+    vd.send_telemetry()
+    now[0] = 4.9
+    run_due_events(vd)
+    assert len(telemetry_batches(vd)) == 1
+
+    now[0] = 5
+    run_due_events(vd)
+    assert [len(batch) for batch in telemetry_batches(vd)] == [3, 2]
+
+    # Changing the settings sends what was collected under the previous ones
+    vd.send_telemetry()
+    vd.set_batching(0, 0)
+    run_due_events(vd)
+    assert [len(batch) for batch in telemetry_batches(vd)] == [3, 2, 1]
+
+
+def test_telemetry_batch_is_flushed_on_stop(vd, monkeypatch):
+    monkeypatch.setattr(VirtualDevice, "publish_external_ip", lambda self: None)
+    vd.set_batching(100, 0)
+    run_due_events(vd)
+    vd.send_telemetry()
+
+    vd.stop()
+    vd.start()
+
+    # The sample taken before the stop and the one of the last loop iteration
+    assert [len(batch) for batch in telemetry_batches(vd)] == [2]
@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+
+
+# Connections per second and burst allowed for all the devices of a host (or fleet, split across shards).
+# AWS IoT allows 500 CONNECT per second per account by default.
+DEFAULT_CONNECT_RATE = float(os.getenv("CONNECT_RATE", "50"))
+DEFAULT_CONNECT_BURST = int(os.getenv("CONNECT_BURST", "10"))
+
+
+class AdmissionController(object):
+    """AdmissionController
+
+    Token bucket shared by the devices of a host, so they don't all connect in the same second.
+    A device calls :meth:`reserve` before each connection attempt, first connections and automatic
+    reconnections alike, and waits the returned delay: a token is a CONNECT, the requests a device
+    makes once connected are not counted, they follow its connection.
+    Reservations can drive the bucket below zero, which queues devices in arrival order without
+    holding a lock while they wait. A burst of 0 admits every device after 1 / rate seconds, e.g.
+    for the shards of a fleet whose burst is smaller than its number of shards.
+
+    Also measures the time to fully connected: from the first device expected to connect until
+    every expected device is connected.
+    """
+
+    def __init__(self, rate=DEFAULT_CONNECT_RATE, burst=DEFAULT_CONNECT_BURST, clock=time.monotonic):
+        if rate <= 0 or burst < 0:
+            raise ValueError("Invalid admission rate '{}' / burst '{}'".format(rate, burst))
+
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = clock()
+        self.admitted = 0
+        self.connected = 0
+        self._pending = set()
+        self._wave_start = None
+        self.time_to_fully_connected = None
+
+    def reserve(self, cost=1):
+        """Take `cost` tokens, returns the number of seconds to wait before using them."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= cost
+            self.admitted += 1
+
+            return max(0.0, -self._tokens / self.rate)
+
+    def expect(self, name):
+        """`name` is about to connect, and counts toward the time to fully connected."""
+        with self._lock:
+            if not self._pending:
+                # New wave (startup, or devices added later), measured from now
+                self._wave_start = self._clock()
+
+            self._pending.add(name)
+
+    def forget(self, name):
+        """`name` stopped before connecting."""
+        with self._lock:
+            self._pending.discard(name)
+
+    def on_connected(self, name):
+        with self._lock:
+            self.connected += 1
+
+            if name in self._pending:
+                self._pending.discard(name)
+
+                if not self._pending:
+                    self.time_to_fully_connected = self._clock() - self._wave_start
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "connect_rate": self.rate,
+                "connect_burst": self.burst,
+                "admitted": self.admitted,
+                "connected": self.connected,
+                "connecting": len(self._pending),
+                "time_to_fully_connected": None if self.time_to_fully_connected is None else round(self.time_to_fully_connected, 3)
+            }
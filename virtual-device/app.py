@@ -1,5 +1,5 @@
 # home.py
-from flask import Flask, render_template, request, url_for, redirect, flash, current_app
+from flask import Flask, Response, abort, render_template, request, url_for, redirect, flash, current_app
 import os
 import sys
 import json
@@ -9,14 +9,21 @@ import json
 import time
 import random
 import string
-from virtual_device import VirtualDevice, VirtualSwitch, VirtualBulb, RogueDevice
-
-# Not a good practice =\
-global vd
+from device_host import DeviceHost
+from virtual_device import LOG_PAGE_SIZE
+import prometheus
+import profiler
 
 PORT = int(os.getenv("PORT", "80"))
+# The shadow page shows the replica of the device when it is this recent, and waits this long for a get otherwise
+SHADOW_MAX_AGE = 10
+SHADOW_TIMEOUT = 5
+# Seconds between two reads of the log by a live tail, and between two keep-alives of an idle one
+LOG_STREAM_POLL = 0.5
+LOG_STREAM_HEARTBEAT = 15
 
-mqtt_thread = threading.Thread()
+# Every virtual device served by this process, see DeviceHost
+host = DeviceHost()
 
 def create_app(cfg_file):
     app = Flask(__name__)
@@ -25,36 +32,39 @@ def create_app(cfg_file):
 
 
     def interrupt():
-        current_app.logger.info(">interrupt")
-
-        global mqtt_thread
-        global vd
+        print(">interrupt")
 
-        print(">Stopping virtual device...")
-        vd.stop()
-
-        mqtt_thread.join()
+        print(">Stopping virtual devices...")
+        host.stop_all()
 
         print("<interrupt")
 
         return
 
 
+    # Requests select a device with ?device=<name> (or a "device" form field), defaulting to the first one
+    def get_device():
+        try:
+            return host.get_device(request.values.get("device"))
+        except KeyError as e:
+            abort(404, e.args[0])
+
+
     @app.route("/")
     def home():
-        global vd
+        vd = get_device()
         name = vd.name
         return render_template("index.html", message="This is IoT Device Playground", name=name, img_file="bulb-off.png", type="bulb_off")
 
     @app.route("/press_on")
     def press_on():
-        global vd
+        vd = get_device()
         vd.press_on()
         return render_template("index.html", message="This is IoT Device Playground", img_file="bulb-off.png", type="bulb_off")
 
     @app.route("/press_off")
     def press_off():
-        global vd
+        vd = get_device()
         vd.press_off()
         return render_template("index.html", message="This is IoT Device Playground", img_file="switch.png", type="switch")
 
@@ -62,7 +72,7 @@ def create_app(cfg_file):
     def cert():
         data = ""
 
-        with open('/tmp/cert', 'r') as file:
+        with open(get_device().file_path('cert'), 'r') as file:
             data = file.read()  #.replace('\n', '')
 
         return render_template("cert.html", message=data)
@@ -71,7 +81,7 @@ def create_app(cfg_file):
     def key():
         data = ""
 
-        with open('/tmp/key', 'r') as file:
+        with open(get_device().file_path('key'), 'r') as file:
             data = file.read()  #.replace('\n', '')
 
         return data
@@ -81,7 +91,7 @@ def create_app(cfg_file):
     def endpoint():
         data = ""
 
-        with open('/tmp/iot_endpoint', 'r') as file:
+        with open(get_device().file_path('iot_endpoint'), 'r') as file:
             data = file.read()  #.replace('\n', '')
 
         return render_template("endpoint.html", message=data)
@@ -91,24 +101,23 @@ def create_app(cfg_file):
     def name():
         data = ""
 
-        with open('/tmp/device_name', 'r') as file:
+        with open(get_device().file_path('device_name'), 'r') as file:
             data = file.read()  #.replace('\n', '')
 
         return data
 
 
+    # ?max_age=<seconds> accepts the shadow replica of the device if it was updated within max_age seconds
     @app.route("/shadow")
     def shadow():
-        global vd
-
-        data = ""
-        data = json.dumps(vd.get_shadow(vd.name))
-        print(data)
+        vd = get_device()
+        max_age = request.args.get('max_age', SHADOW_MAX_AGE, type=float)
 
-        #time.sleep(2)
-
-        #with open('/tmp/shadow', 'r') as file:
-        #    data = file.read()#.replace('\n', '')
+        try:
+            data = json.dumps(vd.get_shadow(vd.name, max_age).result(SHADOW_TIMEOUT))
+        except Exception as e:
+            print(e)
+            data = "No shadow from the broker ({}), last known shadow: {}".format(str(e) or "timeout", json.dumps(vd.shadow))
 
         return render_template("endpoint.html", message=data)
 
@@ -116,14 +125,14 @@ def create_app(cfg_file):
     @app.route("/config", methods=['GET', 'POST'])
     def config():
         data = ""
-        global vd
+        vd = get_device()
 
         if (request.args.get('time') or (request.form.get('fsampling') != '' and request.form.get('fsampling') is not None)):
             time = request.args.get('time') or request.form.get('fsampling')
             print("Changing time to '{}'...".format(time))
 
             try:
-                vd.set_sampling_delay(int(time))
+                vd.set_sampling_delay(float(time))
                 data = str(time)
             except Exception as e:
                 print(e)
@@ -134,12 +143,114 @@ def create_app(cfg_file):
             print("Changing Device Metrics topic to '{}'...".format(device_metrics_time))
 
             try:
-                vd.set_device_metrics_sampling_delay(int(device_metrics_time))
+                vd.set_device_metrics_sampling_delay(float(device_metrics_time))
                 data = str(device_metrics_time)
             except Exception as e:
                 print(e)
                 data = e        
 
+        if (request.args.get('batch_size') or request.args.get('batch_window')
+                or (request.form.get('fbatch_size') != '' and request.form.get('fbatch_size') is not None)
+                or (request.form.get('fbatch_window') != '' and request.form.get('fbatch_window') is not None)):
+            batch_size = request.args.get('batch_size') or request.form.get('fbatch_size') or 0
+            batch_window = request.args.get('batch_window') or request.form.get('fbatch_window') or 0
+            print("Changing telemetry batching to '{}' samples / '{}' seconds...".format(batch_size, batch_window))
+
+            try:
+                vd.set_batching(int(batch_size), float(batch_window))
+                data = "batch size {} / window {}".format(batch_size, batch_window)
+            except Exception as e:
+                print(e)
+                data = e
+
+        if (request.args.get('queue_size') or request.args.get('queue_policy') or request.args.get('drain_rate')
+                or (request.form.get('fqueue_size') != '' and request.form.get('fqueue_size') is not None)
+                or (request.form.get('fqueue_policy') != '' and request.form.get('fqueue_policy') is not None)
+                or (request.form.get('fdrain_rate') != '' and request.form.get('fdrain_rate') is not None)):
+            counters = vd.get_stats()
+            queue_size = request.args.get('queue_size') or request.form.get('fqueue_size') or counters["queue_size"]
+            queue_policy = request.args.get('queue_policy') or request.form.get('fqueue_policy') or counters["queue_policy"]
+            drain_rate = request.args.get('drain_rate') or request.form.get('fdrain_rate') or vd.drain_rate
+            print("Changing publish queue to '{}' messages / '{}' / '{}' messages per second...".format(queue_size, queue_policy, drain_rate))
+
+            try:
+                vd.set_publish_queue(int(queue_size), queue_policy, float(drain_rate))
+                data = "queue size {} / policy {} / drain rate {}".format(queue_size, queue_policy, drain_rate)
+            except Exception as e:
+                print(e)
+                data = e
+
+        if (request.args.get('qos') or (request.form.get('fqos') != '' and request.form.get('fqos') is not None)):
+            qos = request.args.get('qos') or request.form.get('fqos')
+            print("Changing QoS to '{}'...".format(qos))
+
+            try:
+                # <topic class>:<qos>[,<topic class>:<qos>...], ex: telemetry:1,shadow:1
+                for setting in qos.split(","):
+                    topic_class, level = setting.split(":")
+                    vd.set_qos(topic_class.strip(), int(level))
+
+                data = qos
+            except Exception as e:
+                print(e)
+                data = e
+
+        if (request.args.get('inflight') or (request.form.get('finflight') != '' and request.form.get('finflight') is not None)):
+            inflight = request.args.get('inflight') or request.form.get('finflight')
+            print("Changing in-flight window to '{}'...".format(inflight))
+
+            try:
+                vd.set_inflight_window(int(inflight))
+                data = inflight
+            except Exception as e:
+                print(e)
+                data = e
+
+        if (request.args.get('journal') or (request.form.get('fjournal') != '' and request.form.get('fjournal') is not None)):
+            journal = request.args.get('journal') or request.form.get('fjournal')
+            replay_rate = request.args.get('replay_rate') or request.form.get('freplay_rate')
+            print("Changing journal to '{}' / replay rate '{}'...".format(journal, replay_rate))
+
+            try:
+                vd.set_journal(journal.lower() == "on", float(replay_rate) if replay_rate else None)
+                data = journal
+            except Exception as e:
+                print(e)
+                data = e
+
+        if (request.args.get('shadow_file') or (request.form.get('fshadow_file') != '' and request.form.get('fshadow_file') is not None)):
+            shadow_file = request.args.get('shadow_file') or request.form.get('fshadow_file')
+            print("Changing shadow file to '{}'...".format(shadow_file))
+
+            try:
+                vd.set_shadow_file(shadow_file.lower() == "on")
+                data = shadow_file
+            except Exception as e:
+                print(e)
+                data = e
+
+        if (request.args.get('shadow_window') or (request.form.get('fshadow_window') != '' and request.form.get('fshadow_window') is not None)):
+            shadow_window = request.args.get('shadow_window') or request.form.get('fshadow_window')
+            print("Changing shadow update window to '{}'...".format(shadow_window))
+
+            try:
+                vd.set_shadow_update_window(float(shadow_window))
+                data = shadow_window
+            except Exception as e:
+                print(e)
+                data = e
+
+        if (request.args.get('ddm_format') or (request.form.get('ddm_format') != '' and request.form.get('ddm_format') is not None)):
+            device_metrics_format = request.args.get('ddm_format') or request.form.get('ddm_format')
+            print("Changing Device Metrics format to '{}'...".format(device_metrics_format))
+
+            try:
+                vd.set_device_metrics_format(device_metrics_format.lower())
+                data = device_metrics_format
+            except Exception as e:
+                print(e)
+                data = e
+
         if (request.args.get('topic') or (request.form.get('ftopic') != '' and request.form.get('ftopic') is not None)):
             topic = request.args.get('topic') or request.form.get('ftopic')
             print("Changing topic to '{}'...".format(topic))
@@ -151,6 +262,39 @@ def create_app(cfg_file):
                 print(e)
                 data = e
         
+        if (request.args.get('ingest_rule') or (request.form.get('fingest_rule') != '' and request.form.get('fingest_rule') is not None)):
+            rule = request.args.get('ingest_rule') or request.form.get('fingest_rule')
+            print("Changing Basic Ingest rule to '{}'...".format(rule))
+
+            try:
+                vd.set_basic_ingest_rule(None if rule.lower() == "off" else rule)
+                data = rule
+            except Exception as e:
+                print(e)
+                data = e
+
+        if (request.args.get('signal') or (request.form.get('fsignal') != '' and request.form.get('fsignal') is not None)):
+            signal = request.args.get('signal') or request.form.get('fsignal')
+            print("Changing signal to '{}'...".format(signal))
+
+            try:
+                vd.set_signal(signal.lower())
+                data = signal
+            except Exception as e:
+                print(e)
+                data = e
+
+        if (request.args.get('log_level') or (request.form.get('flog_level') != '' and request.form.get('flog_level') is not None)):
+            log_level = request.args.get('log_level') or request.form.get('flog_level')
+            print("Changing log level to '{}'...".format(log_level))
+
+            try:
+                vd.set_log_level(log_level)
+                data = log_level
+            except Exception as e:
+                print(e)
+                data = e
+
         if (request.args.get('payload') or (request.form.get('fpayload') != '' and request.form.get('fpayload') is not None)):
             payload = request.args.get("payload") or request.form.get('fpayload')
             try:
@@ -163,15 +307,77 @@ def create_app(cfg_file):
         return render_template("config.html", message=data)
 
 
+    # Integer query parameter (or header) of the log pages, 400 if it is not one
+    def get_log_arg(name, value, default=None, minimum=0):
+        if value is None or value == '':
+            return default
+
+        try:
+            number = int(value)
+        except ValueError:
+            abort(400, "'{}' must be an integer, not '{}'".format(name, value))
+
+        if number < minimum:
+            abort(400, "'{}' must be at least {}".format(name, minimum))
+
+        return number
+
+
+    # Pages of the device log: ?since=<sequence number>&limit=<records>, the last records by default
     @app.route("/log")
     def log():
-        global vd
+        vd = get_device()
+        since = get_log_arg('since', request.args.get('since'))
+        limit = get_log_arg('limit', request.args.get('limit'), LOG_PAGE_SIZE, 1)
+
+        records, cursor = vd.get_log_records(since, limit)
+        first = records[0][0] if records else cursor
+
+        return render_template("log.html", records=records, name=vd.name, limit=limit, cursor=cursor,
+                               older=max(0, first - limit) if first > 0 else None)
+
+
+    # Live tail of the device log as Server-Sent Events, resuming after the Last-Event-ID sent by the browser
+    @app.route("/log/stream")
+    def log_stream():
+        vd = get_device()
+        last_event_id = get_log_arg('Last-Event-ID', request.headers.get("Last-Event-ID"))
+        since = last_event_id + 1 if last_event_id is not None else get_log_arg('since', request.args.get('since'))
+
+        def events(cursor):
+            if cursor is None:
+                _, cursor = vd.get_log_records(None, 0)
+
+            idle = 0
+
+            while True:
+                records, cursor = vd.get_log_records(cursor, LOG_PAGE_SIZE)
+
+                for seq, line in records:
+                    # Multi-line records span several data fields
+                    yield "id: {}\n{}\n\n".format(seq, "\n".join("data: " + part for part in line.split("\n")))
+
+                if len(records) == LOG_PAGE_SIZE:
+                    continue
+
+                idle = 0 if records else idle + LOG_STREAM_POLL
+
+                if idle >= LOG_STREAM_HEARTBEAT:
+                    # Comment line, fails as soon as the browser is gone
+                    yield ": keep-alive\n\n"
+                    idle = 0
 
-        log_list = vd.get_log_list()
+                time.sleep(LOG_STREAM_POLL)
 
-        return render_template("log.html", log_list=log_list)
+        return Response(events(since), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
     
 
+    # Counters of every hosted device, for Prometheus to scrape
+    @app.route("/metrics")
+    def metrics():
+        return Response(prometheus.render(host), mimetype=prometheus.CONTENT_TYPE)
+
+
     @app.route("/help")
     def help():
         return render_template("help.html")
@@ -179,7 +385,7 @@ def create_app(cfg_file):
 
     @app.route("/actions", methods=['GET', 'POST'])
     def actions():
-        global vd
+        vd = get_device()
 
         if request.method == 'POST':
             current_app.logger.info(" actions - POST")
@@ -230,68 +436,61 @@ def create_app(cfg_file):
         else:    
             flash("All the form fields are required.")
         
-        return redirect(url_for("home"))
+        return redirect(url_for("home", device=vd.name))
         # return render_template("index.html", message="This is IoT Device Playground", img_file="bulb-off.png", type="bulb_off")
 
     
-    ######## HELPER FUNCTIONS #################
-
-
-    def get_client_id(cfg_file):
-        return cfg_file["device_name"]
-
-
-    def get_endpoint(cfg_file):
-        return cfg_file["iot_endpoint"]
-
+    # Profiles the whole process: ?seconds=<N>&mode=<sample|cprofile>, sample mode also takes &interval=<seconds>&threads=on
+    @app.route("/profile")
+    def profile():
+        try:
+            seconds = float(request.args.get('seconds') or profiler.DEFAULT_DURATION)
+            mode = request.args.get('mode') or profiler.MODE_SAMPLE
+            current_app.logger.info("Profiling for {} seconds, mode '{}'...".format(seconds, mode))
 
-    def get_device_type(cfg_file):
-        return cfg_file.get("device-type", "generic")
+            if mode == profiler.MODE_CPROFILE:
+                devices = [host.get_device(name) for name in host.names()]
+                data = profiler.profile_devices(devices, seconds)
 
+                return Response(data, mimetype="application/octet-stream",
+                                headers={"Content-Disposition": "attachment; filename=virtual-device.prof"})
+            elif mode == profiler.MODE_SAMPLE:
+                interval = float(request.args.get('interval') or profiler.DEFAULT_INTERVAL)
+                stacks = profiler.sample_stacks(seconds, interval, request.args.get('threads') == "on")
 
-    def run_virtual_device(cfg_file_json):
-        global vd
+                return Response(profiler.collapse(stacks), mimetype="text/plain")
 
-        cfg_file = json.loads(cfg_file_json)
+            raise ValueError("Unknown profile mode '{}'".format(mode))
+        except Exception as e:
+            current_app.logger.warning("Profile failed: {}".format(e))
 
-        client_id = get_client_id(cfg_file)
-        endpoint = get_endpoint(cfg_file)
-        dev_type = get_device_type(cfg_file)
+            return Response(str(e), status=400, mimetype="text/plain")
 
-        if dev_type == "generic":
-            vd = VirtualDevice(client_id, endpoint)
-        elif dev_type == "bulb":
-            vd = VirtualBulb(client_id, endpoint)
-        elif dev_type == "switch":
-            vd = VirtualSwitch(client_id, endpoint)
-        elif dev_type == "rogue":
-            vd = RogueDevice(client_id, endpoint)
-        else:
-            print("unknown device type...")
 
-        lwt = {
-            "msg": "Ouch Charlie...that really hurt",
-            "device": client_id
-        }
-
-        vd.register_last_will_and_testament("cmd/{}/lwt".format(client_id), json.dumps(lwt))
-
-        vd.prepare_files(cfg_file_json)
-        vd.setup()
-        vd.start()
+    @app.route("/devices", methods=['GET', 'POST'])
+    def devices():
+        if request.method == 'POST':
+            action = request.form['action']
+            name = request.form['device']
 
-        return
+            try:
+                if action == "start":
+                    host.start_device(name)
+                    flash("Device '{}' started".format(name))
+                elif action == "stop":
+                    host.stop_device(name)
+                    flash("Device '{}' stopped".format(name))
+                else:
+                    flash("Invalid action.")
+            except KeyError:
+                flash("Unknown device '{}'".format(name))
 
-    def start_virtual_device(cfg_file):
-        # Do initialisation stuff here
-        global mqtt_thread
+        return render_template("devices.html", devices=host.get_stats(), admission=host.admission.get_stats())
 
-        # Create your thread
-        mqtt_thread = threading.Thread(target=run_virtual_device, args=(json.dumps(cfg_file),))
-        mqtt_thread.start()
 
     # Initiate
-    start_virtual_device(cfg_file)
+    host.load(cfg_file)
+    host.start_all()
 
     # When you kill Flask (SIGTERM), clear the trigger for the next thread
     atexit.register(interrupt)
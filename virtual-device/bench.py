@@ -0,0 +1,187 @@
+# bench.py - micro benchmarks for the hot paths of a virtual device
+#
+#   python bench.py [name ...]
+#
+# Runs every benchmark when no name is given.
+import json
+import math
+import random
+import sys
+import timeit
+
+import cbor
+
+import metrics
+import signals
+import topic_dispatch
+from mqtt_transport import MqttMessage, topic_matches
+from virtual_device import THING_TOPICS
+
+
+def sample_metrics(short_names=False, last_metric=None):
+    """A Device Defender report with a realistic amount of ports and connections, without sampling the host."""
+    report = metrics.Metrics(short_names=short_names, last_metric=last_metric)
+    report.add_listening_ports("TCP", [{"port": port, "interface": "eth0"} for port in (22, 80, 443, 8080)])
+    report.add_listening_ports("UDP", [{"port": port, "interface": "eth0"} for port in (53, 123)])
+    report.add_network_stats(123456789, 98765, 23456789, 87654)
+
+    for i in range(20):
+        report.add_network_connection("10.0.{}.{}".format(i // 250, i % 250 + 1), 443, "eth0", 40000 + i)
+
+    return report
+
+
+def bench_device_defender_encoding(number=2000):
+    """Size and encoding time of a Device Defender report, JSON vs CBOR, long vs short tags."""
+    baseline = sample_metrics()
+
+    for name, short_names, encode in (("json", False, "to_json_string"),
+                                      ("json short", True, "to_json_string"),
+                                      ("cbor", False, "to_cbor"),
+                                      ("cbor short", True, "to_cbor")):
+        report = sample_metrics(short_names, last_metric=baseline)
+        encoder = getattr(report, encode)
+        size = len(encoder())
+        elapsed = timeit.timeit(encoder, number=number)
+        print("metrics {:<12} {:>6} bytes {:>8.1f} us/report".format(name, size, elapsed / number * 1e6))
+
+
+def bench_signals(devices=10000, rounds=20):
+    """Cost of a telemetry sample for a fleet sampled round robin: signal bank vs per-device Python math."""
+    profiles = sorted(signals.PROFILES)
+    bank = signals.SignalBank()
+    fleet = [bank.register(profiles[i % len(profiles)]) for i in range(devices)]
+    params = [dict(signals.PROFILES[profiles[i % len(profiles)]]) for i in range(devices)]
+    counters = [0] * devices
+    samples = devices * rounds
+
+    def from_bank():
+        for signal in fleet:
+            signal.next()
+
+    def python_math():
+        for i in range(devices):
+            p = params[i]
+            t = counters[i] = counters[i] + 1
+            period = p.get("period", 1)
+            (p.get("amplitude", 0) * math.sin(2 * math.pi * t / period) + p.get("drift", 0) * t
+             + p.get("step", 0) * ((t // period) % 2) + random.gauss(0, p.get("noise", 0))
+             + (p.get("anomaly", 0) if random.random() < p.get("anomaly_rate", 0) else 0))
+
+    for name, generate in (("bank", from_bank), ("python math", python_math)):
+        elapsed = timeit.timeit(generate, number=rounds)
+        print("signals {:<12} {:>8.2f} us/sample ({} devices)".format(name, elapsed / samples * 1e6, devices))
+
+
+def sample_shadow_document(keys=20):
+    """A get/accepted shadow document with `keys` desired and reported keys."""
+    state = dict(("key{}".format(i), {"value": i, "unit": "celsius", "label": "Sensor {} value".format(i)}) for i in range(keys))
+
+    return {"state": {"desired": state, "reported": state}, "metadata": {}, "version": 42, "timestamp": 1700000000,
+            "clientToken": "0123456789abcdef0123456789abcdef"}
+
+
+def bench_decode(number=20000):
+    """Decode and dispatch cost of a received message: the former str round trip (which breaks on apostrophes) vs bytes, JSON vs CBOR."""
+    document = sample_shadow_document()
+    topic = "$aws/things/dev1/shadow/get/accepted"
+    json_message = MqttMessage(topic, json.dumps(document).encode("utf8"))
+    cbor_message = MqttMessage("$aws/things/dev1/shadow/get/cbor", cbor.dumps(document))
+
+    router = topic_dispatch.TopicRouter()
+    router.add("$aws/things/dev1/shadow/get/+", None)
+    router.add("$aws/things/dev1/shadow/get/cbor", None, topic_dispatch.CODEC_CBOR)
+
+    for i in range(7):
+        router.add("$aws/things/dev1/jobs/{}/+".format(i), None)
+
+    def str_round_trip():
+        json.loads(json_message.payload.decode("utf8").replace("'", '"'))
+
+    for name, decode, message in (("str+replace", str_round_trip, json_message),
+                                  ("json bytes", lambda: json.loads(json_message.payload), json_message),
+                                  ("json router", lambda: router.decode(json_message), json_message),
+                                  ("cbor router", lambda: router.decode(cbor_message), cbor_message)):
+        # Best of a few rounds, a single message takes tens of microseconds
+        elapsed = min(timeit.repeat(decode, number=number, repeat=5))
+        print("decode {:<12} {:>6} bytes {:>8.1f} us/message".format(name, len(message.payload), elapsed / number * 1e6))
+
+
+def bench_routing(devices=10000, number=20000):
+    """Routing cost of the received messages of a host of `devices`: per-filter subscriptions vs topic routers."""
+    names = ["dev-{:05d}".format(i) for i in range(devices)]
+    # The filters routed by a device, see VirtualDevice.setup()
+    keys = [key for key in THING_TOPICS if key.endswith("_replies") or key in ("jobs_notify_next", "shadow_update_documents",
+                                                                                "shadow_update_delta")]
+    filters = dict((name, [THING_TOPICS[key].format(name) for key in keys] + ["cmd/ac/{}/req".format(name)]) for name in names)
+    suffixes = ("shadow/get/accepted", "shadow/update/delta", "jobs/notify-next", "jobs/job-1/get/accepted",
+                "defender/metrics/json/accepted", "shadow/update")
+    rng = random.Random(1)
+    messages = []
+
+    for _ in range(number):
+        name = rng.choice(names)
+        messages.append((name, "$aws/things/{}/{}".format(name, rng.choice(suffixes))))
+
+    start = timeit.default_timer()
+    routers = {}
+
+    for name in names:
+        router = routers[name] = topic_dispatch.TopicRouter()
+
+        for topic_filter in filters[name]:
+            router.add(topic_filter, None)
+
+    build = timeit.default_timer() - start
+    host_router = topic_dispatch.TopicRouter()
+
+    for name in names:
+        for topic_filter in filters[name]:
+            host_router.add(topic_filter, name)
+
+    all_filters = [topic_filter for name in names for topic_filter in filters[name]]
+
+    def per_filter():
+        # Every subscription of the connection is tried, as the transports do
+        for name, topic in messages:
+            for topic_filter in filters[name]:
+                topic_matches(topic_filter, topic)
+
+    def device_router():
+        for name, topic in messages:
+            routers[name].match(topic)
+
+    def host_trie():
+        for _, topic in messages:
+            host_router.match(topic)
+
+    def host_scan():
+        # A single list of every filter of the host, a few messages only
+        for _, topic in messages[:20]:
+            for topic_filter in all_filters:
+                if topic_matches(topic_filter, topic):
+                    break
+
+    # Per-filter subscriptions vs $aws/things/<name>/# and the command topic
+    print("routing {} devices, {} subscriptions per filter, {} with the thing wildcard, routers built in {:.2f} s".format(
+        devices, len(all_filters), devices * 2, build))
+
+    for name, route, count in (("per-filter", per_filter, number),
+                               ("device trie", device_router, number),
+                               ("host trie", host_trie, number),
+                               ("host scan", host_scan, 20)):
+        elapsed = timeit.timeit(route, number=1)
+        print("routing {:<12} {:>10.2f} us/message".format(name, elapsed / count * 1e6))
+
+
+BENCHMARKS = {
+    "decode": bench_decode,
+    "metrics": bench_device_defender_encoding,
+    "routing": bench_routing,
+    "signals": bench_signals
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -0,0 +1,249 @@
+import json
+import sys
+import threading
+
+import device_log
+import publish_queue
+from admission import AdmissionController
+from virtual_device import VirtualDevice, VirtualSwitch, VirtualBulb, RogueDevice
+
+
+if sys.version[0:1] == '3':
+    import urllib.request as urllib
+else:
+    import urllib as urllib
+
+
+DEVICE_TYPES = {
+    "generic": VirtualDevice,
+    "bulb": VirtualBulb,
+    "switch": VirtualSwitch,
+    "rogue": RogueDevice
+}
+
+# Seconds to wait for a device thread to finish after stop()
+STOP_TIMEOUT = 30
+
+
+def load_device_configs(cfg):
+    """
+    Normalize a configuration document into a list of device configurations.
+
+    Parameters
+    ----------
+    cfg: dict or list
+        Either a single device configuration (the format produced by the device factory),
+        a list of them, or a dictionary with a "devices" list. List items can also be
+        config file URLs, which are downloaded.
+
+    Returns
+    -------
+        A list of device configuration dictionaries
+    """
+    if isinstance(cfg, dict):
+        cfg = cfg["devices"] if "devices" in cfg else [cfg]
+
+    configs = []
+
+    for item in cfg:
+        if not isinstance(item, dict):
+            item = json.loads(urllib.urlopen(item).read())
+
+        configs.append(item)
+
+    return configs
+
+
+def create_device(cfg_file, files_dir=None):
+    """Build (but do not connect) the virtual device described by a device configuration."""
+    client_id = cfg_file["device_name"]
+    endpoint = cfg_file["iot_endpoint"]
+    dev_type = cfg_file.get("device-type", "generic")
+
+    if dev_type not in DEVICE_TYPES:
+        raise ValueError("Unknown device type '{}'".format(dev_type))
+
+    vd = DEVICE_TYPES[dev_type](client_id, endpoint, files_dir)
+
+    if cfg_file.get("transport"):
+        vd.transport = cfg_file["transport"]
+
+    if cfg_file.get("basic-ingest-rule"):
+        vd.set_basic_ingest_rule(cfg_file["basic-ingest-rule"])
+
+    if cfg_file.get("signal"):
+        vd.set_signal(cfg_file["signal"])
+
+    if cfg_file.get("shadow-file") is not None:
+        vd.set_shadow_file(bool(cfg_file["shadow-file"]))
+
+    if cfg_file.get("log-level"):
+        vd.set_log_level(cfg_file["log-level"])
+
+    if cfg_file.get("queue-size") or cfg_file.get("queue-policy") or cfg_file.get("drain-rate") is not None:
+        vd.set_publish_queue(cfg_file.get("queue-size", publish_queue.DEFAULT_QUEUE_SIZE),
+                             cfg_file.get("queue-policy", publish_queue.DEFAULT_POLICY),
+                             cfg_file.get("drain-rate", vd.drain_rate))
+
+    for topic_class, qos in cfg_file.get("qos", {}).items():
+        vd.set_qos(topic_class, qos)
+
+    if cfg_file.get("inflight-window"):
+        vd.set_inflight_window(cfg_file["inflight-window"])
+
+    if cfg_file.get("journal"):
+        vd.set_journal(True, cfg_file.get("replay-rate"))
+
+    if cfg_file.get("device-metrics-format"):
+        vd.set_device_metrics_format(cfg_file["device-metrics-format"])
+
+    if dev_type == "switch" and cfg_file.get("controlled-device"):
+        vd.set_target_device(cfg_file["controlled-device"])
+
+    if dev_type == "switch" and cfg_file.get("shadow-update-window") is not None:
+        vd.set_shadow_update_window(cfg_file["shadow-update-window"])
+
+    lwt = {
+        "msg": "Ouch Charlie...that really hurt",
+        "device": client_id
+    }
+
+    vd.register_last_will_and_testament("cmd/{}/lwt".format(client_id), json.dumps(lwt))
+    vd.prepare_files(json.dumps(cfg_file))
+
+    return vd
+
+
+class DeviceHost(object):
+    """DeviceHost
+
+    Runs several virtual devices side by side in the same process, each one with its own
+    MQTT connection, files directory and thread, and with independent start/stop.
+    """
+
+    def __init__(self, admission=None):
+        self._devices = {}
+        self._lock = threading.Lock()
+        # Paces the connections of all the hosted devices
+        self.admission = admission or AdmissionController()
+
+    def add_device(self, cfg_file):
+        """Create the device described by `cfg_file` and register it, without starting it."""
+        vd = create_device(cfg_file)
+        vd.admission = self.admission
+
+        with self._lock:
+            if vd.name in self._devices:
+                raise ValueError("Device '{}' is already hosted".format(vd.name))
+
+            self._devices[vd.name] = {
+                "device": vd,
+                "type": cfg_file.get("device-type", "generic"),
+                "thread": None
+            }
+
+        return vd
+
+    def load(self, cfg):
+        """Register every device found in a configuration document (see :func:`load_device_configs`)."""
+        return [self.add_device(cfg_file) for cfg_file in load_device_configs(cfg)]
+
+    def get_device(self, name=None):
+        """Return the device called `name`, or the first hosted device if no name is given. Raises KeyError if there is none."""
+        with self._lock:
+            if name:
+                if name not in self._devices:
+                    raise KeyError("Unknown device '{}'".format(name))
+
+                return self._devices[name]["device"]
+
+            if not self._devices:
+                raise KeyError("No devices are hosted")
+
+            return next(iter(self._devices.values()))["device"]
+
+    def names(self):
+        with self._lock:
+            return list(self._devices)
+
+    def is_running(self, name):
+        with self._lock:
+            thread = self._devices[name]["thread"]
+
+        return thread is not None and thread.is_alive()
+
+    def start_device(self, name):
+        with self._lock:
+            entry = self._devices[name]
+
+            if entry["thread"] is not None and entry["thread"].is_alive():
+                return
+
+            # Devices are reusable after a stop
+            entry["device"]._stop = False
+            self.admission.expect(name)
+            entry["thread"] = threading.Thread(target=self._run_device, args=(entry["device"],), name=name)
+            entry["thread"].daemon = True
+            entry["thread"].start()
+
+    def stop_device(self, name, timeout=STOP_TIMEOUT):
+        with self._lock:
+            entry = self._devices[name]
+
+        entry["device"].stop()
+        self.admission.forget(name)
+
+        if entry["thread"] is not None:
+            entry["thread"].join(timeout)
+
+    def remove_device(self, name):
+        self.stop_device(name)
+
+        with self._lock:
+            entry = self._devices.pop(name)
+
+        # Frees its slot in the signal bank
+        entry["device"].set_signal(None)
+
+    def start_all(self):
+        for name in self.names():
+            self.start_device(name)
+
+    def stop_all(self, timeout=STOP_TIMEOUT):
+        names = self.names()
+
+        # Signal every device first, so they shut down in parallel
+        for name in names:
+            self.get_device(name).stop()
+
+        for name in names:
+            self.stop_device(name, timeout)
+
+    def describe(self):
+        """Return a summary of every hosted device: name, type and whether its thread is running."""
+        with self._lock:
+            entries = list(self._devices.items())
+
+        return [{"name": name, "type": entry["type"], "running": entry["thread"] is not None and entry["thread"].is_alive()}
+                for name, entry in entries]
+
+    def get_stats(self):
+        """Per-device counters (see VirtualDevice.get_stats) plus the type of each device and whether it is running."""
+        stats = []
+
+        for device in self.describe():
+            device_stats = self.get_device(device["name"]).get_stats()
+            device_stats["running"] = device["running"]
+            device_stats["type"] = device["type"]
+            stats.append(device_stats)
+
+        return stats
+
+    @staticmethod
+    def _run_device(vd):
+        try:
+            # setup() only fails to connect when the device is stopped meanwhile
+            if vd.setup():
+                vd.start()
+        except Exception as e:
+            vd.log(" host - Device stopped with error '{}'", e, level=device_log.ERROR)
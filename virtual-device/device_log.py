@@ -0,0 +1,284 @@
+import atexit
+import collections
+import datetime
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+DEFAULT_SIZE = 15000
+
+
+def parse_level(name):
+    """Level called `name` (debug, info, warning or error), raising ValueError if unknown."""
+    try:
+        return LEVELS[str(name).lower()]
+    except KeyError:
+        raise ValueError("Unknown log level '{}'".format(name))
+
+
+DEFAULT_LEVEL = parse_level(os.getenv("LOG_LEVEL", "info"))
+# Records are echoed to stdout, the container log, unless LOG_STDOUT=off
+ECHO_STDOUT = os.getenv("LOG_STDOUT", "on") != "off"
+# Records waiting for the log shipper, beyond which new records are dropped
+SHIPPER_BUFFER_SIZE = int(os.getenv("LOG_BUFFER_SIZE", "10000"))
+SHIPPER_BATCH_SIZE = 500
+# Seconds between two batches when fewer than SHIPPER_BATCH_SIZE records are waiting
+SHIPPER_INTERVAL = 0.2
+
+
+class Json(object):
+    """Log argument dumped as JSON only when its record is formatted."""
+
+    __slots__ = ("value", "options")
+
+    def __init__(self, value, **options):
+        self.value = value
+        self.options = options
+
+    def __str__(self):
+        return json.dumps(self.value, **self.options)
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+
+class LogRecord(object):
+    """A log call: sequence number, timestamp, level, template and arguments, formatted on demand."""
+
+    __slots__ = ("seq", "ts", "level", "template", "args")
+
+    def __init__(self, seq, ts, level, template, args):
+        self.seq = seq
+        self.ts = ts
+        self.level = level
+        self.template = template
+        self.args = args
+
+    def message(self):
+        if not self.args:
+            return str(self.template)
+
+        try:
+            return str(self.template).format(*self.args)
+        except Exception:
+            # Never lose a record to a bad template, e.g. "{:.1f}" given None
+            return "{} {}".format(self.template, self.args)
+
+    def format(self):
+        return "{} - {} - {}".format(datetime.datetime.utcfromtimestamp(self.ts).isoformat(), logging.getLevelName(self.level),
+                                     self.message())
+
+
+def _write_stdout(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+class LogShipper(object):
+    """LogShipper
+
+    Writes log records to `write` (stdout by default, which the awslogs driver sends to CloudWatch)
+    from a background thread, a batch at a time. :meth:`submit` never blocks the logging thread:
+    beyond `max_size` waiting records new ones are dropped, counted, and reported in the next batch.
+    """
+
+    def __init__(self, write=_write_stdout, max_size=SHIPPER_BUFFER_SIZE, batch_size=SHIPPER_BATCH_SIZE,
+                 interval=SHIPPER_INTERVAL):
+        if max_size < 1 or batch_size < 1:
+            raise ValueError("Invalid log shipper buffer size '{}' / batch size '{}'".format(max_size, batch_size))
+
+        self._write = write
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self._buffer = collections.deque()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self.shipped = 0
+        self.batches = 0
+        self.dropped = 0
+        self.write_errors = 0
+        self._reported_drops = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-shipper")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def submit(self, record):
+        """Queue `record`, a sink of RingLog."""
+        if len(self._buffer) >= self.max_size:
+            with self._lock:
+                self.dropped += 1
+
+            return
+
+        self._buffer.append(record)
+
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                # Nothing must stop the shipper, the records of the failed batch are lost
+                self.write_errors += 1
+
+    def flush(self):
+        """Write every waiting record, in the calling thread."""
+        with self._flush_lock:
+            while self._buffer:
+                records = []
+
+                while self._buffer and len(records) < self.batch_size:
+                    records.append(self._buffer.popleft().format())
+
+                with self._lock:
+                    dropped = self.dropped - self._reported_drops
+                    self._reported_drops = self.dropped
+
+                if dropped:
+                    notice = "{} - WARNING - log shipper - {} records dropped".format(datetime.datetime.utcnow().isoformat(), dropped)
+                    records.insert(0, notice)
+
+                try:
+                    self._write("\n".join(records) + "\n")
+                except Exception:
+                    # A closed or broken stdout must not kill the shipper, the batch is lost
+                    self.write_errors += 1
+                    continue
+
+                self.shipped += len(records) - (1 if dropped else 0)
+                self.batches += 1
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def get_counters(self):
+        return {
+            "log_buffered": len(self._buffer),
+            "log_shipped": self.shipped,
+            "log_batches": self.batches,
+            "log_dropped": self.dropped,
+            "log_write_errors": self.write_errors
+        }
+
+
+_shipper = None
+_shipper_lock = threading.Lock()
+
+
+def get_shipper():
+    """The log shipper of the process, started on first use and flushed at exit."""
+    global _shipper
+
+    with _shipper_lock:
+        if _shipper is None:
+            _shipper = LogShipper()
+            _shipper.start()
+            atexit.register(_shipper.flush)
+
+        return _shipper
+
+
+class RingLog(object):
+    """RingLog
+
+    Fixed size ring buffer of the log records of a device. Records below `level` are dropped before
+    anything is formatted; the others keep their template and arguments, and are only formatted when
+    read (see :meth:`records`) or when a sink consumes them. Sinks are called with each new record,
+    in the logging thread; unless `echo` is False, the log shipper of the process is one, which
+    writes the records to stdout. Writers take a short lock, so that a record is in its slot before
+    `head` covers it; readers take none.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, level=DEFAULT_LEVEL, echo=ECHO_STDOUT):
+        if size < 1:
+            raise ValueError("Log size must be at least 1")
+
+        self._records = [None] * size
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        # Sequence number of the next record
+        self.head = 0
+        self.level = level
+        self.sinks = [get_shipper().submit] if echo else []
+
+    def is_enabled_for(self, level):
+        return level >= self.level
+
+    def log(self, level, template, args=()):
+        """Record `template` and its `args`, None if the level is filtered out."""
+        if level < self.level:
+            return None
+
+        with self._lock:
+            seq = next(self._seq)
+            record = LogRecord(seq, time.time(), level, template, args)
+            self._records[seq % len(self._records)] = record
+            self.head = seq + 1
+
+        for sink in self.sinks:
+            sink(record)
+
+        return record
+
+    def since(self, cursor, limit):
+        """
+        Read at most `limit` records from sequence number `cursor`, without copying the buffer.
+
+        Parameters
+        ----------
+        cursor: int
+            Sequence number of the first record to read. Records already overwritten are skipped
+        limit: int
+            Maximum number of records
+
+        Returns
+        -------
+            (records oldest first, cursor of the next records)
+        """
+        size = len(self._records)
+        head = self.head
+        # A cursor from the future (e.g. kept by a client across a restart) starts over from the head
+        cursor = min(cursor, head)
+        start = max(cursor, head - size, 0)
+        end = min(head, start + limit)
+        records = []
+
+        for seq in range(start, end):
+            record = self._records[seq % size]
+
+            # A slot can already hold a newer record
+            if record is not None and record.seq == seq:
+                records.append(record)
+
+        return records, max(end, cursor)
+
+    def tail(self, limit):
+        """The last `limit` records, see :meth:`since`."""
+        return self.since(self.head - limit, limit)
+
+    def records(self):
+        """The records still in the buffer, oldest first."""
+        return self.since(0, len(self._records))[0]
@@ -0,0 +1,282 @@
+# fleet.py - runs a device list sharded across worker processes, one per core
+from flask import Flask, jsonify
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+import admission
+from device_host import DeviceHost, load_device_configs
+
+
+PORT = int(os.getenv("PORT", "80"))
+FLEET_WORKERS = int(os.getenv("FLEET_WORKERS", "0")) or multiprocessing.cpu_count()
+# Seconds between two reports from a shard
+REPORT_INTERVAL = 10
+# Seconds between two supervisor checks
+SUPERVISE_INTERVAL = 1
+# A shard crashing more than MAX_RESTARTS times within RESTART_WINDOW seconds is retired
+# and its devices are rebalanced across the remaining shards
+MAX_RESTARTS = 3
+RESTART_WINDOW = 300
+
+CMD_ADD = "add"
+CMD_STOP = "stop"
+
+
+def shard_configs(configs, shards):
+    """Split a list of device configurations into `shards` lists, round robin."""
+    return [configs[i::shards] for i in range(shards)]
+
+
+def shard_bursts(burst, shards):
+    """Split a connection burst into `shards` integer shares adding up to `burst`, some 0 if there are more shards."""
+    return [burst // shards + (1 if i < burst % shards else 0) for i in range(shards)]
+
+
+def add_devices(host, configs, start=False):
+    """
+    Add the devices of `configs` to `host`, a configuration that fails only loses its own device.
+
+    Returns
+    -------
+        A list with the device name and the error of every configuration that could not be added
+    """
+    errors = []
+
+    for cfg_file in configs:
+        try:
+            vd = host.add_device(cfg_file)
+        except Exception as e:
+            errors.append({"device": cfg_file.get("device_name"), "error": "{}: {}".format(type(e).__name__, e)})
+            continue
+
+        if start:
+            host.start_device(vd.name)
+
+    return errors
+
+
+def run_shard(shard_id, configs, commands, reports, connect_rate, connect_burst):
+    """Worker process entry point: hosts a shard of devices and reports its counters periodically."""
+    host = DeviceHost(admission.AdmissionController(connect_rate, connect_burst))
+    errors = add_devices(host, configs)
+    host.start_all()
+
+    while True:
+        try:
+            command, args = commands.get(timeout=REPORT_INTERVAL)
+        except queue.Empty:
+            command = None
+
+        if command == CMD_STOP:
+            host.stop_all()
+            return
+        elif command == CMD_ADD:
+            errors.extend(add_devices(host, args, start=True))
+
+        reports.put((shard_id, os.getpid(), time.time(), host.get_stats(), host.admission.get_stats(), errors))
+
+
+class FleetSupervisor(object):
+    """FleetSupervisor
+
+    Starts one worker process per shard, restarts crashed workers and moves the devices of a
+    worker that keeps crashing to the other ones. Shard reports are aggregated by :meth:`status`,
+    along with the device configurations a shard could not load.
+    """
+
+    def __init__(self, configs, workers=FLEET_WORKERS, connect_rate=admission.DEFAULT_CONNECT_RATE,
+                 connect_burst=admission.DEFAULT_CONNECT_BURST):
+        self._context = multiprocessing.get_context("spawn")
+        self._reports = self._context.Queue()
+        self._shards = {}
+        self._lock = threading.Lock()
+        self._stop = False
+        shards = shard_configs(configs, min(workers, len(configs)) or 1)
+        # The connection rate and burst apply to the whole fleet, each shard gets its share
+        self._connect_rate = float(connect_rate) / len(shards)
+
+        for shard_id, (shard, burst) in enumerate(zip(shards, shard_bursts(connect_burst, len(shards)))):
+            self._shards[shard_id] = {
+                "configs": shard,
+                "connect_burst": burst,
+                "process": None,
+                "commands": None,
+                "restarts": [],
+                "retired": False,
+                "report": None,
+                "admission": None,
+                "errors": [],
+                "throughput": 0.0
+            }
+
+    def start(self):
+        for shard_id in self._shards:
+            self._spawn(shard_id)
+
+    def _spawn(self, shard_id):
+        shard = self._shards[shard_id]
+        shard["commands"] = self._context.Queue()
+        shard["process"] = self._context.Process(target=run_shard, name="shard-{}".format(shard_id),
+                                                 args=(shard_id, shard["configs"], shard["commands"], self._reports,
+                                                       self._connect_rate, shard["connect_burst"]))
+        shard["process"].daemon = True
+        shard["process"].start()
+
+    def supervise(self):
+        """Supervisor loop, returns after :meth:`stop`."""
+        while not self._stop:
+            self._collect_reports()
+
+            with self._lock:
+                for shard_id, shard in self._shards.items():
+                    if not shard["retired"] and not shard["process"].is_alive() and not self._stop:
+                        self._handle_crash(shard_id)
+
+            time.sleep(SUPERVISE_INTERVAL)
+
+    def _collect_reports(self):
+        while True:
+            try:
+                shard_id, pid, ts, stats, admission_stats, errors = self._reports.get_nowait()
+            except queue.Empty:
+                return
+
+            with self._lock:
+                shard = self._shards[shard_id]
+                previous = shard["report"]
+                messages_out = sum(device.get("messages_out", 0) for device in stats)
+
+                # Only compare reports coming from the same process, counters restart with the worker
+                if previous and previous["pid"] == pid and ts > previous["ts"]:
+                    shard["throughput"] = (messages_out - previous["messages_out"]) / (ts - previous["ts"])
+
+                shard["report"] = {"pid": pid, "ts": ts, "messages_out": messages_out, "devices": stats}
+                shard["admission"] = admission_stats
+                shard["errors"] = errors
+
+    def _handle_crash(self, shard_id):
+        shard = self._shards[shard_id]
+        now = time.time()
+        shard["restarts"] = [ts for ts in shard["restarts"] if now - ts < RESTART_WINDOW] + [now]
+        survivors = [i for i, s in self._shards.items() if i != shard_id and not s["retired"]]
+
+        if len(shard["restarts"]) <= MAX_RESTARTS or not survivors:
+            print("Shard {} exited with code {}, restarting...".format(shard_id, shard["process"].exitcode))
+            self._spawn(shard_id)
+            return
+
+        print("Shard {} keeps crashing, moving its {} devices to shards {}".format(shard_id, len(shard["configs"]), survivors))
+        shard["retired"] = True
+
+        for target, configs in zip(survivors, shard_configs(shard["configs"], len(survivors))):
+            if configs:
+                self._shards[target]["configs"] = self._shards[target]["configs"] + configs
+                self._shards[target]["commands"].put((CMD_ADD, configs))
+
+        shard["configs"] = []
+        shard["report"] = None
+        shard["admission"] = None
+        shard["errors"] = []
+
+    def status(self):
+        """Aggregated view of the fleet: one entry per shard, plus totals."""
+        shards = []
+        totals = {"devices": 0, "running": 0, "messages_out": 0, "messages_in": 0, "bytes_out": 0, "bytes_in": 0,
+                  "throughput": 0.0, "errors": 0, "time_to_fully_connected": None}
+        connect_times = []
+
+        with self._lock:
+            for shard_id, shard in sorted(self._shards.items()):
+                devices = shard["report"]["devices"] if shard["report"] else []
+                entry = {
+                    "shard": shard_id,
+                    "pid": shard["process"].pid if shard["process"] else None,
+                    "alive": bool(shard["process"] and shard["process"].is_alive()),
+                    "retired": shard["retired"],
+                    "restarts": len(shard["restarts"]),
+                    "devices": len(shard["configs"]),
+                    "running": sum(1 for device in devices if device.get("running")),
+                    "last_report": shard["report"]["ts"] if shard["report"] else None,
+                    "throughput": round(shard["throughput"], 3),
+                    "admission": shard["admission"],
+                    "errors": shard["errors"]
+                }
+
+                for counter in ("messages_out", "messages_in", "bytes_out", "bytes_in"):
+                    entry[counter] = sum(device.get(counter, 0) for device in devices)
+                    totals[counter] += entry[counter]
+
+                totals["devices"] += entry["devices"]
+                totals["running"] += entry["running"]
+                totals["throughput"] += entry["throughput"]
+                totals["errors"] += len(entry["errors"])
+
+                if not shard["retired"]:
+                    connect_times.append(shard["admission"]["time_to_fully_connected"] if shard["admission"] else None)
+
+                shards.append(entry)
+
+        # Shards connect in parallel: the fleet is fully connected once the slowest shard is
+        if connect_times and None not in connect_times:
+            totals["time_to_fully_connected"] = max(connect_times)
+
+        return {"shards": shards, "totals": totals}
+
+    def stop(self, timeout=30):
+        self._stop = True
+
+        with self._lock:
+            shards = [s for s in self._shards.values() if s["process"] is not None]
+
+        for shard in shards:
+            if shard["process"].is_alive():
+                shard["commands"].put((CMD_STOP, None))
+
+        for shard in shards:
+            shard["process"].join(timeout)
+
+            if shard["process"].is_alive():
+                shard["process"].terminate()
+
+
+def create_app(supervisor):
+    app = Flask(__name__)
+
+    @app.route("/")
+    @app.route("/fleet")
+    def fleet():
+        return jsonify(supervisor.status())
+
+    return app
+
+
+if __name__ == '__main__':
+    if sys.version[0:1] == '3':
+        import urllib.request as urllib
+    else:
+        import urllib as urllib
+
+    if os.environ.get('DEBUG') == 'true':
+        response = open("{}/local/config.json".format(os.path.dirname(os.path.realpath(__file__))), "r")
+    else:
+        response = urllib.urlopen(os.environ.get('CONFIG_FILE_URL'))
+
+    # Config URLs are resolved once here, so restarted or rebalanced shards don't download them again
+    configs = load_device_configs(json.loads(response.read()))
+
+    supervisor = FleetSupervisor(configs)
+    supervisor.start()
+
+    supervisor_thread = threading.Thread(target=supervisor.supervise, name="fleet-supervisor")
+    supervisor_thread.daemon = True
+    supervisor_thread.start()
+
+    try:
+        create_app(supervisor).run(threaded=True, host='0.0.0.0', port=PORT, use_reloader=False)
+    finally:
+        supervisor.stop()
@@ -0,0 +1,65 @@
+import bisect
+import threading
+
+
+# Upper bounds in seconds, from 1 ms to 10 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Histogram
+
+    Fixed bucket histogram of durations, cheap enough to observe every publish.
+    Thread safe.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def cumulative_counts(self):
+        """(upper bound, observations <= upper bound) pairs, the last bound being infinity."""
+        with self._lock:
+            counts = list(self._counts)
+
+        pairs = []
+        total = 0
+
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            total += count
+            pairs.append((bound, total))
+
+        return pairs
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the `q` quantile, None without observations."""
+        pairs = self.cumulative_counts()
+        total = pairs[-1][1]
+
+        if not total:
+            return None
+
+        for bound, count in pairs:
+            if count >= q * total:
+                return bound
+
+    def snapshot(self):
+        quantiles = dict((name, self.quantile(q)) for name, q in (("p50", 0.5), ("p99", 0.99)))
+        snapshot = {"count": self.count, "sum": round(self.sum, 6)}
+
+        for name, bound in quantiles.items():
+            # Above the last bucket, named the Prometheus way
+            snapshot[name] = "+Inf" if bound == float("inf") else bound
+
+        return snapshot
@@ -0,0 +1,123 @@
+import collections
+import threading
+
+import histogram
+
+
+# Classes of the topics counted by /metrics, the telemetry class takes every topic not matched below
+TOPIC_CLASS_TELEMETRY = "telemetry"
+TOPIC_CLASS_DEVICE_DEFENDER = "device_defender"
+TOPIC_CLASS_JOBS = "jobs"
+TOPIC_CLASS_SHADOW = "shadow"
+TOPIC_CLASS_COMMAND = "command"
+TOPIC_CLASS_MARKERS = (
+    ("/defender/", TOPIC_CLASS_DEVICE_DEFENDER),
+    ("/jobs/", TOPIC_CLASS_JOBS),
+    ("/shadow/", TOPIC_CLASS_SHADOW),
+    ("cmd/", TOPIC_CLASS_COMMAND)
+)
+
+# Topics whose class is cached, command replies go to topics chosen by the requester
+MAX_CACHED_TOPICS = 1024
+# Callbacks and loop ticks are much shorter than publish round trips, from 100 us to 5 s
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+
+def classify_topic(topic):
+    for marker, topic_class in TOPIC_CLASS_MARKERS:
+        if marker in topic:
+            return topic_class
+
+    return TOPIC_CLASS_TELEMETRY
+
+
+class DeviceInstruments(object):
+    """DeviceInstruments
+
+    Counters and histograms of a single device, exported by /metrics: messages and bytes per topic
+    class in both directions, publish errors, callback durations and errors, and loop tick lag.
+    A few dictionary updates per message, thread safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Topics are few and reused, their class is computed once
+        self._topic_classes = {}
+        self.published = collections.Counter()
+        self.published_bytes = collections.Counter()
+        self.received = collections.Counter()
+        self.received_bytes = collections.Counter()
+        self.publish_errors = 0
+        self.decode_errors = 0
+        self.unrouted = 0
+        self.callback_errors = collections.Counter()
+        self.callback_duration = {}
+        self.tick_lag = histogram.Histogram(FAST_BUCKETS)
+        # Histogram of the in-flight window of the device, which observes the PUBACKs
+        self.puback_latency = None
+
+    def topic_class(self, topic):
+        topic_class = self._topic_classes.get(topic)
+
+        if topic_class is None:
+            topic_class = classify_topic(topic)
+
+            if len(self._topic_classes) < MAX_CACHED_TOPICS:
+                self._topic_classes[topic] = topic_class
+
+        return topic_class
+
+    def count_published(self, topic, payload):
+        topic_class = self.topic_class(topic)
+
+        with self._lock:
+            self.published[topic_class] += 1
+            self.published_bytes[topic_class] += len(payload)
+
+    def count_received(self, message):
+        topic_class = self.topic_class(message.topic)
+
+        with self._lock:
+            self.received[topic_class] += 1
+            self.received_bytes[topic_class] += len(message.payload)
+
+    def count_publish_error(self):
+        with self._lock:
+            self.publish_errors += 1
+
+    def count_decode_error(self):
+        with self._lock:
+            self.decode_errors += 1
+
+    def count_unrouted(self):
+        with self._lock:
+            self.unrouted += 1
+
+    def count_callback_error(self, name):
+        with self._lock:
+            self.callback_errors[name] += 1
+
+    def observe_callback(self, name, duration):
+        h = self.callback_duration.get(name)
+
+        if h is None:
+            with self._lock:
+                h = self.callback_duration.setdefault(name, histogram.Histogram(FAST_BUCKETS))
+
+        h.observe(duration)
+
+    def snapshot(self):
+        """Copies of the counters, safe to iterate while the device runs."""
+        with self._lock:
+            return {
+                "published": dict(self.published),
+                "published_bytes": dict(self.published_bytes),
+                "received": dict(self.received),
+                "received_bytes": dict(self.received_bytes),
+                "publish_errors": self.publish_errors,
+                "decode_errors": self.decode_errors,
+                "unrouted": self.unrouted,
+                "callback_errors": dict(self.callback_errors),
+                "callback_duration": dict(self.callback_duration)
+            }
+
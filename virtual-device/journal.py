@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+import time
+
+
+# Acked messages are deleted once there are this many of them
+COMPACT_EVERY = 1000
+# Oldest messages are dropped above this backlog, so an endless outage can't fill the disk
+DEFAULT_MAX_MESSAGES = 100000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    offset INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    topic TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    qos INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class Journal(object):
+    """Journal
+
+    Append-only store-and-forward log of publishes, kept in a SQLite database in WAL mode so
+    it survives a restart of the container. Messages are replayed in offset order; the offset
+    of the last replayed message is committed with :meth:`ack`, so a message acked before a
+    crash is not sent again. Thread safe.
+    """
+
+    def __init__(self, path, max_messages=DEFAULT_MAX_MESSAGES):
+        self.path = path
+        self.max_messages = max_messages
+        self.appended = 0
+        self.replayed = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only loses the last transactions on a power failure, not on a crash
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._acked = self._get_state("acked")
+        self._compacted = self._acked
+        self._backlog = self._db.execute("SELECT COUNT(*) FROM messages WHERE offset > ?", (self._acked,)).fetchone()[0]
+
+    def _get_state(self, key):
+        row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+
+        return row[0] if row else 0
+
+    def append(self, topic, payload, qos=0):
+        """Store a message, returns its offset."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf8")
+
+        with self._lock:
+            offset = self._db.execute("INSERT INTO messages (ts, topic, payload, qos) VALUES (?, ?, ?, ?)",
+                                      (time.time(), topic, payload, qos)).lastrowid
+            self.appended += 1
+            self._backlog += 1
+
+            if self._backlog > self.max_messages:
+                self._drop_oldest(self._backlog - self.max_messages)
+
+            return offset
+
+    def _drop_oldest(self, count):
+        # Dropped messages are acked without being sent
+        row = self._db.execute("SELECT offset FROM messages WHERE offset > ? ORDER BY offset LIMIT 1 OFFSET ?",
+                               (self._acked, count - 1)).fetchone()
+        self._commit_ack(row[0])
+        self._backlog -= count
+        self.dropped += count
+
+    def pending(self, limit):
+        """The next `limit` messages to replay, as (offset, topic, payload, qos) tuples."""
+        with self._lock:
+            return self._db.execute("SELECT offset, topic, payload, qos FROM messages WHERE offset > ? ORDER BY offset LIMIT ?",
+                                    (self._acked, limit)).fetchall()
+
+    def ack(self, offset):
+        """Mark every message up to `offset` as sent."""
+        with self._lock:
+            if offset <= self._acked:
+                return
+
+            acked = self._db.execute("SELECT COUNT(*) FROM messages WHERE offset > ? AND offset <= ?",
+                                     (self._acked, offset)).fetchone()[0]
+            self._commit_ack(offset)
+            self._backlog -= acked
+            self.replayed += acked
+
+    def _commit_ack(self, offset):
+        self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('acked', ?)", (offset,))
+        self._acked = offset
+
+        if self._acked - self._compacted >= COMPACT_EVERY:
+            self._db.execute("DELETE FROM messages WHERE offset <= ?", (self._acked,))
+            self._compacted = self._acked
+
+    @property
+    def acked(self):
+        return self._acked
+
+    def __len__(self):
+        return self._backlog
+
+    def get_counters(self):
+        return {
+            "journal_backlog": self._backlog,
+            "journal_appended": self.appended,
+            "journal_replayed": self.replayed,
+            "journal_dropped": self.dropped
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
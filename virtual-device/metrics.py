@@ -130,10 +130,11 @@ class Metrics(object):
         }
 
         if self._old_interface_stats:
-            bytes_in_diff = bytes_in - self._old_interface_stats[self.t.bytes_in]
-            bytes_out_diff = bytes_out - self._old_interface_stats[self.t.bytes_out]
-            packets_in_diff = packets_in - self._old_interface_stats[self.t.packets_in]
-            packets_out_diff = packets_out - self._old_interface_stats[self.t.packets_out]
+            # total_counts always uses the long names, whatever the tags of this report
+            bytes_in_diff = bytes_in - self._old_interface_stats['bytes_in']
+            bytes_out_diff = bytes_out - self._old_interface_stats['bytes_out']
+            packets_in_diff = packets_in - self._old_interface_stats['packets_in']
+            packets_out_diff = packets_out - self._old_interface_stats['packets_out']
 
             self._interface_stats = {self.t.bytes_in: bytes_in_diff,
                                      self.t.bytes_out: bytes_out_diff,
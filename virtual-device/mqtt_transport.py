@@ -0,0 +1,854 @@
+import asyncio
+import collections
+import os
+import ssl
+import struct
+import threading
+import time
+
+import device_log
+import reconnect
+
+
+TRANSPORT_SDK = "sdk"
+TRANSPORT_ASYNCIO = "asyncio"
+TRANSPORT_LOCAL = "local"
+DEFAULT_TRANSPORT = os.getenv("MQTT_TRANSPORT", TRANSPORT_SDK)
+
+DEFAULT_KEEP_ALIVE = 600
+# Keep alive periods without any packet from the broker after which a connection is considered lost
+KEEP_ALIVE_TIMEOUT = 1.5
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_OPERATION_TIMEOUT = 5
+RESERVED_TOPIC_PREFIX = "$aws/"
+BASIC_INGEST_PREFIX = "$aws/rules/"
+# ALPN protocol used by AWS IoT to accept MQTT over TLS on port 443
+AWS_IOT_ALPN_PROTOCOL = "x-amzn-mqtt-ca"
+
+# MQTT 3.1.1 control packet types
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+SUBSCRIBE = 0x80
+SUBACK = 0x90
+UNSUBSCRIBE = 0xA0
+PINGREQ = 0xC0
+PINGRESP = 0xD0
+DISCONNECT = 0xE0
+
+
+class MqttMessage(object):
+    """An incoming message, exposing the same attributes as the AWS IoT SDK messages."""
+
+    __slots__ = ("topic", "payload", "qos", "retain")
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class MqttTransport(object):
+    """MqttTransport
+
+    The MQTT operations used by the virtual devices. Callbacks passed to :meth:`subscribe` are
+    called as ``callback(client, userdata, message)``; they can be plain functions or coroutine
+    functions, the latter always run on the process-wide event loop (see :func:`get_shared_loop`).
+
+    Transports count the messages and bytes going through them, see :meth:`get_counters`.
+    """
+
+    def __init__(self):
+        self.messages_out = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.offline_dropped = 0
+        self._log = None
+
+    def get_counters(self):
+        return {
+            "messages_out": self.messages_out,
+            "bytes_out": self.bytes_out,
+            "messages_in": self.messages_in,
+            "bytes_in": self.bytes_in,
+            "offline_dropped": self.offline_dropped
+        }
+
+    def _count_out(self, payload):
+        self.messages_out += 1
+        self.bytes_out += len(payload)
+
+    def _count_in(self, message):
+        self.messages_in += 1
+        self.bytes_in += len(message.payload)
+
+    def configure_log(self, log):
+        """Report what the transport handles on its own, e.g. failed reconnections, through
+        ``log(template, *args, level=...)`` (see VirtualDevice.log)."""
+        self._log = log
+
+    def _log_event(self, template, *args, level=device_log.INFO):
+        if self._log is not None:
+            self._log(template, *args, level=level)
+
+    def configure_credentials(self, ca_path, key_path, cert_path):
+        raise NotImplementedError()
+
+    def configure_last_will(self, topic, payload, qos):
+        raise NotImplementedError()
+
+    def configure_offline_queue(self, size, drop_oldest=True):
+        """Number of publishes queued while offline, -1 for unbounded and 0 to disable. When full, the
+        oldest queued publish is dropped, or the new one if `drop_oldest` is False."""
+        raise NotImplementedError()
+
+    def configure_draining_frequency(self, frequency):
+        """Rate (Hz) at which the offline queue is flushed after a reconnection."""
+        raise NotImplementedError()
+
+    def configure_timeouts(self, connect_disconnect, operation):
+        raise NotImplementedError()
+
+    def configure_reconnect(self, reconnect_delay, on_reconnected=None, on_connection_lost=None):
+        """
+        Pace the automatic reconnections after a connection loss: every attempt first waits
+        `reconnect_delay()` seconds. `on_connection_lost` is called when the connection drops (not on
+        :meth:`disconnect`), `on_reconnected` after each automatic reconnection. The callbacks run
+        in a transport thread or on the event loop, they must not block.
+        """
+        raise NotImplementedError()
+
+    def connect(self, keep_alive=DEFAULT_KEEP_ALIVE):
+        raise NotImplementedError()
+
+    def disconnect(self):
+        raise NotImplementedError()
+
+    def is_connected(self):
+        raise NotImplementedError()
+
+    def publish(self, topic, payload, qos, ack_callback=None):
+        """Publish a message. For QoS 1, `ack_callback` (no arguments) is called from a transport
+        thread when the PUBACK arrives."""
+        raise NotImplementedError()
+
+    def subscribe(self, topic, qos, callback):
+        raise NotImplementedError()
+
+
+def create_transport(kind, client_id, endpoint, port):
+    """
+    Build a transport.
+
+    Parameters
+    ----------
+    kind: string
+        TRANSPORT_SDK (AWS IoT Device SDK, one set of threads per client) or
+        TRANSPORT_ASYNCIO (all the clients share the same event loop) or
+        TRANSPORT_LOCAL (in memory, no broker involved)
+    """
+    if kind == TRANSPORT_SDK:
+        return SdkTransport(client_id, endpoint, port)
+    elif kind == TRANSPORT_ASYNCIO:
+        return AsyncioTransport(client_id, endpoint, port)
+    elif kind == TRANSPORT_LOCAL:
+        return LocalTransport(client_id)
+    else:
+        raise ValueError("Unknown MQTT transport '{}'".format(kind))
+
+
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+
+def get_shared_loop():
+    """Return the process-wide event loop, started in a daemon thread on first use."""
+    global _shared_loop
+
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_shared_loop.run_forever, name="mqtt-event-loop")
+            thread.daemon = True
+            thread.start()
+
+        return _shared_loop
+
+
+def _wrap_sdk_callback(transport, callback):
+    is_coroutine = asyncio.iscoroutinefunction(callback)
+
+    def run(client, userdata, message):
+        transport._count_in(message)
+
+        # Threaded clients hand coroutines over to the shared loop instead of blocking their own thread
+        if is_coroutine:
+            asyncio.run_coroutine_threadsafe(callback(client, userdata, message), get_shared_loop())
+        else:
+            callback(client, userdata, message)
+
+    return run
+
+
+class _SdkBackoffCore(object):
+    """Stand-in for the ProgressiveBackOffCore of the SDK, waiting the delays of `reconnect_delay`."""
+
+    def __init__(self, reconnect_delay):
+        self._reconnect_delay = reconnect_delay
+
+    def configTime(self, base_delay, max_delay, stable_time):
+        pass
+
+    def backOff(self):
+        # Called by the network thread of the client, before each reconnection attempt
+        time.sleep(self._reconnect_delay())
+
+    def startStableConnectionTimer(self):
+        pass
+
+    def stopStableConnectionTimer(self):
+        pass
+
+
+class SdkTransport(MqttTransport):
+    """Transport backed by the AWS IoT Device SDK (AWSIoTMQTTShadowClient)."""
+
+    def __init__(self, client_id, endpoint, port):
+        from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTShadowClient
+
+        MqttTransport.__init__(self)
+        self._shadow_client = AWSIoTMQTTShadowClient(client_id)
+        self._shadow_client.disableMetricsCollection()
+        self._shadow_client.configureEndpoint(endpoint, port)
+        self._client = self._shadow_client.getMQTTConnection()
+        self._connected = False
+        self._closing = False
+        self._reconnecting = False
+        self._on_reconnected = None
+        self._on_connection_lost = None
+        # Loaded by the SDK on connect(), called from its own threads after every (re)connection
+        self._shadow_client.onOnline = self._on_online
+        self._shadow_client.onOffline = self._on_offline
+
+    def _on_online(self):
+        self._connected = True
+
+        if self._reconnecting:
+            self._reconnecting = False
+
+            if self._on_reconnected is not None:
+                self._on_reconnected()
+
+    def _on_offline(self):
+        self._connected = False
+
+        if not self._closing and not self._reconnecting:
+            self._reconnecting = True
+
+            if self._on_connection_lost is not None:
+                self._on_connection_lost()
+
+    def configure_credentials(self, ca_path, key_path, cert_path):
+        self._shadow_client.configureCredentials(ca_path, key_path, cert_path)
+
+    def configure_last_will(self, topic, payload, qos):
+        self._shadow_client.configureLastWill(topic, payload, qos)
+
+    def configure_offline_queue(self, size, drop_oldest=True):
+        # AWSIoTPythonSDK DropBehaviorTypes: DROP_OLDEST = 0, DROP_NEWEST = 1
+        self._client.configureOfflinePublishQueueing(size, 0 if drop_oldest else 1)
+
+    def configure_draining_frequency(self, frequency):
+        self._client.configureDrainingFrequency(frequency)
+
+    def configure_timeouts(self, connect_disconnect, operation):
+        self._client.configureConnectDisconnectTimeout(connect_disconnect)
+        self._client.configureMQTTOperationTimeout(operation)
+
+    def configure_reconnect(self, reconnect_delay, on_reconnected=None, on_connection_lost=None):
+        self._on_reconnected = on_reconnected
+        self._on_connection_lost = on_connection_lost
+        # The SDK client sleeps in the backoff core of its paho client before every automatic
+        # reconnection, doubling its delay without jitter: the delays come from reconnect_delay instead
+        paho_client = self._client._mqtt_core._internal_async_client._paho_client
+        paho_client._backoffCore = _SdkBackoffCore(reconnect_delay)
+
+    def connect(self, keep_alive=DEFAULT_KEEP_ALIVE):
+        self._closing = False
+        self._reconnecting = False
+
+        return self._shadow_client.connect(keep_alive)
+
+    def disconnect(self):
+        self._closing = True
+
+        return self._client.disconnect()
+
+    def is_connected(self):
+        return self._connected
+
+    def publish(self, topic, payload, qos, ack_callback=None):
+        self._count_out(payload)
+
+        if qos and ack_callback is not None:
+            return self._client.publishAsync(topic, payload, qos, ackCallback=lambda mid: ack_callback())
+
+        return self._client.publish(topic, payload, qos)
+
+    def subscribe(self, topic, qos, callback):
+        return self._client.subscribe(topic, qos, _wrap_sdk_callback(self, callback))
+
+
+class LocalTransport(MqttTransport):
+    """LocalTransport
+
+    In-memory stand-in for the broker, for local runs and tests. Publishes are recorded in
+    `published` and delivered to the matching subscriptions of the same transport, except for
+    the reserved $aws/ topics, which are requests to AWS IoT services.
+
+    Basic Ingest publishes ($aws/rules/<rule>/<topic>) are checked the way AWS IoT does, recorded in
+    `ingested` by rule name and, as with the real service, never delivered to subscribers.
+    """
+
+    def __init__(self, client_id, basic_ingest_rules=None):
+        MqttTransport.__init__(self)
+        self.client_id = client_id
+        self.basic_ingest_rules = basic_ingest_rules
+        self.connected = False
+        self.published = []
+        self.ingested = collections.defaultdict(list)
+        # Delays waited by the automatic reconnections, see reconnect()
+        self.reconnect_delays = []
+        self._subscriptions = collections.OrderedDict()
+        self._reconnect_delay = None
+        self._on_reconnected = None
+        self._on_connection_lost = None
+
+    def configure_credentials(self, ca_path, key_path, cert_path):
+        pass
+
+    def configure_last_will(self, topic, payload, qos):
+        pass
+
+    def configure_offline_queue(self, size, drop_oldest=True):
+        pass
+
+    def configure_draining_frequency(self, frequency):
+        pass
+
+    def configure_timeouts(self, connect_disconnect, operation):
+        pass
+
+    def configure_reconnect(self, reconnect_delay, on_reconnected=None, on_connection_lost=None):
+        self._reconnect_delay = reconnect_delay
+        self._on_reconnected = on_reconnected
+        self._on_connection_lost = on_connection_lost
+
+    def connect(self, keep_alive=DEFAULT_KEEP_ALIVE):
+        self.connected = True
+
+        return True
+
+    def disconnect(self):
+        self.connected = False
+
+        return True
+
+    def lose_connection(self):
+        """Drop the connection as a broker outage would."""
+        self.connected = False
+
+        if self._on_connection_lost is not None:
+            self._on_connection_lost()
+
+    def reconnect(self):
+        """Reconnect automatically after :meth:`lose_connection`, the delay is recorded instead of waited."""
+        if self._reconnect_delay is not None:
+            self.reconnect_delays.append(self._reconnect_delay())
+
+        self.connected = True
+
+        if self._on_reconnected is not None:
+            self._on_reconnected()
+
+    def is_connected(self):
+        return self.connected
+
+    def publish(self, topic, payload, qos, ack_callback=None):
+        self._count_out(payload)
+        self.published.append((topic, payload, qos))
+
+        # The in-memory broker acks right away
+        if qos and ack_callback is not None:
+            ack_callback()
+
+        if topic.startswith(BASIC_INGEST_PREFIX):
+            rule, ingested_topic = self.check_basic_ingest_topic(topic)
+            self.ingested[rule].append((ingested_topic, payload))
+            return True
+
+        if topic.startswith(RESERVED_TOPIC_PREFIX):
+            return True
+
+        message = MqttMessage(topic, payload.encode("utf8") if isinstance(payload, str) else payload, qos)
+
+        for topic_filter, callback in list(self._subscriptions.items()):
+            if topic_matches(topic_filter, topic):
+                self._count_in(message)
+
+                if asyncio.iscoroutinefunction(callback):
+                    asyncio.run_coroutine_threadsafe(callback(self, None, message), get_shared_loop())
+                else:
+                    callback(self, None, message)
+
+        return True
+
+    def subscribe(self, topic, qos, callback):
+        self._subscriptions[topic] = callback
+
+        return True
+
+    def check_basic_ingest_topic(self, topic):
+        """Split a Basic Ingest topic into (rule name, topic seen by the rule), raising ValueError if it is invalid."""
+        levels = topic[len(BASIC_INGEST_PREFIX):].split("/", 1)
+
+        if len(levels) != 2 or not levels[0] or not levels[1]:
+            raise ValueError("Invalid Basic Ingest topic '{}'".format(topic))
+
+        rule, ingested_topic = levels
+
+        if self.basic_ingest_rules is not None and rule not in self.basic_ingest_rules:
+            raise ValueError("Unknown rule '{}' in Basic Ingest topic '{}'".format(rule, topic))
+
+        if "+" in ingested_topic or "#" in ingested_topic:
+            raise ValueError("Wildcards are not allowed in Basic Ingest topic '{}'".format(topic))
+
+        return rule, ingested_topic
+
+
+def topic_matches(topic_filter, topic):
+    """Check whether `topic` matches an MQTT topic filter, with + and # wildcards."""
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+
+        if i >= len(topic_levels):
+            return False
+
+        if level != "+" and level != topic_levels[i]:
+            return False
+
+    return len(filter_levels) == len(topic_levels)
+
+
+def _encode_length(length):
+    encoded = bytearray()
+
+    while True:
+        byte = length % 128
+        length //= 128
+
+        if length:
+            byte |= 0x80
+
+        encoded.append(byte)
+
+        if not length:
+            return bytes(encoded)
+
+
+def _encode_string(value):
+    if isinstance(value, str):
+        value = value.encode("utf8")
+
+    return struct.pack("!H", len(value)) + value
+
+
+def _packet(header, body=b""):
+    return bytes([header]) + _encode_length(len(body)) + body
+
+
+def encode_connect(client_id, keep_alive, clean_session=True, will=None):
+    """Encode a CONNECT packet, `will` is an optional (topic, payload, qos) tuple."""
+    flags = 0x02 if clean_session else 0x00
+    payload = _encode_string(client_id)
+
+    if will:
+        will_topic, will_payload, will_qos = will
+        flags |= 0x04 | (will_qos << 3)
+        payload += _encode_string(will_topic) + _encode_string(will_payload)
+
+    body = _encode_string("MQTT") + struct.pack("!BBH", 4, flags, keep_alive) + payload
+
+    return _packet(CONNECT, body)
+
+
+def encode_publish(topic, payload, qos=0, packet_id=None, retain=False, dup=False):
+    if isinstance(payload, str):
+        payload = payload.encode("utf8")
+
+    header = PUBLISH | (0x08 if dup else 0) | (qos << 1) | (0x01 if retain else 0)
+    body = _encode_string(topic)
+
+    if qos:
+        body += struct.pack("!H", packet_id)
+
+    return _packet(header, body + payload)
+
+
+def encode_puback(packet_id):
+    return _packet(PUBACK, struct.pack("!H", packet_id))
+
+
+def encode_subscribe(packet_id, topics):
+    """Encode a SUBSCRIBE packet for a list of (topic filter, qos) tuples."""
+    body = struct.pack("!H", packet_id)
+
+    for topic, qos in topics:
+        body += _encode_string(topic) + bytes([qos])
+
+    return _packet(SUBSCRIBE | 0x02, body)
+
+
+def encode_pingreq():
+    return _packet(PINGREQ)
+
+
+def encode_disconnect():
+    return _packet(DISCONNECT)
+
+
+def decode_publish(flags, body):
+    """Decode the variable header and payload of a PUBLISH packet into (message, packet id)."""
+    qos = (flags >> 1) & 0x03
+    topic_length = struct.unpack_from("!H", body)[0]
+    topic = body[2:2 + topic_length].decode("utf8")
+    offset = 2 + topic_length
+    packet_id = None
+
+    if qos:
+        packet_id = struct.unpack_from("!H", body, offset)[0]
+        offset += 2
+
+    return MqttMessage(topic, body[offset:], qos, bool(flags & 0x01)), packet_id
+
+
+async def read_packet(reader):
+    """Read one control packet from a stream, returning (header byte, body)."""
+    header = (await reader.readexactly(1))[0]
+    length = 0
+    multiplier = 1
+
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        multiplier *= 128
+
+        if not byte & 0x80:
+            break
+
+    body = await reader.readexactly(length) if length else b""
+
+    return header, body
+
+
+class AsyncioTransport(MqttTransport):
+    """AsyncioTransport
+
+    A minimal MQTT 3.1.1 client where every connection lives on the shared event loop, so a
+    process can keep thousands of devices connected without a thread per client.
+
+    The public methods are thread safe and never block on the network, except for
+    :meth:`connect` and :meth:`disconnect`, which must not be called from the event loop itself.
+
+    The messages of a transport reach its callbacks one at a time, in the order they were received,
+    reconnections included: coroutine callbacks are awaited, plain ones run in the loop's default
+    executor. A slow callback only delays the next messages of its own transport.
+    """
+
+    def __init__(self, client_id, endpoint, port, loop=None):
+        MqttTransport.__init__(self)
+        self.client_id = client_id
+        self.endpoint = endpoint
+        self.port = port
+        self._loop = loop or get_shared_loop()
+        self._ssl_context = None
+        self._will = None
+        self._offline_queue = collections.deque()
+        self._offline_queue_size = -1
+        self._offline_drop_oldest = True
+        self._reconnect_delay = None
+        self._on_reconnected = None
+        self._on_connection_lost = None
+        self._draining_delay = 0.5
+        self._connect_timeout = DEFAULT_CONNECT_TIMEOUT
+        self._operation_timeout = DEFAULT_OPERATION_TIMEOUT
+        self._keep_alive = DEFAULT_KEEP_ALIVE
+        self._subscriptions = collections.OrderedDict()
+        self._next_packet_id = 0
+        # QoS 1 packet id -> callback waiting for its PUBACK
+        self._pending_acks = {}
+        self._reader = None
+        self._writer = None
+        self._tasks = []
+        self._reconnect_task = None
+        # (message, callbacks) waiting for the dispatch task, created on the event loop
+        self._inbox = None
+        self._dispatch_task = None
+        # Event loop time of the last packet received
+        self._last_received = 0
+        self._connected = False
+        self._closing = False
+
+    def configure_credentials(self, ca_path, key_path, cert_path):
+        context = ssl.create_default_context(cafile=ca_path)
+        context.load_cert_chain(cert_path, key_path)
+
+        if self.port == 443:
+            context.set_alpn_protocols([AWS_IOT_ALPN_PROTOCOL])
+
+        self._ssl_context = context
+
+    def configure_last_will(self, topic, payload, qos):
+        self._will = (topic, payload, qos)
+
+    def configure_offline_queue(self, size, drop_oldest=True):
+        self._offline_queue_size = size
+        self._offline_drop_oldest = drop_oldest
+
+    def configure_draining_frequency(self, frequency):
+        self._draining_delay = 1.0 / frequency
+
+    def configure_timeouts(self, connect_disconnect, operation):
+        self._connect_timeout = connect_disconnect
+        self._operation_timeout = operation
+
+    def configure_reconnect(self, reconnect_delay, on_reconnected=None, on_connection_lost=None):
+        self._reconnect_delay = reconnect_delay
+        self._on_reconnected = on_reconnected
+        self._on_connection_lost = on_connection_lost
+
+    def is_connected(self):
+        return self._connected
+
+    def connect(self, keep_alive=DEFAULT_KEEP_ALIVE):
+        self._keep_alive = keep_alive
+        self._closing = False
+        future = asyncio.run_coroutine_threadsafe(self._connect(), self._loop)
+
+        return future.result(self._connect_timeout + self._operation_timeout)
+
+    def disconnect(self):
+        future = asyncio.run_coroutine_threadsafe(self._disconnect(), self._loop)
+
+        return future.result(self._connect_timeout)
+
+    def publish(self, topic, payload, qos, ack_callback=None):
+        self._loop.call_soon_threadsafe(self._publish, topic, payload, qos, ack_callback)
+
+        return True
+
+    def subscribe(self, topic, qos, callback):
+        self._loop.call_soon_threadsafe(self._subscribe, topic, qos, callback)
+
+        return True
+
+    async def _connect(self):
+        await self._close_connection()
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.endpoint, self.port, ssl=self._ssl_context), self._connect_timeout)
+
+        try:
+            writer.write(encode_connect(self.client_id, self._keep_alive, will=self._will))
+            # A broker can also close the connection instead of answering, e.g. a throttled CONNECT
+            header, body = await asyncio.wait_for(read_packet(reader), self._connect_timeout)
+
+            if header & 0xF0 != CONNACK or body[1] != 0:
+                raise ConnectionError("Connection refused, CONNACK '{}'".format(body.hex()))
+        except BaseException:
+            writer.close()
+            raise
+
+        self._reader = reader
+        self._writer = writer
+        self._last_received = self._loop.time()
+        self._connected = True
+
+        if self._dispatch_task is None:
+            self._inbox = asyncio.Queue()
+            self._dispatch_task = self._loop.create_task(self._dispatch_loop())
+        self._tasks = [self._loop.create_task(self._read_loop()), self._loop.create_task(self._keep_alive_loop())]
+
+        # Clean session: subscriptions are restored on every connection
+        if self._subscriptions:
+            topics = [(topic, qos) for topic, (qos, _) in self._subscriptions.items()]
+            writer.write(encode_subscribe(self._packet_id(), topics))
+
+        if self._offline_queue:
+            self._tasks.append(self._loop.create_task(self._drain_offline_queue()))
+
+        return True
+
+    async def _disconnect(self):
+        self._closing = True
+
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+
+        if self._dispatch_task is not None:
+            self._dispatch_task.cancel()
+            self._dispatch_task = None
+
+        if self._connected:
+            self._writer.write(encode_disconnect())
+
+        await self._close_connection()
+
+        return True
+
+    async def _close_connection(self):
+        self._connected = False
+
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+
+        self._tasks = []
+
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                pass
+
+            self._writer = None
+
+    def _packet_id(self):
+        self._next_packet_id = self._next_packet_id % 65535 + 1
+
+        return self._next_packet_id
+
+    def _publish(self, topic, payload, qos, ack_callback=None):
+        self._count_out(payload)
+        packet_id = self._packet_id() if qos else None
+        packet = encode_publish(topic, payload, qos, packet_id)
+
+        if packet_id and ack_callback is not None:
+            self._pending_acks[packet_id] = ack_callback
+
+        if self._connected:
+            self._writer.write(packet)
+        elif self._offline_queue_size != 0:
+            if len(self._offline_queue) == self._offline_queue_size:
+                self.offline_dropped += 1
+
+                if not self._offline_drop_oldest:
+                    return
+
+                self._offline_queue.popleft()
+
+            self._offline_queue.append(packet)
+
+    def _subscribe(self, topic, qos, callback):
+        self._subscriptions[topic] = (qos, callback)
+
+        if self._connected:
+            self._writer.write(encode_subscribe(self._packet_id(), [(topic, qos)]))
+
+    async def _drain_offline_queue(self):
+        while self._offline_queue and self._connected:
+            self._writer.write(self._offline_queue.popleft())
+            await asyncio.sleep(self._draining_delay)
+
+    async def _keep_alive_loop(self):
+        # A half-open connection never fails a write: a broker silent for too long, PINGRESP
+        # included, is gone
+        next_ping = self._loop.time() + self._keep_alive
+
+        while self._connected:
+            await asyncio.sleep(self._keep_alive / 2)
+            now = self._loop.time()
+
+            if now - self._last_received >= KEEP_ALIVE_TIMEOUT * self._keep_alive:
+                self._log_event(" transport - No packet from the broker for {:.0f} seconds, closing the connection",
+                                now - self._last_received, level=device_log.WARNING)
+                # The read loop sees the connection end and reconnects
+                self._writer.transport.abort()
+                return
+
+            if now >= next_ping:
+                self._writer.write(encode_pingreq())
+                next_ping = now + self._keep_alive
+
+    async def _read_loop(self):
+        try:
+            while True:
+                header, body = await read_packet(self._reader)
+                self._last_received = self._loop.time()
+
+                if header & 0xF0 == PUBLISH:
+                    message, packet_id = decode_publish(header & 0x0F, body)
+
+                    if message.qos:
+                        self._writer.write(encode_puback(packet_id))
+
+                    self._dispatch(message)
+                elif header & 0xF0 == PUBACK:
+                    ack_callback = self._pending_acks.pop(struct.unpack("!H", body[:2])[0], None)
+
+                    if ack_callback is not None:
+                        ack_callback()
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+
+        if not self._closing:
+            await self._close_connection()
+
+            if self._on_connection_lost is not None:
+                self._on_connection_lost()
+
+            self._reconnect_task = self._loop.create_task(self._reconnect())
+
+    def _dispatch(self, message):
+        self._count_in(message)
+        callbacks = [callback for topic_filter, (_, callback) in self._subscriptions.items() if topic_matches(topic_filter, message.topic)]
+
+        if callbacks:
+            self._inbox.put_nowait((message, callbacks))
+
+    async def _dispatch_loop(self):
+        while True:
+            message, callbacks = await self._inbox.get()
+
+            for callback in callbacks:
+                try:
+                    if asyncio.iscoroutinefunction(callback):
+                        await callback(self, None, message)
+                    else:
+                        await self._loop.run_in_executor(None, callback, self, None, message)
+                except Exception as e:
+                    self._log_event(" transport - Callback '{}' failed on topic '{}' '{}: {}'", getattr(callback, "__name__", callback),
+                                    message.topic, type(e).__name__, e, level=device_log.ERROR)
+
+    async def _reconnect(self):
+        reconnect_delay = self._reconnect_delay or reconnect.ReconnectPolicy().next_delay
+
+        while not self._closing and not self._connected:
+            await asyncio.sleep(reconnect_delay())
+
+            try:
+                await self._connect()
+            except Exception as e:
+                # Whatever the failure, the next attempt follows
+                self._log_event(" transport - Reconnection failed '{}: {}'", type(e).__name__, e, level=device_log.WARNING)
+
+        if self._connected and self._on_reconnected is not None:
+            self._on_reconnected()
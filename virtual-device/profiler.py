@@ -0,0 +1,167 @@
+import collections
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import cProfile
+
+
+MODE_SAMPLE = "sample"
+MODE_CPROFILE = "cprofile"
+MODES = (MODE_SAMPLE, MODE_CPROFILE)
+
+DEFAULT_DURATION = 10
+MAX_DURATION = 120
+# Seconds between two samples of every thread stack
+DEFAULT_INTERVAL = 0.01
+
+# A single profile at a time, nothing runs when no profile is requested
+_running = threading.Lock()
+
+
+def _check_duration(duration):
+    if not 0 < duration <= MAX_DURATION:
+        raise ValueError("Profile duration must be between 0 and {} seconds".format(MAX_DURATION))
+
+
+def _frame_name(code):
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+def sample_stacks(duration, interval=DEFAULT_INTERVAL, by_thread=False):
+    """
+    Sample the stacks of every thread (device loops, MQTT callbacks, event loop, web server) for
+    `duration` seconds.
+
+    Parameters
+    ----------
+    duration: float
+        Seconds to sample for, at most MAX_DURATION
+    interval: float
+        Seconds between two samples
+    by_thread: bool
+        Root each stack at the name of its thread, otherwise identical stacks of different threads
+        (e.g. the loops of different devices) are merged
+
+    Returns
+    -------
+        collections.Counter of the number of samples of each stack, frames separated by ';' from the
+        outermost one
+    """
+    _check_duration(duration)
+
+    if interval <= 0:
+        raise ValueError("Sampling interval must be positive")
+
+    if not _running.acquire(False):
+        raise ValueError("A profile is already running")
+
+    try:
+        stacks = collections.Counter()
+        # Compiled once per code object, the same functions show up in every sample
+        names = {}
+        me = threading.get_ident()
+        deadline = time.monotonic() + duration
+
+        while time.monotonic() < deadline:
+            threads = dict((t.ident, t.name) for t in threading.enumerate()) if by_thread else None
+
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                stack = []
+
+                while frame is not None:
+                    code = frame.f_code
+                    name = names.get(code)
+
+                    if name is None:
+                        name = names[code] = _frame_name(code)
+
+                    stack.append(name)
+                    frame = frame.f_back
+
+                if by_thread:
+                    stack.append(threads.get(ident, str(ident)))
+
+                stack.reverse()
+                stacks[";".join(stack)] += 1
+
+            time.sleep(interval)
+
+        return stacks
+    finally:
+        _running.release()
+
+
+def collapse(stacks):
+    """Collapsed stacks format (``frame;frame;frame count`` lines), the input of flamegraph.pl and speedscope."""
+    return "".join("{} {}\n".format(stack, count) for stack, count in sorted(stacks.items()))
+
+
+def profiled(profile, handler):
+    """Wrap an event handler so it runs under `profile`, a cProfile.Profile."""
+    def run():
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one active cProfile per process, the other devices run unprofiled
+            return handler()
+
+        try:
+            return handler()
+        finally:
+            profile.disable()
+
+    return run
+
+
+def profile_devices(devices, duration):
+    """
+    Run the event handlers of `devices` under cProfile for `duration` seconds, each device with its
+    own profile in its own thread (see VirtualDevice.set_profile).
+
+    Returns
+    -------
+        The merged statistics, in the marshal format of pstats.Stats.dump_stats. Devices that ran
+        nothing under their profile (stopped, idle, or not profiled on Python 3.12+) are left out,
+        the statistics are empty if no device ran anything
+    """
+    _check_duration(duration)
+
+    if not _running.acquire(False):
+        raise ValueError("A profile is already running")
+
+    try:
+        profiles = []
+
+        for vd in devices:
+            profile = cProfile.Profile()
+            vd.set_profile(profile)
+            profiles.append(profile)
+
+        time.sleep(duration)
+
+        for vd in devices:
+            vd.set_profile(None)
+
+        stats = None
+
+        for profile in profiles:
+            # pstats.Stats raises TypeError for a profile without any call
+            profile.create_stats()
+
+            if not profile.stats:
+                continue
+
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+
+        return marshal.dumps(stats.stats if stats is not None else {})
+    finally:
+        _running.release()
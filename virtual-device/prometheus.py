@@ -0,0 +1,170 @@
+import collections
+
+import device_log
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "virtual_device_"
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    escaped = ('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+               for name, value in labels)
+
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+
+class Exposition(object):
+    """Exposition
+
+    Metric families in the Prometheus text format, samples are grouped by family whatever the
+    order they are added in.
+    """
+
+    def __init__(self):
+        self._families = collections.OrderedDict()
+
+    def _family(self, name, kind, help_text):
+        name = PREFIX + name
+
+        if name not in self._families:
+            self._families[name] = (kind, help_text, [])
+
+        return name, self._families[name][2]
+
+    def add(self, name, kind, help_text, value, **labels):
+        name, samples = self._family(name, kind, help_text)
+        samples.append((name, sorted(labels.items()), value))
+
+    def add_histogram(self, name, help_text, h, **labels):
+        """Add a histogram.Histogram, as cumulative buckets, sum and count."""
+        name, samples = self._family(name, HISTOGRAM, help_text)
+        labels = sorted(labels.items())
+
+        for bound, count in h.cumulative_counts():
+            samples.append((name + "_bucket", labels + [("le", _format_value(float(bound)))], count))
+
+        samples.append((name + "_sum", labels, h.sum))
+        samples.append((name + "_count", labels, h.count))
+
+    def render(self):
+        lines = []
+
+        for name, (kind, help_text, samples) in self._families.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+            for sample_name, labels, value in samples:
+                lines.append("{}{} {}".format(sample_name, _format_labels(labels), _format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+
+def collect_device(exposition, vd, device_type):
+    """Add the counters of a device (see VirtualDevice.get_stats and VirtualDevice.instruments)."""
+    stats = vd.get_stats()
+    instruments = vd.instruments
+    counts = instruments.snapshot()
+    device = vd.name
+    e = exposition
+
+    e.add("connected", GAUGE, "1 if the device has an MQTT connection", int(stats["connected"]), device=device, type=device_type)
+    e.add("connections_total", COUNTER, "Successful connections", stats["connections"], device=device)
+    e.add("reconnects_total", COUNTER, "Connections after the first one", max(0, stats["connections"] - 1), device=device)
+    e.add("connect_failures_total", COUNTER, "Failed connection attempts", stats["connect_failures"], device=device)
+
+    for topic_class, count in sorted(counts["published"].items()):
+        e.add("messages_published_total", COUNTER, "Messages handed to the MQTT client, per topic class", count,
+              device=device, topic_class=topic_class)
+        e.add("published_bytes_total", COUNTER, "Payload bytes published, per topic class",
+              counts["published_bytes"][topic_class], device=device, topic_class=topic_class)
+
+    for topic_class, count in sorted(counts["received"].items()):
+        e.add("messages_received_total", COUNTER, "Messages received by the device callbacks, per topic class", count,
+              device=device, topic_class=topic_class)
+        e.add("received_bytes_total", COUNTER, "Payload bytes received, per topic class",
+              counts["received_bytes"][topic_class], device=device, topic_class=topic_class)
+
+    e.add("publish_errors_total", COUNTER, "Publishes that raised an error", counts["publish_errors"], device=device)
+    e.add("unrouted_messages_total", COUNTER, "Received messages without a route, e.g. the requests of the device itself",
+          counts["unrouted"], device=device)
+    e.add("subscriptions", GAUGE, "Topic filters the MQTT connection is subscribed to", stats["subscriptions"], device=device)
+    e.add("decode_errors_total", COUNTER, "Received messages whose payload could not be decoded", counts["decode_errors"], device=device)
+    e.add("queue_depth", GAUGE, "Messages waiting in the publish queue", stats["queue_depth"], device=device)
+    e.add("queue_dropped_total", COUNTER, "Messages dropped by the publish queue policy", stats["queue_dropped"], device=device)
+    e.add("inflight", GAUGE, "QoS 1 publishes waiting for their PUBACK", stats["inflight"], device=device)
+    e.add("ack_timeouts_total", COUNTER, "QoS 1 publishes whose PUBACK never came", stats["ack_timeouts"], device=device)
+
+    if "journal_backlog" in stats:
+        e.add("journal_backlog", GAUGE, "Messages waiting in the journal", stats["journal_backlog"], device=device)
+
+    if "shadow_updates" in stats:
+        e.add("shadow_updates_published_total", COUNTER, "Shadow updates published by a switch", stats["shadow_updates_published"], device=device)
+        e.add("shadow_updates_coalesced_total", COUNTER, "Desired changes merged into a pending shadow update", stats["shadow_updates_coalesced"],
+              device=device)
+        e.add("shadow_updates_retried_total", COUNTER, "Shadow updates published again after a version conflict", stats["shadow_updates_retried"],
+              device=device)
+        e.add("shadow_updates_failed_total", COUNTER, "Shadow updates rejected for good", stats["shadow_updates_failed"], device=device)
+
+    if "reported_updates" in stats:
+        e.add("reported_updates_total", COUNTER, "Reported state updates published by an actuator", stats["reported_updates"], device=device)
+        e.add("reported_keys_total", COUNTER, "Keys of the reported state updates", stats["reported_keys"], device=device)
+        e.add("reported_document_keys_total", COUNTER, "Keys the reported state updates would carry with the whole state",
+              stats["reported_document_keys"], device=device)
+
+    if instruments.puback_latency is not None:
+        e.add_histogram("puback_latency_seconds", "Time from a QoS 1 publish to its PUBACK", instruments.puback_latency, device=device)
+
+    e.add_histogram("loop_tick_lag_seconds", "Delay between the deadline of an event and its handling", instruments.tick_lag,
+                    device=device)
+
+    for callback, h in sorted(counts["callback_duration"].items()):
+        e.add_histogram("callback_duration_seconds", "Execution time of the message callbacks", h, device=device, callback=callback)
+
+    for callback, count in sorted(counts["callback_errors"].items()):
+        e.add("callback_errors_total", COUNTER, "Message callbacks that raised an error", count, device=device, callback=callback)
+
+
+def render(host):
+    """Metrics of a DeviceHost and of its devices, in the Prometheus text format."""
+    e = Exposition()
+    devices = host.describe()
+
+    e.add("host_devices", GAUGE, "Devices hosted by the process", len(devices))
+    e.add("host_running_devices", GAUGE, "Hosted devices whose thread is running", sum(1 for d in devices if d["running"]))
+
+    admission = host.admission.get_stats()
+    e.add("admission_admitted_total", COUNTER, "Connection attempts admitted by the admission controller", admission["admitted"])
+    e.add("admission_connecting", GAUGE, "Devices expected to connect", admission["connecting"])
+
+    if admission["time_to_fully_connected"] is not None:
+        e.add("admission_time_to_fully_connected_seconds", GAUGE, "Time for the last wave of devices to be connected",
+              admission["time_to_fully_connected"])
+
+    shipper = device_log.get_shipper().get_counters()
+    e.add("log_buffered", GAUGE, "Log records waiting for the log shipper", shipper["log_buffered"])
+    e.add("log_shipped_total", COUNTER, "Log records written by the log shipper", shipper["log_shipped"])
+    e.add("log_dropped_total", COUNTER, "Log records dropped because the log shipper buffer was full", shipper["log_dropped"])
+
+    for d in devices:
+        try:
+            collect_device(e, host.get_device(d["name"]), d["type"])
+        except KeyError:
+            # Removed meanwhile
+            pass
+
+    return e.render()
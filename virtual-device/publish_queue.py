@@ -0,0 +1,214 @@
+import collections
+import threading
+import time
+
+import histogram
+
+
+POLICY_DROP_OLDEST = "drop-oldest"
+POLICY_DROP_NEWEST = "drop-newest"
+# Drops the oldest message of the lowest priority class, and drains higher classes first
+POLICY_PRIORITY = "priority"
+POLICIES = (POLICY_DROP_OLDEST, POLICY_DROP_NEWEST, POLICY_PRIORITY)
+
+# Lower values are more important
+PRIORITY_CRITICAL = 0   # tamper, errors, command replies
+PRIORITY_EVENT = 1      # events and Device Defender reports
+PRIORITY_TELEMETRY = 2
+PRIORITIES = (PRIORITY_CRITICAL, PRIORITY_EVENT, PRIORITY_TELEMETRY)
+
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_POLICY = POLICY_DROP_OLDEST
+# QoS 1 publishes waiting for their PUBACK
+DEFAULT_INFLIGHT_WINDOW = 20
+# Seconds after which a missing PUBACK (e.g. lost with the connection) frees its slot
+ACK_TIMEOUT = 30
+
+
+PendingPublish = collections.namedtuple("PendingPublish", ["topic", "payload", "qos", "priority"])
+
+
+class PublishQueue(object):
+    """PublishQueue
+
+    Bounded FIFO of outbound publishes for a single device. When the queue is full the policy
+    decides which message is lost, so a long outage costs at most `max_size` messages of memory.
+    Thread safe.
+    """
+
+    def __init__(self, max_size=DEFAULT_QUEUE_SIZE, policy=DEFAULT_POLICY):
+        self._lock = threading.Lock()
+        self._queues = dict((priority, collections.deque()) for priority in PRIORITIES)
+        self._size = 0
+        self.enqueued = 0
+        self.dequeued = 0
+        self.dropped = 0
+        self.configure(max_size, policy)
+
+    def configure(self, max_size, policy):
+        """
+        Change the size and the policy of the queue. Messages above the new size are dropped
+        according to the new policy.
+
+        Parameters
+        ----------
+        max_size: int
+            Maximum number of queued messages, at least 1
+        policy: string
+            One of POLICIES
+        """
+        if max_size < 1:
+            raise ValueError("Queue size must be at least 1")
+
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy '{}'".format(policy))
+
+        with self._lock:
+            self.max_size = max_size
+            self.policy = policy
+
+            while self._size > max_size:
+                self._evict(None)
+
+    def put(self, topic, payload, qos=0, priority=PRIORITY_TELEMETRY):
+        """
+        Queue a message.
+
+        Returns
+        -------
+            False if the message itself was dropped
+        """
+        if self.policy != POLICY_PRIORITY:
+            # Priorities only matter to the priority policy, the other ones are a single FIFO
+            priority = PRIORITY_TELEMETRY
+
+        with self._lock:
+            if self._size >= self.max_size and not self._evict(priority):
+                self.dropped += 1
+                return False
+
+            self._queues[priority].append(PendingPublish(topic, payload, qos, priority))
+            self._size += 1
+            self.enqueued += 1
+
+            return True
+
+    def _evict(self, priority):
+        """Make room for a message of `priority` (None: whatever the priority), False if it must be dropped instead."""
+        if self.policy == POLICY_DROP_NEWEST and priority is not None:
+            return False
+
+        for victim in reversed(PRIORITIES):
+            if self._queues[victim]:
+                if priority is not None and victim < priority:
+                    return False
+
+                if self.policy == POLICY_DROP_NEWEST:
+                    self._queues[victim].pop()
+                else:
+                    self._queues[victim].popleft()
+
+                self._size -= 1
+                self.dropped += 1
+
+                return True
+
+        return False
+
+    def get(self):
+        """Oldest message of the most important class, None when the queue is empty."""
+        with self._lock:
+            for priority in PRIORITIES:
+                if self._queues[priority]:
+                    self._size -= 1
+                    self.dequeued += 1
+
+                    return self._queues[priority].popleft()
+
+        return None
+
+    def __len__(self):
+        return self._size
+
+    def get_counters(self):
+        return {
+            "queue_depth": self._size,
+            "queue_size": self.max_size,
+            "queue_policy": self.policy,
+            "queue_enqueued": self.enqueued,
+            "queue_dequeued": self.dequeued,
+            "queue_dropped": self.dropped
+        }
+
+
+class InflightWindow(object):
+    """InflightWindow
+
+    Tracks the QoS 1 publishes waiting for their PUBACK, records the ack latencies and tells
+    when `size` publishes are in flight, so the publish queue stops draining until an ack frees
+    a slot. Thread safe, acks come from the transport threads.
+    """
+
+    def __init__(self, size=DEFAULT_INFLIGHT_WINDOW, timeout=ACK_TIMEOUT, on_ack=None, clock=time.monotonic):
+        self.configure(size)
+        self.timeout = timeout
+        self.on_ack = on_ack
+        self.latency = histogram.Histogram()
+        self.acked = 0
+        self.timeouts = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        self._next_token = 0
+
+    def configure(self, size):
+        if size < 1:
+            raise ValueError("In-flight window must be at least 1")
+
+        self.size = size
+
+    def track(self):
+        """Register a publish, returns the callback to call on its PUBACK."""
+        with self._lock:
+            self._next_token += 1
+            token = self._next_token
+            self._pending[token] = self._clock()
+
+        return lambda: self._ack(token)
+
+    def _ack(self, token):
+        with self._lock:
+            sent = self._pending.pop(token, None)
+
+            if sent is None:
+                return
+
+            self.acked += 1
+
+        self.latency.observe(self._clock() - sent)
+
+        if self.on_ack is not None:
+            self.on_ack()
+
+    def is_full(self):
+        with self._lock:
+            # Oldest first: expire the publishes whose ack is not coming
+            deadline = self._clock() - self.timeout
+
+            while self._pending and next(iter(self._pending.values())) < deadline:
+                self._pending.popitem(last=False)
+                self.timeouts += 1
+
+            return len(self._pending) >= self.size
+
+    def __len__(self):
+        return len(self._pending)
+
+    def get_counters(self):
+        return {
+            "inflight": len(self._pending),
+            "inflight_window": self.size,
+            "acked": self.acked,
+            "ack_timeouts": self.timeouts,
+            "ack_latency": self.latency.snapshot()
+        }
@@ -0,0 +1,98 @@
+import random
+import threading
+import time
+
+
+DEFAULT_BASE_DELAY = 1
+DEFAULT_MAX_DELAY = 60
+
+
+class ReconnectPolicy(object):
+    """ReconnectPolicy
+
+    Capped exponential backoff with full jitter: the n-th retry in a row waits a random delay
+    between 0 and min(max_delay, base_delay * 2^n) seconds, so devices disconnected together
+    don't come back in lockstep. Retries never stop, :meth:`interrupt` ends a pending wait.
+    Paces the first connection as well as the automatic reconnections of the transport.
+
+    Also counts connection attempts and the time spent connected.
+    """
+
+    def __init__(self, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY, clock=time.monotonic, rand=random.random):
+        if base_delay <= 0 or max_delay < base_delay:
+            raise ValueError("Invalid backoff delays '{}' / '{}'".format(base_delay, max_delay))
+
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._clock = clock
+        self._rand = rand
+        self._interrupted = threading.Event()
+        self._retries = 0
+        # Lost connection, the next delay is not one after a failed attempt
+        self._lost = False
+        self.attempts = 0
+        self.failures = 0
+        self.connections = 0
+        self._connected_since = None
+        self._connected_time = 0.0
+
+    def next_delay(self):
+        """Delay before the next attempt, after a failed one or a connection loss."""
+        if self._lost:
+            self._lost = False
+        else:
+            self.failures += 1
+
+        ceiling = min(self.max_delay, self.base_delay * 2 ** min(self._retries, 32))
+        self._retries += 1
+
+        return self._rand() * ceiling
+
+    def on_attempt(self):
+        self.attempts += 1
+
+    def on_connected(self):
+        self._retries = 0
+        self.connections += 1
+
+        if self._connected_since is None:
+            self._connected_since = self._clock()
+
+    def on_disconnected(self):
+        if self._connected_since is not None:
+            self._connected_time += self._clock() - self._connected_since
+            self._connected_since = None
+
+    def on_connection_lost(self):
+        self.on_disconnected()
+        self._lost = True
+
+    def wait(self, delay):
+        """Sleep `delay` seconds, returns False if interrupted."""
+        interrupted = self._interrupted.wait(delay)
+        self._interrupted.clear()
+
+        return not interrupted
+
+    def interrupt(self):
+        self._interrupted.set()
+
+    def clear_interrupt(self):
+        """Forget an interrupt no wait has seen, e.g. before the device starts again."""
+        self._interrupted.clear()
+
+    @property
+    def connected_duration(self):
+        """Seconds spent connected, current connection included."""
+        if self._connected_since is None:
+            return self._connected_time
+
+        return self._connected_time + self._clock() - self._connected_since
+
+    def get_counters(self):
+        return {
+            "connect_attempts": self.attempts,
+            "connect_failures": self.failures,
+            "connections": self.connections,
+            "connected_seconds": round(self.connected_duration, 3)
+        }
@@ -0,0 +1,233 @@
+import copy
+import threading
+import time
+import uuid
+
+from shadow_replica import merge_state
+
+
+# Seconds the changes of the actual state wait for later ones before they are reported
+DEFAULT_WINDOW = 0.5
+# Seconds a reported update waits for its reply before it is considered lost
+REPLY_TIMEOUT = 10
+# Rejected or lost updates reported again before their keys are given up, until the next change
+MAX_RETRIES = 3
+# Codes of update/rejected worth retrying: version conflict, throttling, service errors
+RETRYABLE_CODES = (409, 429, 500, 503)
+
+
+def count_keys(state):
+    """Number of leaf keys of a shadow state."""
+    return sum(count_keys(value) if isinstance(value, dict) and value else 1 for value in state.values())
+
+
+def diff_reported(actual, acknowledged):
+    """The reported update turning `acknowledged` into `actual`: the changed keys, None for the deleted ones."""
+    update = {}
+
+    for key, value in actual.items():
+        previous = acknowledged.get(key)
+
+        if isinstance(value, dict) and isinstance(previous, dict):
+            nested = diff_reported(value, previous)
+
+            if nested:
+                update[key] = nested
+        elif previous != value:
+            update[key] = copy.deepcopy(value)
+
+    for key in acknowledged:
+        if key not in actual:
+            update[key] = None
+
+    return update
+
+
+class ReportedStateEngine(object):
+    """ReportedStateEngine
+
+    Actual state of an actuator, reported to its shadow. The actuator follows the desired deltas
+    (:meth:`apply`); what it reports is the minimal diff between its actual state and the last
+    reported state acknowledged by the shadow, so an update carries only the changed keys. Changes
+    made within `window` seconds, or while an update is in flight, are batched into the next one.
+    The reported state belongs to the actuator: keys of the shadow it does not have are deleted.
+    Rejected updates are retried only for RETRYABLE_CODES, and at most `max_retries` times.
+    `send_update` is called with the documents to publish, outside the lock. Thread safe.
+
+    The owner runs :meth:`flush` after :meth:`next_flush` seconds, and after every reply.
+    """
+
+    def __init__(self, send_update, initial=None, window=DEFAULT_WINDOW, max_retries=MAX_RETRIES, clock=time.monotonic):
+        self._send_update = send_update
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.window = window
+        self.max_retries = max_retries
+        self._actual = copy.deepcopy(initial or {})
+        self._acknowledged = {}
+        # Time of the first change not reported yet
+        self._changed_since = self._clock() if self._actual else None
+        # (client token, reported diff, time sent) of the update in flight
+        self._inflight = None
+        self._retries = 0
+        self.changes = 0
+        self.batched = 0
+        self.updates = 0
+        self.keys = 0
+        self.document_keys = 0
+        self.failed = 0
+        self.retried = 0
+        self.timeouts = 0
+
+    @property
+    def actual(self):
+        with self._lock:
+            return copy.deepcopy(self._actual)
+
+    def _mark_changed(self):
+        if self._changed_since is None:
+            self._changed_since = self._clock()
+        else:
+            self.batched += 1
+
+    def apply(self, changes):
+        """Change the actual state, e.g. with a desired delta. None values delete their key."""
+        with self._lock:
+            self.changes += 1
+            merge_state(self._actual, changes)
+
+            if diff_reported(self._actual, self._acknowledged):
+                self._mark_changed()
+
+    def sync(self, reported, delta=None):
+        """
+        Catch up with the shadow, from a get/accepted or update/documents message.
+
+        Parameters
+        ----------
+        reported: dict
+            Reported state of the shadow, acknowledged as is, None keeps the acknowledged state
+        delta: dict
+            Desired state differing from the reported one, applied to the actual state
+        """
+        with self._lock:
+            if reported is not None:
+                self._acknowledged = copy.deepcopy(reported)
+
+            if delta:
+                self.changes += 1
+                merge_state(self._actual, delta)
+
+            if not diff_reported(self._actual, self._acknowledged):
+                self._changed_since = None
+            elif self._changed_since is None:
+                self._changed_since = self._clock()
+
+    def next_flush(self):
+        """Seconds until :meth:`flush` has something to do, None if it waits for a reply or for changes."""
+        with self._lock:
+            now = self._clock()
+
+            if self._inflight is not None:
+                return max(0, self._inflight[2] + REPLY_TIMEOUT - now)
+
+            if self._changed_since is None:
+                return None
+
+            return max(0, self._changed_since + self.window - now)
+
+    def flush(self):
+        """Report the changed keys if their window is over and no reply is awaited, True if published."""
+        with self._lock:
+            now = self._clock()
+
+            if self._inflight is not None:
+                if now - self._inflight[2] < REPLY_TIMEOUT:
+                    return False
+
+                self.timeouts += 1
+                self._inflight = None
+                self._retry(now)
+
+            if self._changed_since is None or now - self._changed_since < self.window:
+                return False
+
+            self._changed_since = None
+            reported = diff_reported(self._actual, self._acknowledged)
+
+            if not reported:
+                # Changed back meanwhile
+                return False
+
+            token = uuid.uuid4().hex
+            self._inflight = (token, reported, now)
+            self.updates += 1
+            self.keys += count_keys(reported)
+            self.document_keys += count_keys(self._actual)
+
+        self._send_update({"state": {"reported": reported}, "clientToken": token})
+
+        return True
+
+    def _pop_inflight(self, message):
+        if self._inflight is None or message.get("clientToken") != self._inflight[0]:
+            return None
+
+        reported = self._inflight[1]
+        self._inflight = None
+
+        return reported
+
+    def on_accepted(self, message):
+        """Handle an update/accepted message, acknowledging the keys of the update in flight."""
+        with self._lock:
+            reported = self._pop_inflight(message)
+
+            if reported is None:
+                return False
+
+            merge_state(self._acknowledged, reported)
+            self._retries = 0
+
+        return True
+
+    def _retry(self, now):
+        if self._retries >= self.max_retries:
+            # Given up, the keys are reported with the next change
+            self._retries = 0
+            return False
+
+        self._retries += 1
+        self.retried += 1
+
+        if self._changed_since is None:
+            self._changed_since = now
+
+        return True
+
+    def on_rejected(self, error):
+        """Handle an update/rejected message, the keys are reported again after the window if the error is retryable."""
+        with self._lock:
+            if self._pop_inflight(error) is None:
+                return False
+
+            self.failed += 1
+
+            if error.get("code") in RETRYABLE_CODES:
+                self._retry(self._clock())
+            else:
+                self._retries = 0
+
+        return True
+
+    def get_counters(self):
+        return {
+            "reported_changes": self.changes,
+            "reported_batched": self.batched,
+            "reported_updates": self.updates,
+            "reported_keys": self.keys,
+            "reported_document_keys": self.document_keys,
+            "reported_failed": self.failed,
+            "reported_retried": self.retried,
+            "reported_timeouts": self.timeouts
+        }
@@ -0,0 +1,129 @@
+import heapq
+import itertools
+import threading
+import time
+
+
+class Scheduler(object):
+    """Scheduler
+
+    A keyed timer heap driven by the monotonic clock.
+
+    Each key (e.g. "telemetry") has at most one pending deadline; scheduling a key again replaces its
+    previous deadline. A thread blocked in :meth:`wait` sleeps until the earliest deadline or until
+    :meth:`wake` is called, so an idle device costs no wakeups between events.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """Initialize an empty scheduler.
+
+        Parameters
+        ----------
+        clock : callable
+                Monotonic time source returning seconds as a float.
+        """
+        self._clock = clock
+        self._heap = []
+        self._pending = {}
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._woken = False
+        # Seconds between the deadline of the first event returned by the last wait() and its return
+        self.last_lag = 0.0
+
+    def schedule(self, key, delay):
+        """
+        Schedule `key` to be due `delay` seconds from now, replacing any pending deadline for it.
+
+        Parameters
+        ----------
+        key: hashable
+            Event name
+        delay: float
+            Seconds from now, negative values are treated as 0
+        """
+        with self._cond:
+            due = self._clock() + max(0, delay)
+            seq = next(self._counter)
+            self._pending[key] = seq
+            heapq.heappush(self._heap, (due, seq, key))
+            self._cond.notify()
+
+    def cancel(self, key):
+        """Drop the pending deadline for `key`, if any."""
+        with self._cond:
+            self._pending.pop(key, None)
+
+    def is_scheduled(self, key):
+        with self._cond:
+            return key in self._pending
+
+    def wake(self):
+        """Interrupt a pending :meth:`wait`, even if no event is due."""
+        with self._cond:
+            self._woken = True
+            self._cond.notify()
+
+    def wait(self, timeout=None):
+        """
+        Block until at least one event is due, :meth:`wake` is called or `timeout` expires.
+
+        Parameters
+        ----------
+        timeout: float
+            Maximum number of seconds to block, None blocks until an event or a wake-up.
+
+        Returns
+        -------
+            The list of due keys, in deadline order. Empty when woken up or timed out.
+        """
+        with self._cond:
+            deadline = None if timeout is None else self._clock() + timeout
+
+            while True:
+                now = self._clock()
+                due = self._pop_due(now)
+
+                if due or self._woken:
+                    self._woken = False
+                    return due
+
+                delay = self._next_delay(now)
+
+                if deadline is not None:
+                    remaining = deadline - now
+
+                    if remaining <= 0:
+                        return due
+
+                    delay = remaining if delay is None else min(delay, remaining)
+
+                self._cond.wait(delay)
+
+    def _pop_due(self, now):
+        due = []
+
+        while self._heap and self._heap[0][0] <= now:
+            deadline, seq, key = heapq.heappop(self._heap)
+
+            # Entries replaced by a later schedule() or cancel() are discarded lazily
+            if self._pending.get(key) == seq:
+                del self._pending[key]
+
+                if not due:
+                    self.last_lag = now - deadline
+
+                due.append(key)
+
+        return due
+
+    def _next_delay(self, now):
+        while self._heap:
+            due, seq, key = self._heap[0]
+
+            if self._pending.get(key) == seq:
+                return due - now
+
+            heapq.heappop(self._heap)
+
+        return None
@@ -0,0 +1,279 @@
+import concurrent.futures
+import copy
+import threading
+import time
+import uuid
+
+
+# Seconds after which a reconciliation get without reply can be sent again
+RECONCILE_TIMEOUT = 10
+# Seconds a get request waits for its reply before it fails, later callers send a new one
+GET_TIMEOUT = 5
+
+
+def merge_state(target, patch):
+    """Apply a partial shadow state to `target` in place, None values delete their key."""
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_state(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def diff_state(desired, reported):
+    """The part of `desired` that differs from `reported`, the delta computed by AWS IoT."""
+    delta = {}
+
+    for key, value in desired.items():
+        if isinstance(value, dict) and isinstance(reported.get(key), dict):
+            nested = diff_state(value, reported[key])
+
+            if nested:
+                delta[key] = nested
+        elif reported.get(key) != value:
+            delta[key] = copy.deepcopy(value)
+
+    return delta
+
+
+class ShadowReplica(object):
+    """ShadowReplica
+
+    Local copy of the classic shadow of a thing: a full document from a get, then kept up to date
+    from the update/documents and update/delta messages, so reading the shadow needs no get
+    request. Messages older than the replica are ignored; a delta that skips a version triggers a
+    single reconciliation get, through `request_get`, until its reply arrives or RECONCILE_TIMEOUT.
+    `on_change` is called after every change. Thread safe.
+
+    Gets are correlated with their reply by client token, see :meth:`request`. The owner runs
+    :meth:`expire` once the timeout of a get is over, to fail it if its reply never arrived.
+    """
+
+    def __init__(self, request_get=None, on_change=None, clock=time.monotonic):
+        self._request_get = request_get
+        self._on_change = on_change
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = {"desired": {}, "reported": {}, "delta": {}}
+        self.version = None
+        self._reconcile_sent = None
+        self._updated = None
+        # (client token, future, deadline) of the get in flight
+        self._pending_get = None
+        self.documents = 0
+        self.deltas = 0
+        self.stale = 0
+        self.reconciles = 0
+        self.gets = 0
+        self.coalesced = 0
+        self.cached = 0
+        self.timeouts = 0
+
+    @property
+    def synced(self):
+        return self.version is not None and self._reconcile_sent is None
+
+    def apply_document(self, document):
+        """Replace the replica with a full shadow document, the payload of get/accepted."""
+        state = document.get("state", {})
+
+        with self._lock:
+            if self.version is not None and document.get("version", 0) < self.version:
+                self.stale += 1
+                return False
+
+            self._state = {
+                "desired": copy.deepcopy(state.get("desired", {})),
+                "reported": copy.deepcopy(state.get("reported", {})),
+                "delta": copy.deepcopy(state.get("delta", {}))
+            }
+            self.version = document.get("version", 0)
+            self._reconcile_sent = None
+            self._updated = self._clock()
+            self.documents += 1
+
+        self._changed()
+
+        return True
+
+    def apply_documents(self, message):
+        """Apply an update/documents message, which carries the whole current state."""
+        current = message.get("current", {})
+        state = current.get("state", {})
+
+        with self._lock:
+            # The delta of the same update may have been applied already
+            if self.version is not None and current.get("version", 0) < self.version:
+                self.stale += 1
+                return False
+
+            desired = copy.deepcopy(state.get("desired", {}))
+            reported = copy.deepcopy(state.get("reported", {}))
+            self._state = {"desired": desired, "reported": reported, "delta": diff_state(desired, reported)}
+            self.version = current.get("version", 0)
+            self._reconcile_sent = None
+            self._updated = self._clock()
+            self.documents += 1
+
+        self._changed()
+
+        return True
+
+    def apply_delta(self, message):
+        """Apply an update/delta message in place, reconciling with a get if versions were missed."""
+        version = message.get("version", 0)
+
+        with self._lock:
+            if self.version is not None and version <= self.version:
+                self.stale += 1
+                return False
+
+            if self.version is None or version > self.version + 1:
+                reconcile = self._reconcile_sent is None or self._clock() - self._reconcile_sent > RECONCILE_TIMEOUT
+
+                if reconcile:
+                    self._reconcile_sent = self._clock()
+                    self.reconciles += 1
+            else:
+                reconcile = False
+
+            # Applied even across a gap, the reconciliation get fixes the rest
+            delta = message.get("state", {})
+            merge_state(self._state["desired"], delta)
+            merge_state(self._state["delta"], delta)
+            self.version = version
+            self._updated = self._clock()
+            self.deltas += 1
+
+        if reconcile and self._request_get is not None:
+            self._request_get()
+
+        self._changed()
+
+        return True
+
+    def request(self, max_age=None, timeout=GET_TIMEOUT):
+        """
+        Start a get of the shadow.
+
+        Parameters
+        ----------
+        max_age: float
+            Accept the replica if it is in sync and was updated at most `max_age` seconds ago
+        timeout: float
+            Seconds after which a get without reply fails, see :meth:`expire`, and no longer
+            coalesces the new requests
+
+        Returns
+        -------
+            (concurrent.futures.Future of the shadow document, client token of the get to publish).
+            The token is None when nothing must be published: the replica is recent enough, or a
+            get is already in flight and the future is shared with it.
+        """
+        expired = None
+
+        with self._lock:
+            now = self._clock()
+
+            if max_age is not None and self.synced and now - self._updated <= max_age:
+                self.cached += 1
+                future = concurrent.futures.Future()
+                future.set_result({"state": copy.deepcopy(self._state), "version": self.version})
+
+                return future, None
+
+            if self._pending_get is not None:
+                token, future, deadline = self._pending_get
+
+                if now < deadline:
+                    self.coalesced += 1
+                    return future, None
+
+                expired = future
+
+            token = uuid.uuid4().hex
+            future = concurrent.futures.Future()
+            self._pending_get = (token, future, now + timeout)
+            self.gets += 1
+
+        if expired is not None:
+            self._fail_expired(expired)
+
+        return future, token
+
+    def expire(self):
+        """
+        Fail the get in flight if its timeout is over.
+
+        Returns
+        -------
+            Seconds until the timeout of the get in flight, None if there is none anymore
+        """
+        with self._lock:
+            if self._pending_get is None:
+                return None
+
+            token, future, deadline = self._pending_get
+            left = deadline - self._clock()
+
+            if left > 0:
+                return left
+
+            self._pending_get = None
+
+        self._fail_expired(future)
+
+        return None
+
+    def _fail_expired(self, future):
+        if not future.done():
+            self.timeouts += 1
+            future.set_exception(concurrent.futures.TimeoutError("No reply to the shadow get"))
+
+    def resolve(self, token):
+        """Complete the get `token` with the replica, once get/accepted was applied."""
+        future = self._pop_pending(token)
+
+        if future is not None:
+            future.set_result(self.get_document())
+
+    def reject(self, token, error):
+        """Fail the get `token` with the error document of get/rejected."""
+        future = self._pop_pending(token)
+
+        if future is not None:
+            future.set_exception(RuntimeError("Shadow get rejected: {} {}".format(error.get("code"), error.get("message"))))
+
+    def _pop_pending(self, token):
+        with self._lock:
+            if token is None or self._pending_get is None or self._pending_get[0] != token:
+                return None
+
+            future = self._pending_get[1]
+            self._pending_get = None
+
+        return None if future.done() else future
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change()
+
+    def get_document(self):
+        """A copy of the replica, in the get/accepted format."""
+        with self._lock:
+            return {"state": copy.deepcopy(self._state), "version": self.version}
+
+    def get_counters(self):
+        return {
+            "shadow_version": self.version,
+            "shadow_documents": self.documents,
+            "shadow_deltas": self.deltas,
+            "shadow_stale": self.stale,
+            "shadow_reconciles": self.reconciles,
+            "shadow_gets": self.gets,
+            "shadow_gets_coalesced": self.coalesced,
+            "shadow_gets_cached": self.cached,
+            "shadow_gets_timeouts": self.timeouts
+        }
@@ -0,0 +1,223 @@
+import copy
+import threading
+import time
+import uuid
+
+
+# Seconds the desired changes wait for later ones before the update is published
+DEFAULT_WINDOW = 0.5
+# Version conflicts retried, with a fresh version, before the update is given up
+MAX_RETRIES = 3
+# Seconds an update or get waits for its reply before it is considered lost
+REPLY_TIMEOUT = 10
+# Code of update/rejected when the version of the update is not the version of the shadow
+VERSION_CONFLICT = 409
+
+
+def _merge(target, patch):
+    # Unlike shadow_replica.merge_state, None values are kept: they delete the key in the shadow
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+class ShadowUpdateWriter(object):
+    """ShadowUpdateWriter
+
+    Writes the desired state of a shadow, coalescing the changes made within `window` seconds into
+    a single update where the last value of each key wins. A single update is in flight at a time,
+    the changes made meanwhile wait for its reply. Updates carry the last known version of the
+    shadow: on a version conflict the writer gets the shadow for its version, through `send_get`,
+    and publishes the update again, at most `max_retries` times. `send_update` and `send_get` are
+    called with the documents to publish, outside the lock. Thread safe.
+
+    The owner runs :meth:`flush` after :meth:`next_flush` seconds, and after every reply.
+    """
+
+    def __init__(self, send_update, send_get, window=DEFAULT_WINDOW, max_retries=MAX_RETRIES, clock=time.monotonic):
+        self._send_update = send_update
+        self._send_get = send_get
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.window = None
+        self.set_window(window)
+        self.max_retries = max_retries
+        self.version = None
+        # Desired changes waiting for the window, and the time of the first one
+        self._pending = None
+        self._pending_since = None
+        # (client token, desired state, time sent) of the update in flight
+        self._inflight = None
+        # (client token, time sent) of the get for the version after a conflict
+        self._version_get = None
+        self._retries = 0
+        self.updates = 0
+        self.published = 0
+        self.coalesced = 0
+        self.accepted = 0
+        self.conflicts = 0
+        self.retried = 0
+        self.failed = 0
+        self.timeouts = 0
+
+    def set_window(self, window):
+        if window < 0:
+            raise ValueError("Shadow update window must be positive or 0")
+
+        self.window = window
+
+    def reset(self):
+        """Forget the pending changes, the update and get in flight and the version, e.g. for another shadow."""
+        with self._lock:
+            self.version = None
+            self._pending = None
+            self._pending_since = None
+            self._inflight = None
+            self._version_get = None
+            self._retries = 0
+
+    def update(self, desired):
+        """Queue changes of the desired state, e.g. {"status": "on"}."""
+        with self._lock:
+            self.updates += 1
+
+            if self._pending is None:
+                self._pending = {}
+                self._pending_since = self._clock()
+            else:
+                self.coalesced += 1
+
+            _merge(self._pending, desired)
+
+    def _requeue(self, desired):
+        # The changes of a failed attempt go back under the newer ones
+        pending = copy.deepcopy(desired)
+        _merge(pending, self._pending or {})
+
+        if self._pending is None:
+            self._pending_since = self._clock()
+
+        self._pending = pending
+
+    def _expire(self, now):
+        if self._inflight is not None and now - self._inflight[2] >= REPLY_TIMEOUT:
+            self.timeouts += 1
+            self._requeue(self._inflight[1])
+            self._inflight = None
+
+        if self._version_get is not None and now - self._version_get[1] >= REPLY_TIMEOUT:
+            self.timeouts += 1
+            self._version_get = None
+
+    def next_flush(self):
+        """Seconds until :meth:`flush` has something to do, None if it waits for a reply or for changes."""
+        with self._lock:
+            now = self._clock()
+
+            if self._inflight is not None:
+                return max(0, self._inflight[2] + REPLY_TIMEOUT - now)
+
+            if self._version_get is not None:
+                return max(0, self._version_get[1] + REPLY_TIMEOUT - now)
+
+            if self._pending is None:
+                return None
+
+            return max(0, self._pending_since + self.window - now)
+
+    def flush(self):
+        """Publish the pending changes if their window is over and no reply is awaited, True if published."""
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+
+            if self._pending is None or self._inflight is not None or self._version_get is not None:
+                return False
+
+            if now - self._pending_since < self.window:
+                return False
+
+            token = uuid.uuid4().hex
+            document = {"state": {"desired": self._pending}, "clientToken": token}
+
+            if self.version is not None:
+                document["version"] = self.version
+
+            self._inflight = (token, self._pending, now)
+            self._pending = None
+            self.published += 1
+
+        self._send_update(document)
+
+        return True
+
+    def on_accepted(self, message):
+        """Handle an update/accepted message, of this writer or of any other client of the shadow."""
+        with self._lock:
+            version = message.get("version")
+
+            if version is not None and (self.version is None or version > self.version):
+                self.version = version
+
+            if self._inflight is None or message.get("clientToken") != self._inflight[0]:
+                return False
+
+            self._inflight = None
+            self._retries = 0
+            self.accepted += 1
+
+        return True
+
+    def on_rejected(self, error):
+        """Handle an update/rejected message, getting a fresh version and retrying on a conflict."""
+        with self._lock:
+            if self._inflight is None or error.get("clientToken") != self._inflight[0]:
+                return False
+
+            desired = self._inflight[1]
+            self._inflight = None
+            conflict = error.get("code") == VERSION_CONFLICT
+
+            if conflict:
+                self.conflicts += 1
+
+            if not conflict or self._retries >= self.max_retries:
+                self.failed += 1
+                self._retries = 0
+                return True
+
+            self.retried += 1
+            self._retries += 1
+            self._requeue(desired)
+            token = uuid.uuid4().hex
+            self._version_get = (token, self._clock())
+
+        self._send_get({"clientToken": token})
+
+        return True
+
+    def on_get_reply(self, message, accepted=True):
+        """Handle a get/accepted or get/rejected message, the version to retry a conflicting update with."""
+        with self._lock:
+            if self._version_get is None or message.get("clientToken") != self._version_get[0]:
+                return False
+
+            self._version_get = None
+            # A rejected get (no shadow anymore) retries without version
+            self.version = message.get("version") if accepted else None
+
+        return True
+
+    def get_counters(self):
+        return {
+            "shadow_updates": self.updates,
+            "shadow_updates_published": self.published,
+            "shadow_updates_coalesced": self.coalesced,
+            "shadow_updates_accepted": self.accepted,
+            "shadow_updates_conflicts": self.conflicts,
+            "shadow_updates_retried": self.retried,
+            "shadow_updates_failed": self.failed,
+            "shadow_updates_timeouts": self.timeouts
+        }
@@ -0,0 +1,198 @@
+import threading
+
+import numpy as np
+
+
+# Samples precomputed per device at each refill
+BLOCK_SIZE = 64
+
+SIGNAL_OFF = "off"
+
+# Every profile is a mix of the same components, so a whole block is generated by a single
+# vectorized expression whatever the profiles of the devices:
+#   amplitude * sin(2 pi t / period) + drift * t + step * ((t // period) % 2) + noise * N(0, 1)
+#   + anomaly when U(0, 1) < anomaly_rate
+# t is the sample number of the device and values are offsets from the base value of its payload.
+PROFILES = {
+    "sine": {"amplitude": 5.0, "period": 60, "noise": 0.2},
+    "drift": {"drift": 0.01, "noise": 0.2},
+    "noise": {"noise": 1.0},
+    "step": {"step": 5.0, "period": 30},
+    "anomaly": {"noise": 0.5, "anomaly_rate": 0.01, "anomaly": 20.0}
+}
+
+PARAMETERS = ("amplitude", "period", "drift", "step", "noise", "anomaly_rate", "anomaly")
+
+
+class Signal(object):
+    """Signal
+
+    Handle on the slot of a device in a :class:`SignalBank`. The signal keeps its current block, so
+    taking a sample needs no lock; only moving to the next block goes through the bank. A signal is
+    sampled by a single thread, the one of its device.
+    """
+
+    def __init__(self, bank, slot, profile, block):
+        self.bank = bank
+        self.slot = slot
+        self.profile = profile
+        self._block = block
+        self._cursor = 0
+
+    @property
+    def cursor(self):
+        """Samples taken from the current block."""
+        return self._cursor
+
+    def next(self):
+        """Offset of the next sample from the base value."""
+        index = self._cursor
+
+        if index >= len(self._block):
+            self._block = self.bank.next_block(self.slot)
+            index = 0
+
+        self._cursor = index + 1
+
+        return self._block[index]
+
+    def release(self):
+        self.bank.release(self.slot)
+
+
+class SignalBank(object):
+    """SignalBank
+
+    Synthetic signals for all the devices of a process. Samples are precomputed in blocks of
+    BLOCK_SIZE per device, so taking a sample is a list lookup in the block of the device, without
+    lock. When a device reaches the end of its block, the next block of every device past the
+    middle of its own block is generated by the same vectorized call, so devices sampled at similar
+    rates share their refills.
+    """
+
+    def __init__(self, block_size=BLOCK_SIZE, seed=None):
+        self._block_size = block_size
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+        self._params = {name: np.zeros(0) for name in PARAMETERS}
+        # Sample number of the first sample of the next block of each slot
+        self._starts = np.zeros(0, dtype=np.int64)
+        self._active = np.zeros(0, dtype=bool)
+        self._signals = []
+        # Blocks generated ahead, taken by the signals when they reach the end of their block
+        self._next_blocks = []
+        self._free = []
+        self._grow(16)
+
+    def _grow(self, capacity):
+        added = capacity - len(self._signals)
+
+        for name in PARAMETERS:
+            self._params[name] = np.concatenate([self._params[name], np.full(added, 1.0 if name == "period" else 0.0)])
+
+        self._starts = np.concatenate([self._starts, np.zeros(added, dtype=np.int64)])
+        self._active = np.concatenate([self._active, np.zeros(added, dtype=bool)])
+        self._free += list(range(capacity - 1, len(self._signals) - 1, -1))
+        self._signals += [None] * added
+        self._next_blocks += [None] * added
+
+    def _fill(self, rows):
+        """Generate the next BLOCK_SIZE samples of `rows`, from the sample numbers in _starts."""
+        p = {name: values[rows, None] for name, values in self._params.items()}
+        t = self._starts[rows, None] + np.arange(self._block_size)
+        shape = t.shape
+
+        block = p["amplitude"] * np.sin(2 * np.pi * t / p["period"])
+        block += p["drift"] * t
+        block += p["step"] * ((t // p["period"]) % 2)
+        block += p["noise"] * self._rng.standard_normal(shape)
+        block += p["anomaly"] * (self._rng.random(shape) < p["anomaly_rate"])
+
+        self._starts[rows] += self._block_size
+
+        for row, samples in zip(rows.tolist(), block.tolist()):
+            self._next_blocks[row] = samples
+
+    def register(self, profile, **overrides):
+        """
+        Add a device to the bank.
+
+        Parameters
+        ----------
+        profile: string
+            One of PROFILES
+        overrides:
+            Values replacing the parameters of the profile, e.g. amplitude=2
+
+        Returns
+        -------
+            The :class:`Signal` of the device
+        """
+        if profile not in PROFILES:
+            raise ValueError("Unknown signal profile '{}'".format(profile))
+
+        params = dict(PROFILES[profile], **overrides)
+
+        for name in params:
+            if name not in PARAMETERS:
+                raise ValueError("Unknown signal parameter '{}'".format(name))
+
+        with self._lock:
+            if not self._free:
+                self._grow(len(self._signals) * 2)
+
+            slot = self._free.pop()
+
+            for name in PARAMETERS:
+                self._params[name][slot] = params.get(name, 1 if name == "period" else 0)
+
+            self._starts[slot] = 0
+            self._active[slot] = True
+            self._fill(np.array([slot]))
+            signal = Signal(self, slot, profile, self._next_blocks[slot])
+            self._next_blocks[slot] = None
+            self._signals[slot] = signal
+
+        return signal
+
+    def release(self, slot):
+        with self._lock:
+            if self._active[slot]:
+                self._active[slot] = False
+                self._signals[slot] = None
+                self._next_blocks[slot] = None
+                self._free.append(slot)
+
+    def next_block(self, slot):
+        """The next block of samples of `slot`, generated along with the next blocks of the devices past the middle of theirs."""
+        with self._lock:
+            if self._next_blocks[slot] is None:
+                # Cursors are read without the locks of their devices: they only choose the rows
+                half = self._block_size // 2
+                ahead = [signal is not None and self._next_blocks[row] is None and (row == slot or signal.cursor >= half)
+                         for row, signal in enumerate(self._signals)]
+                self._fill(np.flatnonzero(np.array(ahead, dtype=bool) & self._active))
+
+            block = self._next_blocks[slot]
+            self._next_blocks[slot] = None
+
+            return block
+
+    def __len__(self):
+        with self._lock:
+            return int(self._active.sum())
+
+
+_shared_bank = None
+_shared_bank_lock = threading.Lock()
+
+
+def get_shared_bank():
+    """The bank shared by every device of the process."""
+    global _shared_bank
+
+    with _shared_bank_lock:
+        if _shared_bank is None:
+            _shared_bank = SignalBank()
+
+        return _shared_bank
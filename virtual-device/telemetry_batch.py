@@ -0,0 +1,42 @@
+import json
+
+
+def encode_batch(samples):
+    """
+    Encode telemetry samples as a single JSON array payload.
+
+    Parameters
+    ----------
+    samples: list
+        List of (timestamp, payload) tuples, the timestamp in seconds since the epoch.
+
+    Returns
+    -------
+        A JSON array string, one ``{"ts": <timestamp>, "payload": <payload>}`` object per sample
+    """
+    return json.dumps([{"ts": ts, "payload": payload} for ts, payload in samples], separators=(',', ':'))
+
+
+def decode_batch(message):
+    """
+    Decode a telemetry message published by a virtual device, batched or not.
+
+    Consumers (e.g. a Lambda behind a rule) can use it to handle both formats.
+
+    Parameters
+    ----------
+    message: bytes, string, list or dict
+        The raw MQTT payload, or the already parsed JSON document
+
+    Returns
+    -------
+        A list of (timestamp, payload) tuples. Non batched messages give a single sample
+        with a None timestamp.
+    """
+    if isinstance(message, (bytes, bytearray, str)):
+        message = json.loads(message)
+
+    if isinstance(message, list):
+        return [(sample["ts"], sample["payload"]) for sample in message]
+
+    return [(None, message)]
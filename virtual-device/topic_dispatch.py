@@ -0,0 +1,191 @@
+import asyncio
+import json
+import threading
+
+import cbor
+
+
+CODEC_JSON = "json"
+CODEC_CBOR = "cbor"
+# Payload handed over as bytes
+CODEC_RAW = "raw"
+
+
+def decode_json(payload):
+    # json detects UTF-8 (or UTF-16/32) bytes itself, no intermediate str copy
+    return json.loads(payload)
+
+
+def decode_raw(payload):
+    return payload
+
+
+DECODERS = {
+    CODEC_JSON: decode_json,
+    CODEC_CBOR: cbor.loads,
+    CODEC_RAW: decode_raw
+}
+
+
+def split_filter(topic_filter):
+    """Levels of an MQTT topic filter, raising ValueError if its wildcards are misplaced."""
+    levels = tuple(topic_filter.split("/"))
+
+    for i, level in enumerate(levels):
+        if level == "#" and i != len(levels) - 1 or level not in ("+", "#") and ("+" in level or "#" in level):
+            raise ValueError("Invalid topic filter '{}'".format(topic_filter))
+
+    return levels
+
+
+def filter_covers(wide, narrow):
+    """Check whether every topic matching the filter `narrow` also matches the filter `wide`."""
+    wide_levels = wide.split("/")
+    narrow_levels = narrow.split("/")
+
+    for i, level in enumerate(wide_levels):
+        if level == "#":
+            return True
+
+        if i >= len(narrow_levels) or narrow_levels[i] == "#":
+            return False
+
+        if level != "+" and level != narrow_levels[i]:
+            return False
+
+    return len(wide_levels) == len(narrow_levels)
+
+
+class Message(object):
+    """A received message, with its payload decoded by the codec of its topic."""
+
+    __slots__ = ("topic", "payload", "qos", "size")
+
+    def __init__(self, topic, payload, qos, size):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.size = size
+
+
+class Route(object):
+    """Handler and codec of a topic filter."""
+
+    __slots__ = ("topic_filter", "handler", "codec", "decode", "name", "is_coroutine")
+
+    def __init__(self, topic_filter, handler, codec):
+        if codec not in DECODERS:
+            raise ValueError("Unknown codec '{}'".format(codec))
+
+        self.topic_filter = topic_filter
+        self.handler = handler
+        self.codec = codec
+        self.decode = DECODERS[codec]
+        self.name = getattr(handler, "__name__", str(handler))
+        self.is_coroutine = asyncio.iscoroutinefunction(handler)
+
+
+class _Node(object):
+
+    __slots__ = ("children", "route")
+
+    def __init__(self):
+        self.children = {}
+        self.route = None
+
+
+class TopicRouter(object):
+    """TopicRouter
+
+    Routes of the topics a device receives, in a trie of topic filter levels: finding the route of
+    a topic costs one dictionary lookup per level, whatever the number of routes. The most specific
+    filter wins, a level matches exactly before + and #. As in MQTT, wildcards at the first level do
+    not match the $ topics. Routes are added under a lock, matching takes none.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._lock = threading.Lock()
+        self._count = 0
+
+    def add(self, topic_filter, handler, codec=CODEC_JSON):
+        """Route the messages matching `topic_filter` to `handler`, decoded with `codec`, replacing its previous route."""
+        route = Route(topic_filter, handler, codec)
+
+        with self._lock:
+            node = self._root
+
+            for level in split_filter(topic_filter):
+                child = node.children.get(level)
+
+                if child is None:
+                    child = node.children[level] = _Node()
+
+                node = child
+
+            if node.route is None:
+                self._count += 1
+
+            node.route = route
+
+        return route
+
+    def match(self, topic):
+        """The route of `topic`, None if no filter matches it."""
+        return self._match(self._root, topic.split("/"), 0)
+
+    def _match(self, node, levels, i):
+        if i == len(levels):
+            if node.route is not None:
+                return node.route
+
+            # "a/#" matches "a" as well
+            child = node.children.get("#")
+
+            return child.route if child is not None else None
+
+        children = node.children
+        child = children.get(levels[i])
+
+        if child is not None:
+            route = self._match(child, levels, i + 1)
+
+            if route is not None:
+                return route
+
+        if i == 0 and levels[0].startswith("$"):
+            return None
+
+        child = children.get("+")
+
+        if child is not None:
+            route = self._match(child, levels, i + 1)
+
+            if route is not None:
+                return route
+
+        child = children.get("#")
+
+        return child.route if child is not None else None
+
+    def decode(self, message):
+        """
+        Find the route of an incoming message and decode its payload, once.
+
+        Returns
+        -------
+            (route, Message), route None if no filter matches the topic. Raises ValueError (or the
+            CBOR decoder error) if the payload cannot be decoded with the codec of the route
+        """
+        topic = str(message.topic)
+        route = self.match(topic)
+
+        if route is None:
+            return None, None
+
+        payload = message.payload
+
+        return route, Message(topic, route.decode(payload), message.qos, len(payload))
+
+    def __len__(self):
+        return self._count
@@ -1,16 +1,32 @@
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTShadowClient
+import asyncio
+import concurrent.futures
 import json
 import boto3
 import time
-import datetime
 import os
 import sys
 import random
 import string
 import psutil as ps
 from enum import Enum
+from instruments import DeviceInstruments
+import device_log
+import journal
 import metrics
+import profiler
+import publish_queue
+import reconnect
+import reported_state
+import shadow_replica
+import shadow_writer
+import signals
 import socket
+import re
+import threading
+from scheduler import Scheduler
+import mqtt_transport
+import telemetry_batch
+import topic_dispatch
 
 
 if sys.version[0:1] == '3':
@@ -24,6 +40,90 @@ DEFAULT_SAMPLING_DELAY = 60
 ## 300 (5 minutes) is the Default Device Metrics sampling best-practice, more frequent than this and you get throttled
 DEFAULT_DEVICE_METRICS_SAMPLING_DELAY = 300
 LOG_SIZE = 15000
+# Records per /log page
+LOG_PAGE_SIZE = 200
+# Each device keeps its credentials and shadow under <DEFAULT_FILES_ROOT>/<device name>
+DEFAULT_FILES_ROOT = "/tmp"
+# Messages per second drained from the publish queue, so a backlog doesn't burst out at once
+DEFAULT_DRAIN_RATE = 100
+# Publishes buffered by the MQTT client while disconnected, on top of the publish queue
+OFFLINE_QUEUE_SIZE = 100
+# Seconds between two checks of the connection while the publish queue waits for it
+QUEUE_RETRY_DELAY = 1
+# Journal replay: messages per second, messages per batch, and seconds between two checks while disconnected
+DEFAULT_REPLAY_RATE = 50
+REPLAY_BATCH = 50
+JOURNAL_RETRY_DELAY = 5
+# Mean delay between two rogue actions (the polling loop used to roll 1 in 1001 every 0.5 s)
+ROGUE_ACTION_MEAN_DELAY = 500
+
+DEFAULT_TELEMETRY_TOPIC = "dt/ac/company1/area1/{}/temp"
+# Basic Ingest sends messages straight to a rule action, skipping the message broker
+BASIC_INGEST_TOPIC = "$aws/rules/{}/{}"
+RULE_NAME_PATTERN = re.compile(r"^[a-zA-Z0-9_]+$")
+
+DEVICE_METRICS_FORMAT_JSON = "json"
+# Compact binary reports with short tag names, much smaller on the wire
+DEVICE_METRICS_FORMAT_CBOR = "cbor"
+
+# Topics of the thing itself, formatted once per device
+THING_TOPICS = {
+    # Every topic of the thing, a single subscription per connection (see VirtualDevice.subscribe)
+    "all": "$aws/things/{}/#",
+    "shadow_get": "$aws/things/{}/shadow/get",
+    "shadow_get_replies": "$aws/things/{}/shadow/get/+",
+    "shadow_update": "$aws/things/{}/shadow/update",
+    "shadow_update_accepted": "$aws/things/{}/shadow/update/accepted",
+    "shadow_update_rejected": "$aws/things/{}/shadow/update/rejected",
+    "shadow_update_documents": "$aws/things/{}/shadow/update/documents",
+    "shadow_update_delta": "$aws/things/{}/shadow/update/delta",
+    "jobs_get": "$aws/things/{}/jobs/get",
+    "jobs_get_replies": "$aws/things/{}/jobs/get/+",
+    "jobs_notify_next": "$aws/things/{}/jobs/notify-next",
+    "job_get_replies": "$aws/things/{}/jobs/+/get/+",
+    "jobs_start_next": "$aws/things/{}/jobs/start-next",
+    "jobs_start_next_replies": "$aws/things/{}/jobs/start-next/+",
+    "device_defender_json_replies": "$aws/things/{}/defender/metrics/json/+",
+    "device_defender_cbor_replies": "$aws/things/{}/defender/metrics/cbor/+"
+}
+
+# Topic classes with their own QoS
+TOPIC_CLASS_TELEMETRY = "telemetry"
+TOPIC_CLASS_DEVICE_DEFENDER = "device_defender"
+TOPIC_CLASS_JOBS = "jobs"
+TOPIC_CLASS_SHADOW = "shadow"
+TOPIC_CLASSES = (TOPIC_CLASS_TELEMETRY, TOPIC_CLASS_DEVICE_DEFENDER, TOPIC_CLASS_JOBS, TOPIC_CLASS_SHADOW)
+
+EVENT_TELEMETRY = "telemetry"
+EVENT_DEVICE_DEFENDER = "device_defender"
+EVENT_PENDING_PAYLOAD = "pending_payload"
+EVENT_ROGUE_ACTION = "rogue_action"
+EVENT_TELEMETRY_FLUSH = "telemetry_flush"
+EVENT_JOURNAL_REPLAY = "journal_replay"
+EVENT_SHADOW_WRITE = "shadow_write"
+EVENT_SHADOW_GET_TIMEOUT = "shadow_get_timeout"
+EVENT_SHADOW_UPDATE = "shadow_update"
+EVENT_REPORTED_STATE = "reported_state"
+# Shadow changes are written to the shadow file at most once per this many seconds
+SHADOW_WRITE_DELAY = 1
+# Seconds between the connection and the subscriptions in setup()
+SETUP_DELAY = 2
+# Job actions (certificate rotation, firmware update) running at the same time in the process
+JOB_ACTION_WORKERS = int(os.getenv("JOB_ACTION_WORKERS", "8"))
+
+_job_executor = None
+_job_executor_lock = threading.Lock()
+
+
+def get_job_executor():
+    """The executor of the blocking job actions, shared by the devices of the process and created on first use."""
+    global _job_executor
+
+    with _job_executor_lock:
+        if _job_executor is None:
+            _job_executor = concurrent.futures.ThreadPoolExecutor(JOB_ACTION_WORKERS, thread_name_prefix="job-action")
+
+        return _job_executor
 
 
 class JobStatus(Enum):
@@ -42,98 +142,478 @@ class VirtualDevice:
     _stop = False
     _sampling_delay = DEFAULT_SAMPLING_DELAY
     _device_metrics_sampling_delay = DEFAULT_DEVICE_METRICS_SAMPLING_DELAY
-    _next_message_time = datetime.datetime.now()
-    _next_device_defender_telemetry = datetime.datetime.now()
+    _device_metrics_format = DEVICE_METRICS_FORMAT_JSON
+    # Telemetry batching, disabled unless batch size > 1 or batch window > 0
+    _batch_size = 0
+    _batch_window = 0
     _mqtt_client = None
     _lwt_topic = None
     _lwt_message = None
     _clean_disconnect = True
     _log = None
     _force_reconnect = False
-    _pending_payloads = []
+    _drain_rate = DEFAULT_DRAIN_RATE
+    _offline_queue_size = OFFLINE_QUEUE_SIZE
+    _replay_rate = DEFAULT_REPLAY_RATE
+    # Copy of the shadow replica in <files dir>/shadow, written from the loop
+    _shadow_file = True
+    # Event handlers without profiling, while set_profile() wraps them
+    _unprofiled_handlers = None
+    # Connection admission shared with the other devices of the host (admission.AdmissionController), None to connect freely
+    admission = None
 
     # Class Attributes
     endpoint = "ep"
     name = "name"
     mqtt_port = DEFAULT_MQTT_PORT
-    mqtt_telemetry_topic = "dt/ac/company1/area1/{}/temp"
-    mqtt_device_defender_telemetry_topic = "$aws/things/{}/defender/metrics/json"
+    transport = mqtt_transport.DEFAULT_TRANSPORT
+    mqtt_device_defender_telemetry_topic = "$aws/things/{}/defender/metrics/{}"
 
-    shadow = {}
     unit = "metric" # "imperial"
-    payload = { "temp" : 30 }
+    default_payload = { "temp" : 30 }
+    # Synthetic signal added to the signal_field of the payload (see signals.PROFILES), "off" sends the cached payload as is
+    signal_profile = signals.SIGNAL_OFF
+    signal_field = "temp"
 
 
-    def __init__(self, name, endpoint):
+    def __init__(self, name, endpoint, files_dir=None):
         self.name = name
         self.endpoint = endpoint
         self.mqtt_port = DEFAULT_MQTT_PORT
-        self._log = MaxSizeList(LOG_SIZE)
-        self.first_sample = True
+        self.files_dir = files_dir or os.path.join(DEFAULT_FILES_ROOT, name)
+        self._basic_ingest_rule = None
+        self._thing_topics = {key: topic.format(name) for key, topic in THING_TOPICS.items()}
+        self.mqtt_telemetry_topic = DEFAULT_TELEMETRY_TOPIC
+        self._compile_device_defender_topic()
+        # Per-device copies, so several devices can live in the same process
+        self._publish_queue = publish_queue.PublishQueue()
+        self._qos = dict.fromkeys(TOPIC_CLASSES, 0)
+        self._inflight = publish_queue.InflightWindow(on_ack=self._on_publish_ack)
+        # Counters and histograms exported by /metrics
+        self.instruments = DeviceInstruments()
+        self.instruments.puback_latency = self._inflight.latency
+        # Handler and codec of each subscribed topic filter, and the filters subscribed to by the transport, see subscribe()
+        self._routes = topic_dispatch.TopicRouter()
+        self._subscriptions = []
+        self._next_drain = 0
+        self._journal = None
+        self._replay_waiting = False
+        self._reconnect_policy = reconnect.ReconnectPolicy()
+        self._telemetry_batch = []
+        self._shadow = shadow_replica.ShadowReplica(request_get=self.get_shadow, on_change=self._on_shadow_change)
+        self._log = device_log.RingLog(LOG_SIZE)
+        self.payload = dict(self.default_payload)
+        self._signal = None
+        self.set_signal(self.signal_profile)
+        self._scheduler = Scheduler()
+        self._event_handlers = {
+            EVENT_TELEMETRY: self.send_telemetry,
+            EVENT_DEVICE_DEFENDER: self.send_device_defender_metrics,
+            EVENT_PENDING_PAYLOAD: self.send_pending_payload,
+            EVENT_TELEMETRY_FLUSH: self.flush_telemetry,
+            EVENT_JOURNAL_REPLAY: self.replay_journal,
+            EVENT_SHADOW_WRITE: self.write_shadow_snapshot,
+            EVENT_SHADOW_GET_TIMEOUT: self.expire_shadow_get
+        }
 
         self.log("New virtual device...")
-        self.log("CLIENT_ID: '{}'".format(name))
-        self.log("ENDPOINT : '{}'".format(endpoint))
+        self.log("CLIENT_ID: '{}'", name)
+        self.log("ENDPOINT : '{}'", endpoint)
         ## The Device Defender scripts were written starting from: https://github.com/aws-samples/aws-iot-device-defender-agent-sdk-python/blob/master/AWSIoTDeviceDefenderAgentSDK/collector.py
         # Keep a copy of the last metric, if there is one, so we can calculate change in some metrics.
         self._last_metric = None
-        
+        self.device_defender_accepted = 0
+        self.device_defender_rejected = 0
 
-        # Logging method to print on stdout and store in memory for browser consumption
-    def log(self, msg):
-        ts = datetime.datetime.utcnow().isoformat()
-        msg_formatted = "{} - {}".format(ts, str(msg))
 
-        print(msg_formatted)
-        self._log.push(msg_formatted)
-    
+    # Records on the device log (see device_log.RingLog), formatted lazily: pass the arguments of the template, not a formatted string
+    def log(self, msg, *args, level=device_log.INFO):
+        self._log.log(level, msg, args)
+
 
-    def log_enter_callback(self, function_name, payload, topic, qos):
-        self.log(">{} - Received message '{}' on topic '{}' with QoS {}".format(function_name, str(payload), topic, str(qos)))
+    def log_enter_callback(self, function_name, message):
+        self.log(">{} - Received {} bytes on topic '{}' with QoS {}", function_name, message.size, message.topic, message.qos,
+                 level=device_log.DEBUG)
+
+
+    def set_log_level(self, level):
+        """Drop the records below `level`, one of device_log.LEVELS."""
+        self._log.level = device_log.parse_level(level)
+
+        return
 
 
     def get_log_list(self):
-        return self._log.get_list()
+        return [record.format() for record in self._log.records()]
+
+
+    def get_log_records(self, since=None, limit=LOG_PAGE_SIZE):
+        """
+        Formatted log records as (sequence number, line) pairs, oldest first.
+
+        Parameters
+        ----------
+        since: int
+            Sequence number of the first record, None for the last `limit` records
+        limit: int
+            Maximum number of records
+
+        Returns
+        -------
+            (records, cursor of the next records)
+        """
+        records, cursor = self._log.tail(limit) if since is None else self._log.since(since, limit)
+
+        return [(record.seq, record.format()) for record in records], cursor
+
+
+    def set_profile(self, profile):
+        """Run the event handlers of the loop under `profile`, a cProfile.Profile of this device only. None restores them."""
+        if profile is None:
+            if self._unprofiled_handlers is not None:
+                self._event_handlers = self._unprofiled_handlers
+                self._unprofiled_handlers = None
+
+            return
+
+        if self._unprofiled_handlers is None:
+            self._unprofiled_handlers = self._event_handlers
+
+        # Swapped as a whole, the loop picks the new handlers on its next event
+        self._event_handlers = dict((event, profiler.profiled(profile, handler)) for event, handler in self._unprofiled_handlers.items())
+
+
+    def get_stats(self):
+        stats = {"name": self.name, "connected": self._mqtt_client is not None and self._mqtt_client.is_connected()}
+
+        if self._mqtt_client is not None:
+            stats.update(self._mqtt_client.get_counters())
+
+        stats.update(self._publish_queue.get_counters())
+        stats.update(self._inflight.get_counters())
+        stats.update(self._reconnect_policy.get_counters())
+
+        if self._journal is not None:
+            stats.update(self._journal.get_counters())
+
+        stats.update(self._shadow.get_counters())
+        stats["subscriptions"] = len(self._subscriptions)
+        stats["routes"] = len(self._routes)
+
+        return stats
 
 
     def set_sampling_delay(self, sampling_delay):
-        self.log(">set_sampling_delay '{}'".format(sampling_delay))
+        self.log(">set_sampling_delay '{}'", sampling_delay)
+
+        if sampling_delay <= 0:
+            raise ValueError("Sampling delay must be greater than zero")
 
         self._sampling_delay = sampling_delay
-        self._next_message_time = datetime.datetime.now()
+        self._scheduler.schedule(EVENT_TELEMETRY, 0)
 
         return
 
     def set_device_metrics_sampling_delay(self, device_metrics_sampling_delay):
-        self.log(">set_device_metrics_sampling_delay '{}'".format(device_metrics_sampling_delay))
+        self.log(">set_device_metrics_sampling_delay '{}'", device_metrics_sampling_delay)
+
+        if device_metrics_sampling_delay <= 0:
+            raise ValueError("Device metrics sampling delay must be greater than zero")
 
         self._device_metrics_sampling_delay = device_metrics_sampling_delay
-        self._next_device_defender_telemetry = datetime.datetime.now()
+        self._scheduler.schedule(EVENT_DEVICE_DEFENDER, 0)
+
+        return
+
+    @property
+    def mqtt_telemetry_topic(self):
+        return self._mqtt_telemetry_topic
+
+
+    @mqtt_telemetry_topic.setter
+    def mqtt_telemetry_topic(self, topic):
+        self._mqtt_telemetry_topic = topic
+        self._compile_telemetry_topic()
+
+
+    @property
+    def payload(self):
+        return self._payload
+
+
+    @payload.setter
+    def payload(self, payload):
+        # Serialized once here, the telemetry loop publishes the cached bytes. Assign a new
+        # payload instead of changing the dictionary in place, or the cache goes stale.
+        self._payload = payload
+        self._payload_bytes = json.dumps(payload).encode("utf8")
+        self.log(" payload - Telemetry payload is now {}", self._payload_bytes.decode("utf8"))
+
+
+    def set_signal(self, profile):
+        """Drive the signal_field of the payload with a synthetic signal profile, "off" or None sends the static payload."""
+        self.log(">set_signal '{}'", profile)
+        previous = self._signal
+
+        if profile is None or profile == signals.SIGNAL_OFF:
+            self._signal = None
+        else:
+            self._signal = signals.get_shared_bank().register(profile)
+
+        if previous is not None:
+            previous.release()
+
+        return
+
+
+    def sample_payload(self):
+        """Payload of the next telemetry sample."""
+        if self._signal is None:
+            return self._payload
+
+        payload = dict(self._payload)
+        base = payload.get(self.signal_field)
+
+        if not isinstance(base, (int, float)):
+            base = 0
+
+        payload[self.signal_field] = round(base + self._signal.next(), 2)
+
+        return payload
+
+
+    @property
+    def basic_ingest_rule(self):
+        return self._basic_ingest_rule
+
+
+    def set_basic_ingest_rule(self, rule):
+        """Publish telemetry through Basic Ingest to the rule called `rule`, None goes back to the message broker."""
+        self.log(">set_basic_ingest_rule '{}'", rule)
+
+        if rule and not RULE_NAME_PATTERN.match(rule):
+            raise ValueError("Invalid rule name '{}'".format(rule))
+
+        self._basic_ingest_rule = rule or None
+        self._compile_telemetry_topic()
+
+        return
+
+
+    def _compile_telemetry_topic(self):
+        # Built once per change instead of on every publish
+        topic = self._mqtt_telemetry_topic.format(self.name)
+
+        if self._basic_ingest_rule:
+            topic = BASIC_INGEST_TOPIC.format(self._basic_ingest_rule, topic)
+
+        self._telemetry_topic = topic
+
+
+    def set_batching(self, batch_size, batch_window):
+        """
+        Pack telemetry samples into one message, published every `batch_size` samples or
+        `batch_window` seconds after the first sample of the batch, whichever comes first.
+        Use 0 to disable either limit.
+        """
+        self.log(">set_batching '{}' samples / '{}' seconds", batch_size, batch_window)
+
+        if batch_size < 0 or batch_window < 0:
+            raise ValueError("Batch size and window can't be negative")
+
+        self._batch_size = batch_size
+        self._batch_window = batch_window
+
+        # Whatever was collected under the previous settings goes out now
+        self._scheduler.schedule(EVENT_TELEMETRY_FLUSH, 0)
+
+        return
+
+
+    def is_batching(self):
+        return self._batch_size > 1 or self._batch_window > 0
+
+
+    def set_device_metrics_format(self, device_metrics_format):
+        self.log(">set_device_metrics_format '{}'", device_metrics_format)
+
+        if device_metrics_format not in (DEVICE_METRICS_FORMAT_JSON, DEVICE_METRICS_FORMAT_CBOR):
+            raise ValueError("Unknown Device Defender metrics format '{}'".format(device_metrics_format))
+
+        self._device_metrics_format = device_metrics_format
+        self._compile_device_defender_topic()
+
+        return
+
+
+    def _compile_device_defender_topic(self):
+        self._device_defender_topic = self.mqtt_device_defender_telemetry_topic.format(self.name, self._device_metrics_format)
+
+
+    def _thing_topic(self, key, thing_name):
+        if thing_name == self.name:
+            return self._thing_topics[key]
+
+        return THING_TOPICS[key].format(thing_name)
+
+
+    def set_qos(self, topic_class, qos):
+        """QoS (0 or 1) of the publishes of `topic_class`, one of TOPIC_CLASSES."""
+        self.log(">set_qos '{}' '{}'", topic_class, qos)
+
+        if topic_class not in TOPIC_CLASSES:
+            raise ValueError("Unknown topic class '{}'".format(topic_class))
+
+        if qos not in (0, 1):
+            raise ValueError("QoS must be 0 or 1")
+
+        self._qos[topic_class] = qos
+
+        return
+
+
+    def set_inflight_window(self, size):
+        """Maximum number of QoS 1 publishes waiting for their PUBACK before the publish queue stops draining."""
+        self.log(">set_inflight_window '{}'", size)
+        self._inflight.configure(size)
+        self._scheduler.schedule(EVENT_PENDING_PAYLOAD, 0)
+
+        return
+
+
+    @property
+    def drain_rate(self):
+        return self._drain_rate
+
+
+    def set_publish_queue(self, size, policy, drain_rate):
+        """
+        Bound the outbound publish queue to `size` messages, dropping according to `policy`
+        (see publish_queue.POLICIES) and draining `drain_rate` messages per second, 0 for no limit.
+        """
+        self.log(">set_publish_queue size '{}' / policy '{}' / drain rate '{}'", size, policy, drain_rate)
+
+        if drain_rate < 0:
+            raise ValueError("Drain rate can't be negative")
+
+        self._publish_queue.configure(size, policy)
+        self._drain_rate = drain_rate
+        self._scheduler.schedule(EVENT_PENDING_PAYLOAD, 0)
 
         return
 
+
+    def set_journal(self, enabled, replay_rate=None):
+        """
+        Store the publishes made while disconnected in an on-disk journal (<files_dir>/journal.db),
+        replayed at `replay_rate` messages per second once connected. The journal is kept across
+        restarts, disabling it only closes it.
+        """
+        self.log(">set_journal '{}' / replay rate '{}'", enabled, replay_rate)
+
+        if replay_rate is not None:
+            if replay_rate <= 0:
+                raise ValueError("Replay rate must be greater than zero")
+
+            self._replay_rate = replay_rate
+
+        if enabled and self._journal is None:
+            self._journal = journal.Journal(self.file_path("journal.db"))
+            self.log(" set_journal - {} messages to replay", len(self._journal))
+            self._scheduler.schedule(EVENT_JOURNAL_REPLAY, 0)
+        elif not enabled and self._journal is not None:
+            self._scheduler.cancel(EVENT_JOURNAL_REPLAY)
+            self._journal.close()
+            self._journal = None
+
+        return
+
+
     def force_reconnect(self):
         self._force_reconnect = True
+        self._scheduler.wake()
 
 
     def set_clean_disconnect(self, clean):
         self._clean_disconnect = clean
 
 
-    def get_shadow(self, thing_name):
-        self.log(">get_shadow")
-        self._mqtt_client.publish("$aws/things/{}/shadow/get".format(thing_name), "", 0)
+    @property
+    def shadow(self):
+        """The shadow of the device, as kept by its replica."""
+        return self._shadow.get_document()
+
+
+    def get_shadow(self, thing_name=None, max_age=None, timeout=shadow_replica.GET_TIMEOUT):
+        """
+        Get the shadow of the device.
+
+        Parameters
+        ----------
+        thing_name: string
+            Name of the device, the replies of the gets of other things are not received
+        max_age: float
+            Seconds since the last update of the replica within which it is returned without a get,
+            None always gets the shadow from the broker
+        timeout: float
+            Seconds to wait for the reply, concurrent callers share the get in flight meanwhile. While
+            the device runs, the future then fails with concurrent.futures.TimeoutError
+
+        Returns
+        -------
+            A concurrent.futures.Future of the shadow document
+        """
+        if thing_name not in (None, self.name):
+            raise ValueError("Only the shadow of '{}' can be read".format(self.name))
+
+        future, client_token = self._shadow.request(max_age, timeout)
+
+        if client_token is not None:
+            self.log(">get_shadow - Publishing get '{}'", client_token)
+            self._send(self._thing_topics["shadow_get"], json.dumps({"clientToken": client_token}), self._qos[TOPIC_CLASS_SHADOW])
+            self._scheduler.schedule(EVENT_SHADOW_GET_TIMEOUT, timeout)
+
+        return future
+
+
+    def expire_shadow_get(self):
+        left = self._shadow.expire()
 
-        return self.shadow
+        if left is not None:
+            # A later get replaced the one of this event
+            self._scheduler.schedule(EVENT_SHADOW_GET_TIMEOUT, left)
+
+
+    def set_shadow_file(self, enabled):
+        """Keep (or stop keeping) a copy of the shadow in <files dir>/shadow."""
+        self.log(">set_shadow_file '{}'", enabled)
+        self._shadow_file = enabled
+
+        if enabled:
+            self._on_shadow_change()
+
+        return
+
+
+    def _on_shadow_change(self):
+        # Called from the MQTT callbacks, the file is written by the loop
+        if self._shadow_file and not self._scheduler.is_scheduled(EVENT_SHADOW_WRITE):
+            self._scheduler.schedule(EVENT_SHADOW_WRITE, SHADOW_WRITE_DELAY)
+
+
+    def write_shadow_snapshot(self):
+        if self._shadow_file and self._shadow.version is not None:
+            self.write_shadow_file(self.shadow)
 
 
     def get_jobs(self, thing_name):
-        self.log(">get_jobs / Publishing empty message to '{}'".format("$aws/things/{}/jobs/get".format(thing_name)))
-        self._mqtt_client.publish("$aws/things/{}/jobs/get".format(thing_name), "", 0)
+        topic = self._thing_topic("jobs_get", thing_name)
+        self.log(">get_jobs / Publishing empty message to '{}'", topic)
+        self._send(topic, "", self._qos[TOPIC_CLASS_JOBS])
 
 
     def start_next_queued_job(self):
-        self.log(">start_next_queued_job / Publish message to '{}'".format("$aws/things/{}/jobs/start-next".format(self.name)))
+        self.log(">start_next_queued_job / Publish message to '{}'", self._thing_topics["jobs_start_next"])
 
         req = {
             "statusDetails": {
@@ -142,8 +622,8 @@ class VirtualDevice:
             "stepTimeoutInMinutes": 1,
         }
 
-        self._mqtt_client.publish("$aws/things/{}/jobs/start-next".format(self.name), json.dumps(req), 0)
-        self.log("<start_next_queued_job".format())
+        self._send(self._thing_topics["jobs_start_next"], json.dumps(req), self._qos[TOPIC_CLASS_JOBS])
+        self.log("<start_next_queued_job")
 
         return
 
@@ -163,51 +643,55 @@ class VirtualDevice:
         return req
 
 
-    def handle_jobs_start_next_callback(self, client, mid, message):
-        self.log_enter_callback("handle_jobs_start_next_callback", message.payload, message.topic, message.qos)
+    async def handle_jobs_start_next_callback(self, message):
         self.log(" handle_jobs_start_next_callback - Doing stuff...")
 
-        my_json = message.payload.decode("utf8").replace("'", '"')
-        payload = json.loads(my_json)
+        payload = message.payload
 
-        self.log(" handle_jobs_start_next_callback\n{}".format(json.dumps(payload, indent=4, sort_keys=True)))
+        self.log(" handle_jobs_start_next_callback\n{}", device_log.Json(payload, indent=4, sort_keys=True), level=device_log.DEBUG)
 
         job_id = payload["execution"]["jobId"]
         job_doc = payload["execution"]["jobDocument"]
         version = payload["execution"]["versionNumber"]
 
-        self.log(" handle_jobs_start_next_callback - JOB_ID: '{}' JOB_VERSION: '{}'".format(job_id, version))
-        self.log(" handle_jobs_start_next_callback - JOB_DOC:\n\n{}\n\n".format(json.dumps(job_doc, indent=4, sort_keys=True)))
+        self.log(" handle_jobs_start_next_callback - JOB_ID: '{}' JOB_VERSION: '{}'", job_id, version)
+        self.log(" handle_jobs_start_next_callback - JOB_DOC:\n\n{}\n\n", device_log.Json(job_doc, indent=4, sort_keys=True))
 
+        response = False
+        loop = asyncio.get_running_loop()
+
+        # Job actions download files and sleep, so they run in their own executor instead of the shared event loop,
+        # or the default executor, which runs the message callbacks of the asyncio transports
         if "action" in job_doc:
             action = job_doc["action"]
 
             if action.lower() == "rotate-cert":
                 self.log(" handle_jobs_start_next_callback - Rotating cert...")
-                response = self.rotate_certificate(job_doc)
+                response = await loop.run_in_executor(get_job_executor(), self.rotate_certificate, job_doc)
             elif action.lower() == "change-unit":
                 self.log(" handle_jobs_start_next_callback - Changing unit...")
                 response = self.change_unit(job_doc)
             elif action.lower() == "update-firmware":
                 self.log(" handle_jobs_start_next_callback - Updating firmware...")
-                response = self.update_firmware(job_doc)
+                response = await loop.run_in_executor(get_job_executor(), self.update_firmware, job_doc)
             else:
-                self.log(" handle_jobs_start_next_callback - Unknown action '{}'".format(action))
-                response = False
+                self.log(" handle_jobs_start_next_callback - Unknown action '{}'", action)
 
         req = self.generate_job_start_response_doc(response, version, 1)
 
-        self.log(" handle_jobs_start_next_callback - Finished the requested action - Success? {}".format(response))
-        self.log(" handle_jobs_start_next_callback - Response Doc: \n\n{}\n\n".format(json.dumps(req, indent=4, sort_keys=True)))
+        self.log(" handle_jobs_start_next_callback - Finished the requested action - Success? {}", response)
+        self.log(" handle_jobs_start_next_callback - Response Doc: \n\n{}\n\n", device_log.Json(req, indent=4, sort_keys=True))
 
-        self._mqtt_client.publish("$aws/things/{}/jobs/{}/update".format(self.name, job_id), json.dumps(req), 0)
+        self._send("$aws/things/{}/jobs/{}/update".format(self.name, job_id), json.dumps(req), self._qos[TOPIC_CLASS_JOBS])
 
-        self.log("<handle_jobs_start_next_callback - Notified / Published message to '{}'".format("$aws/things/{}/jobs/{}/update".format(self.name, job_id)))
+        self.log("<handle_jobs_start_next_callback - Notified / Published message to '{}'", "$aws/things/{}/jobs/{}/update".format(self.name, job_id))
 
 
     def stop(self):
         self.log(">stop")
         self._stop = True
+        self._scheduler.wake()
+        self._reconnect_policy.interrupt()
 
 
     def change_unit(self, job_doc):
@@ -222,31 +706,41 @@ class VirtualDevice:
         return
 
 
-    def handle_shadow_update_callback(self, client, mid, message):
-        self.log_enter_callback("handle_shadow_update_callback", message.payload, message.topic, message.qos)
+    def handle_shadow_update_callback(self, message):
+        payload = message.payload
+
+        # update/documents: the whole state before and after the update
+        if not self._shadow.apply_documents(payload):
+            self.log(" handle_shadow_update_callback - Stale version '{}'", payload.get("current", {}).get("version"))
+
+        self.log("<handle_shadow_update_callback")
 
-        my_json = message.payload.decode("utf8").replace("'", '"')
-        payload = json.loads(my_json)
+        return
 
-        self.shadow = payload
 
-        with open("/tmp/shadow", "w") as file:
-            file.write("%s" % json.dumps(payload))
+    def handle_shadow_delta_callback(self, message):
+        payload = message.payload
 
-        if "state" in payload:
-            if "desired" in payload["state"]:
-                self.log(payload["state"]["desired"])
+        if self._shadow.apply_delta(payload):
+            self.log(" handle_shadow_delta_callback - Desired changes {}", payload.get("state"))
 
-        self.log("<handle_shadow_update_callback")
+        self.log("<handle_shadow_delta_callback")
 
         return
 
 
-    def handle_cmd_reply_callback(self, client, mid, message):
-        self.log_enter_callback("handle_cmd_reply_callback", message.payload, message.topic, message.qos)
+    def write_shadow_file(self, shadow):
+        # Replaced at once, readers never see a partial file
+        path = self.file_path("shadow")
+
+        with open(path + ".tmp", "w") as file:
+            file.write("%s" % json.dumps(shadow))
+
+        os.replace(path + ".tmp", path)
+
 
-        my_json = message.payload.decode("utf8").replace("'", '"')
-        payload = json.loads(my_json)
+    def handle_cmd_reply_callback(self, message):
+        payload = message.payload
 
         if "type" in payload:
             type = payload["type"]
@@ -262,33 +756,46 @@ class VirtualDevice:
                 "status": "OK"
             }
 
-            self._mqtt_client.publish(response_topic, json.dumps(resp), 0)
+            self.add_pending_payload(response_topic, json.dumps(resp), publish_queue.PRIORITY_CRITICAL)
 
 
         self.log("<handle_cmd_reply_callback")
         return
 
 
+    def handle_device_defender_reply_callback(self, message):
+        # Replies use the format of the report: $aws/things/<name>/defender/metrics/<json|cbor>/<accepted|rejected>
+        payload = message.payload
+
+        if message.topic.endswith("/accepted"):
+            self.device_defender_accepted += 1
+            self.log(" handle_device_defender_reply_callback - Report accepted '{}'", payload, level=device_log.DEBUG)
+        else:
+            self.device_defender_rejected += 1
+            self.log(" handle_device_defender_reply_callback - Report rejected '{}'", payload, level=device_log.WARNING)
+
+        return
+
+
     def last_will(self):
         return
 
 
-    def handle_shadow_get_callback(self, client, mid, message):
-        self.log_enter_callback("handle_shadow_get_callback", message.payload, message.topic, message.qos)
+    # A coroutine, run on the shared event loop whatever the transport: the replica orders the gets
+    # and the updates by version, not by arrival
+    async def handle_shadow_get_callback(self, message):
+        topic = message.topic
 
-        topic = str(message.topic)
+        payload = message.payload
 
+        # Replies to the gets of other clients of the thing carry their token, or none
         if "rejected" in topic:
-            self.log(" handle_shadow_get_callback - Shadow get rejected")
+            self.log(" handle_shadow_get_callback - Shadow get rejected", level=device_log.WARNING)
+            self._shadow.reject(payload.get("clientToken"), payload)
         else:
             self.log(" handle_shadow_get_callback - Shadow get accepted")
-            my_json = message.payload.decode("utf8").replace("'", '"')
-            payload = json.loads(my_json)
-
-            self.shadow = payload
-
-            with open("/tmp/shadow", "w") as file:
-                file.write("%s" % json.dumps(payload))
+            self._shadow.apply_document(payload)
+            self._shadow.resolve(payload.get("clientToken"))
 
             if "state" in payload:
                 if "desired" in payload["state"]:
@@ -299,17 +806,14 @@ class VirtualDevice:
         return
 
 
-    def handle_jobs_get_callback(self, client, mid, message):
-        self.log_enter_callback("handle_jobs_get_callback", message.payload, message.topic, message.qos)
-
-        my_json = message.payload.decode("utf8").replace("'", '"')
-        payload = json.loads(my_json)
+    def handle_jobs_get_callback(self, message):
+        payload = message.payload
         queue_jobs = payload.get("queuedJobs")
         in_progress_jobs = payload.get("inProgressJobs")
 
-        self.log(" handle_jobs_get_callback - CLIENT_ID '{}'".format(self.name))
-        self.log(" handle_jobs_get_callback - QUEUE_JOBS '{}'".format(queue_jobs))
-        self.log(" handle_jobs_get_callback - IN_PROGRESS_JOBS '{}'".format(in_progress_jobs))
+        self.log(" handle_jobs_get_callback - CLIENT_ID '{}'", self.name)
+        self.log(" handle_jobs_get_callback - QUEUE_JOBS '{}'", queue_jobs)
+        self.log(" handle_jobs_get_callback - IN_PROGRESS_JOBS '{}'", in_progress_jobs)
 
         if queue_jobs:
             self.log(" handle_jobs_get_callback - There are jobs queued. Starting...")
@@ -322,11 +826,8 @@ class VirtualDevice:
         return
 
 
-    def handle_jobs_notify_next_callback(self, client, mid, message):
-        self.log_enter_callback("handle_jobs_notify_next_callback", message.payload, message.topic, message.qos)
-
-        my_json = message.payload.decode("utf8").replace("'", '"')
-        payload = json.loads(my_json)
+    def handle_jobs_notify_next_callback(self, message):
+        payload = message.payload
 
         if 'execution' in payload :
             self.log("<handle_jobs_notify_next_callback - Pending jobs found, processing...")
@@ -337,11 +838,8 @@ class VirtualDevice:
         return
 
 
-    def handle_job_get_callback(self, client, mid, message):
-        self.log_enter_callback("handle_job_get_callback", message.payload, message.topic, message.qos)
-
-        my_json = message.payload.decode("utf8").replace("'", '"')
-        payload = json.loads(my_json)
+    def handle_job_get_callback(self, message):
+        payload = message.payload
 
         return
 
@@ -358,20 +856,20 @@ class VirtualDevice:
             else:
                 firmware_file_url = job_doc['firmware_file_url']
 
-                self.log(" update_firmware - Downloading firmware from '{}'".format(firmware_file_url))
+                self.log(" update_firmware - Downloading firmware from '{}'", firmware_file_url)
                 response = urllib.urlopen(firmware_file_url)
-                self.log(" update_firmware - Downloaded\n{}".format(response.read()))
+                self.log(" update_firmware - Downloaded\n{}", response.read())
 
                 # Doing stuff
                 for i in range(1, 4):
-                    self.log(" update_firmware - Installing... {}".format(i))
+                    self.log(" update_firmware - Installing... {}", i)
                     time.sleep(2)
 
-                self.log(" update_firmware - Installed".format())
+                self.log(" update_firmware - Installed")
 
                 success = True
         except Exception as e:
-            self.log(e)
+            self.log(e, level=device_log.ERROR)
             success = False
 
         return success
@@ -399,72 +897,208 @@ class VirtualDevice:
                 success = True
 
         except Exception as e:
-            self.log(e)
+            self.log(e, level=device_log.ERROR)
             success = False
 
         return success
 
 
     # Connect to AWS IoT
-    def connect(self, mqtt_shadow_client):
+    def connect(self, mqtt_client):
+        """Connect, retrying with capped exponential backoff and full jitter until connected or stopped."""
         self.log(">connect")
 
-        connect_count = 0
-        r = None
+        while not self._stop:
+            r = None
 
-        try:
-            self.log(" connect - Trying to connect '{}' '{}'...".format(self.endpoint, self.mqtt_port))
-            r = mqtt_shadow_client.connect(30)
-        except Exception as e:
-            self.log(" connect - FAILED")
-            self.log(e)
+            if not self.wait_admission():
+                continue
 
-        while(not r and connect_count <= 10):
             try:
-                time.sleep(5)
-                self.log(" connect - Trying to connect '{}' '{}'...".format(self.endpoint, self.mqtt_port))
-                r = mqtt_shadow_client.connect()
-                connect_count += 1
+                self.log(" connect - Trying to connect '{}' '{}'...", self.endpoint, self.mqtt_port)
+                self._reconnect_policy.on_attempt()
+                r = mqtt_client.connect(30)
             except Exception as e:
-                self.log(" connect - FAILED")
-                self.log(e)
+                self.log(" connect - FAILED '{}'", e, level=device_log.ERROR)
 
-        connected = False
+            if r:
+                self._reconnect_policy.on_connected()
 
-        if (r):
-            self.log(" connect - Device '{}' connected!".format(self.name))
-            connected = True
-        else:
-            self.log(" connect - ERROR: Device '{}' NOT connected!".format(self.name))
+                if self.admission is not None:
+                    self.admission.on_connected(self.name)
+
+                self.log(" connect - Device '{}' connected!", self.name)
+                return True
+
+            delay = self._reconnect_policy.next_delay()
+            self.log(" connect - Retrying in {:.1f} seconds", delay)
+            self._reconnect_policy.wait(delay)
+
+        self.log(" connect - ERROR: Device '{}' NOT connected, stopped", self.name, level=device_log.ERROR)
+
+        return False
+
+
+    def wait_admission(self):
+        """Wait for a token of the admission controller, False if the device was stopped meanwhile."""
+        if self.admission is None:
+            return True
+
+        delay = self.admission.reserve()
+
+        if delay:
+            self.log(" wait_admission - Waiting {:.2f} seconds for admission", delay)
+
+        return self._reconnect_policy.wait(delay) if delay else True
+
+
+    # Transport callbacks of the automatic reconnections, from its threads or its event loop: they must not block
+    def reconnect_delay(self):
+        """Seconds the transport waits before its next automatic reconnection attempt."""
+        self._reconnect_policy.on_attempt()
+        delay = self._reconnect_policy.next_delay()
+
+        if self.admission is not None:
+            # The token is reserved now rather than after the backoff, the wait cannot block the transport
+            delay += self.admission.reserve()
+
+        self.log(" reconnect_delay - Reconnecting in {:.1f} seconds", delay)
+
+        return delay
+
+
+    def handle_connection_lost(self):
+        self.log(" handle_connection_lost - Connection lost", level=device_log.WARNING)
+        self._reconnect_policy.on_connection_lost()
 
-        return connected
+        if self.admission is not None:
+            # The time to fully connected then measures the reconnection wave
+            self.admission.expect(self.name)
+
+
+    def handle_reconnected(self):
+        self._reconnect_policy.on_connected()
+
+        if self.admission is not None:
+            self.admission.on_connected(self.name)
+
+        self.log(" handle_reconnected - Device '{}' reconnected!", self.name)
+        # The journal and the publish queue drain at once instead of at their next retry
+        self._scheduler.schedule(EVENT_JOURNAL_REPLAY, 0)
+
+        if len(self._publish_queue):
+            self._scheduler.schedule(EVENT_PENDING_PAYLOAD, 0)
 
 
     '''
     SHADOW TOPICS
-        $aws/things/{}/shadow/update/accepted
         $aws/things/{}/shadow/update/delta
         $aws/things/{}/shadow/update/documents
         $aws/things/{}/shadow/get/accepted
+        $aws/things/{}/shadow/get/rejected
     '''
     def setup_shadow_callbacks(self, thing_name):
-        # Subscribing only to accepted topics. In a production environment, the device should handle rejected messages as well.
-        self._mqtt_client.subscribe("$aws/things/{}/shadow/get/+".format(thing_name), 0, self.handle_shadow_get_callback)
-        self._mqtt_client.subscribe("$aws/things/{}/shadow/update/accepted".format(thing_name), 0, self.handle_shadow_update_callback)
+        # The replica starts from a get, then follows the documents and deltas of every update
+        self.subscribe(self._thing_topic("shadow_get_replies", thing_name), self.handle_shadow_get_callback)
+        self.subscribe(self._thing_topic("shadow_update_documents", thing_name), self.handle_shadow_update_callback)
+        self.subscribe(self._thing_topic("shadow_update_delta", thing_name), self.handle_shadow_delta_callback)
+
+
+    def subscribe(self, topic_filter, handler, codec=topic_dispatch.CODEC_JSON, qos=0):
+        """
+        Route the messages of `topic_filter` to `handler`, subscribing to it unless a subscription of
+        the device already covers it (e.g. $aws/things/<name>/#, see setup()).
+
+        Parameters
+        ----------
+        topic_filter: string
+            MQTT topic filter, with + and # wildcards
+        handler: function
+            Called with a topic_dispatch.Message, whose payload is already decoded. Coroutine
+            functions run on the shared event loop
+        codec: string
+            Payload format, one of topic_dispatch.DECODERS
+        """
+        self._routes.add(topic_filter, handler, codec)
+
+        if not any(topic_dispatch.filter_covers(subscription, topic_filter) for subscription in self._subscriptions):
+            self.subscribe_transport(topic_filter, qos)
+
+
+    def subscribe_transport(self, topic_filter, qos=0):
+        """Subscribe the MQTT connection to `topic_filter`, its messages are dispatched by the routes of the device."""
+        self.log(" subscribe_transport - Subscribing to '{}'", topic_filter)
+        self._subscriptions.append(topic_filter)
+        self._mqtt_client.subscribe(topic_filter, qos, self.dispatch_message)
+
+
+    # Transport callback of every subscription: the payload is decoded once, with the codec of its topic, and handed to its handler
+    def dispatch_message(self, client, userdata, message):
+        self.instruments.count_received(message)
+
+        try:
+            route, decoded = self._routes.decode(message)
+        except Exception as e:
+            self.instruments.count_decode_error()
+            self.log(" dispatch_message - Undecodable payload on topic '{}': {}", message.topic, e, level=device_log.WARNING)
+            return
+
+        if route is None:
+            # e.g. the requests of the device itself, which come back through $aws/things/<name>/#
+            self.instruments.count_unrouted()
+            self.log(" dispatch_message - No route for topic '{}'", message.topic, level=device_log.DEBUG)
+            return
+
+        self.log_enter_callback(route.name, decoded)
+
+        if route.is_coroutine:
+            # The handler reports its own errors, nothing waits for its future
+            asyncio.run_coroutine_threadsafe(self._run_handler_async(route, decoded), mqtt_transport.get_shared_loop())
+            return
+
+        start = time.perf_counter()
+
+        try:
+            route.handler(decoded)
+        except Exception as e:
+            self._handler_failed(route, decoded, e)
+        finally:
+            self.instruments.observe_callback(route.name, time.perf_counter() - start)
+
+
+    async def _run_handler_async(self, route, decoded):
+        start = time.perf_counter()
+
+        try:
+            await route.handler(decoded)
+        except Exception as e:
+            self._handler_failed(route, decoded, e)
+        finally:
+            self.instruments.observe_callback(route.name, time.perf_counter() - start)
+
+
+    def _handler_failed(self, route, decoded, e):
+        self.instruments.count_callback_error(route.name)
+        self.log(" dispatch_message - Handler '{}' failed on topic '{}' '{}: {}'", route.name, decoded.topic, type(e).__name__, e,
+                 level=device_log.ERROR)
 
 
     def setup_jobs_callbacks(self, thing_name):
-        self.log("Subscribing to '{}' with callback '{}'".format("$aws/things/{}/jobs/notify-next".format(thing_name), "handle_jobs_notify_next_callback"))
-        self._mqtt_client.subscribe("$aws/things/{}/jobs/notify-next".format(thing_name), 0, self.handle_jobs_notify_next_callback)
+        topic = self._thing_topic("jobs_notify_next", thing_name)
+        self.log("Routing '{}' to '{}'", topic, "handle_jobs_notify_next_callback")
+        self.subscribe(topic, self.handle_jobs_notify_next_callback)
 
-        self.log("Subscribing to '{}' with callback '{}'".format("$aws/things/{}/jobs/get/#".format(thing_name), "handle_jobs_get_callback"))
-        self._mqtt_client.subscribe("$aws/things/{}/jobs/get/#".format(thing_name), 0, self.handle_jobs_get_callback)
+        topic = self._thing_topic("jobs_get_replies", thing_name)
+        self.log("Routing '{}' to '{}'", topic, "handle_jobs_get_callback")
+        self.subscribe(topic, self.handle_jobs_get_callback)
 
-        self.log("Subscribing to '{}' with callback '{}'".format("$aws/things/{}/jobs/+/get/+".format(thing_name), "handle_job_get_callback"))
-        self._mqtt_client.subscribe("$aws/things/{}/jobs/+/get/+".format(thing_name), 0, self.handle_job_get_callback)
+        topic = self._thing_topic("job_get_replies", thing_name)
+        self.log("Routing '{}' to '{}'", topic, "handle_job_get_callback")
+        self.subscribe(topic, self.handle_job_get_callback)
 
-        self.log("Subscribing to '{}' with callback '{}'".format("$aws/things/{}/jobs/start-next/#".format(thing_name), "handle_jobs_start_next_callback"))
-        self._mqtt_client.subscribe("$aws/things/{}/jobs/start-next/#".format(thing_name), 0, self.handle_jobs_start_next_callback)
+        topic = self._thing_topic("jobs_start_next_replies", thing_name)
+        self.log("Routing '{}' to '{}'", topic, "handle_jobs_start_next_callback")
+        self.subscribe(topic, self.handle_jobs_start_next_callback)
 
         #self._mqtt_client.subscribe("$aws/things/{}/jobs/get/accepted".format(client_id), 1, handle_jobs_get_callback)
         #self._mqtt_client.subscribe("$aws/things/{}/jobs/get/rejected".format(client_id), 1, handle_jobs_get_callback)
@@ -475,43 +1109,50 @@ class VirtualDevice:
     def backup_files(self):
         self.log(">backup_files")
 
-        os.rename("/tmp/iot_endpoint", "/tmp/iot_endpoint.bkp")
-        os.rename("/tmp/device_name", "/tmp/device_name.bkp")
-        os.rename("/tmp/cert", "/tmp/cert.bkp")
-        os.rename("/tmp/key", "/tmp/key.bkp")
-        os.rename("/tmp/rootCA.pem", "/tmp/rootCA.pem.bkp")
+        os.rename(self.file_path("iot_endpoint"), self.file_path("iot_endpoint.bkp"))
+        os.rename(self.file_path("device_name"), self.file_path("device_name.bkp"))
+        os.rename(self.file_path("cert"), self.file_path("cert.bkp"))
+        os.rename(self.file_path("key"), self.file_path("key.bkp"))
+        os.rename(self.file_path("rootCA.pem"), self.file_path("rootCA.pem.bkp"))
 
         self.log("<backup_files")
 
         return
 
 
+    def file_path(self, filename):
+        return os.path.join(self.files_dir, filename)
+
+
     def prepare_files(self, cfg_file_str):
         cfg_file = json.loads(cfg_file_str)
 
+        if not os.path.isdir(self.files_dir):
+            os.makedirs(self.files_dir)
+
         iot_endpoint = cfg_file["iot_endpoint"]
 
-        with open("/tmp/iot_endpoint", "w") as file:
+        with open(self.file_path("iot_endpoint"), "w") as file:
             file.write("%s" % iot_endpoint)
 
         dev_name = cfg_file["device_name"]
 
-        with open("/tmp/device_name", "w") as file:
+        with open(self.file_path("device_name"), "w") as file:
             file.write("%s" % dev_name)
 
         cert = cfg_file["cert"]
 
-        with open("/tmp/cert", "w") as file:
+        with open(self.file_path("cert"), "w") as file:
             file.write("%s" % cert)
 
         key = cfg_file["key"]
 
-        with open("/tmp/key", "w") as file:
+        with open(self.file_path("key"), "w") as file:
             file.write("%s" % key)
 
         root_ca = cfg_file["root_ca"]
 
-        with open("/tmp/rootCA.pem", "w") as file:
+        with open(self.file_path("rootCA.pem"), "w") as file:
             file.write("%s" % root_ca)
 
         return
@@ -532,26 +1173,26 @@ class VirtualDevice:
             payload = json.dumps(msg)
 
             self.log(" publish_external_ip - Publishing...")
-            self._mqtt_client.publish("cmd/{}/event".format(self.name), payload, 0)
+            self.add_pending_payload("cmd/{}/event".format(self.name), payload, publish_queue.PRIORITY_EVENT)
         except Exception as e:
-            self.log(" publish_external_ip - Error getting IP '{}'".format(str(e)))
+            self.log(" publish_external_ip - Error getting IP '{}'", e, level=device_log.ERROR)
         
-        self.log("<publish_external_ip - '{}'".format(external_ip))
+        self.log("<publish_external_ip - '{}'", external_ip)
 
 
     def publish(self, msg):
-        self.log(">publish")
+        self.log(">publish", level=device_log.DEBUG)
         
         try:
             payload = json.dumps(msg)
-            topic = self.mqtt_telemetry_topic.format(self.name)
+            topic = self._telemetry_topic
 
-            self.log(" publish - Sending payload '{}' notification to '{}'...".format(payload, topic))
-            self._mqtt_client.publish(topic, payload, 0)
+            self.log(" publish - Sending payload '{}' notification to '{}'...", payload, topic, level=device_log.DEBUG)
+            self.add_pending_payload(topic, payload, publish_queue.PRIORITY_TELEMETRY, self._qos[TOPIC_CLASS_TELEMETRY])
         except Exception as e:
-            self.log(" publish - Error" + str(e))
+            self.log(" publish - Error '{}'", e, level=device_log.ERROR)
         
-        self.log("<publish")
+        self.log("<publish", level=device_log.DEBUG)
 
 
     def force_auth_error(self):
@@ -561,10 +1202,10 @@ class VirtualDevice:
             payload = json.dumps({"auth": "error"})
             topic = "invalid-topic-for-error"
 
-            self.log(" force_auth_error - Sending payload '{}' notification to '{}'...".format(payload, topic))
-            self._mqtt_client.publish(topic, payload, 0)
+            self.log(" force_auth_error - Sending payload '{}' notification to '{}'...", payload, topic)
+            self.add_pending_payload(topic, payload, publish_queue.PRIORITY_CRITICAL)
         except Exception as e:
-            self.log(" force_auth_error - Error" + str(e))
+            self.log(" force_auth_error - Error '{}'", e, level=device_log.ERROR)
         
         self.log("<force_auth_error")
 
@@ -580,10 +1221,10 @@ class VirtualDevice:
             payload = json.dumps(msg)
             topic = "cmd/{}/tamper".format(self.name)
 
-            self.log(" tamper - Sending tamper notification to '{}'...".format(topic))
-            self._mqtt_client.publish(topic, payload, 0)
+            self.log(" tamper - Sending tamper notification to '{}'...", topic)
+            self.add_pending_payload(topic, payload, publish_queue.PRIORITY_CRITICAL)
         except Exception as e:
-            self.log(" tamper - Error" + str(e))
+            self.log(" tamper - Error '{}'", e, level=device_log.ERROR)
         
         self.log("<tamper")
 
@@ -591,32 +1232,39 @@ class VirtualDevice:
     def setup(self):
         self.log(">setup")
 
-        mqtt_shadow_client = AWSIoTMQTTShadowClient(self.name)
-        mqtt_shadow_client.disableMetricsCollection()
+        # An interrupt of the previous run, left by stop() while nothing waited
+        self._reconnect_policy.clear_interrupt()
+        self._mqtt_client = mqtt_transport.create_transport(self.transport, self.name, self.endpoint, self.mqtt_port)
+        self._mqtt_client.configure_log(self.log)
+        # A new connection has no subscriptions yet, the routes are added back below
+        self._subscriptions = []
+        self._routes = topic_dispatch.TopicRouter()
 
         # Configurations
         # For TLS mutual authentication
-        mqtt_shadow_client.configureEndpoint(self.endpoint, self.mqtt_port)
-        mqtt_shadow_client.configureCredentials("/tmp/rootCA.pem", "/tmp/key", "/tmp/cert")
-
-        self._mqtt_client = mqtt_shadow_client.getMQTTConnection()
-        self._mqtt_client.configureOfflinePublishQueueing(-1)  # Infinite offline Publish queueing
-        self._mqtt_client.configureDrainingFrequency(2)  # Draining: 2 Hz
-        self._mqtt_client.configureConnectDisconnectTimeout(10)  # 10 sec
-        self._mqtt_client.configureMQTTOperationTimeout(5)  # 5 sec
+        self._mqtt_client.configure_credentials(self.file_path("rootCA.pem"), self.file_path("key"), self.file_path("cert"))
+        # Bounded offline Publish queueing, most of the backlog waits in the publish queue
+        self._mqtt_client.configure_offline_queue(self._offline_queue_size, self._publish_queue.policy != publish_queue.POLICY_DROP_NEWEST)
+        self._mqtt_client.configure_draining_frequency(2)  # Draining: 2 Hz
+        self._mqtt_client.configure_timeouts(10, 5)  # 10 sec to connect/disconnect, 5 sec per MQTT operation
+        # Automatic reconnections after a connection loss follow the same backoff as connect()
+        self._mqtt_client.configure_reconnect(self.reconnect_delay, self.handle_reconnected, self.handle_connection_lost)
 
         if self._lwt_topic:
-            self.log(" setup - Setting LWT... '{}' / '{}'".format(self._lwt_topic, self._lwt_message))
-            mqtt_shadow_client.configureLastWill(self._lwt_topic, self._lwt_message, 1)
+            self.log(" setup - Setting LWT... '{}' / '{}'", self._lwt_topic, self._lwt_message)
+            self._mqtt_client.configure_last_will(self._lwt_topic, self._lwt_message, 1)
 
-        if not self.connect(mqtt_shadow_client):
-            return
+        if not self.connect(self._mqtt_client):
+            return False
 
         # Create a deviceShadow with persistent subscription
         #deviceShadowHandler = myMQTTShadowClient.createShadowHandlerWithName(client_id, True)
         #shadowCallbackContainer_Bot = shadowCallbackContainer(deviceShadowHandler)
 
-        time.sleep(2)
+        time.sleep(SETUP_DELAY)
+
+        # A single subscription for every topic of the thing, the routes below need none of their own
+        self.subscribe_transport(self._thing_topics["all"])
 
         #JOBS
         self.setup_jobs_callbacks(self.name)
@@ -624,15 +1272,21 @@ class VirtualDevice:
         #SHADOW TOPICS
         self.setup_shadow_callbacks(self.name)
 
+        #DEVICE DEFENDER REPORT REPLIES
+        self.subscribe(self._thing_topics["device_defender_json_replies"], self.handle_device_defender_reply_callback)
+        self.subscribe(self._thing_topics["device_defender_cbor_replies"], self.handle_device_defender_reply_callback,
+                       topic_dispatch.CODEC_CBOR)
+
         #COMMAND / REPLY PATTERN
-        self._mqtt_client.subscribe("cmd/ac/{}/req".format(self.name), 0, self.handle_cmd_reply_callback)
+        self.subscribe("cmd/ac/{}/req".format(self.name), self.handle_cmd_reply_callback)
 
-        return
+        return True
 
 
     def start(self):
         self.log(">start")
 
+        # The startup requests below follow the connection, paced by the admission controller
         # reporting current ip
         self.publish_external_ip()
 
@@ -644,42 +1298,29 @@ class VirtualDevice:
         self.log(" start - Getting shadow status...")
         self.get_shadow(self.name)
 
-        #moving to self to allow fast configuration change
-        self._next_message_time = datetime.datetime.now()
+        self.schedule_events()
+        self._scheduler.schedule(EVENT_JOURNAL_REPLAY, 0)
 
         while True:
-            current_time = datetime.datetime.now()
-
-            if self._next_message_time <= current_time:
-                #payload = { "temp" : 30 }
-                self.log(" start - Sampling delay {}".format(self._sampling_delay))
-                topic = self.mqtt_telemetry_topic.format(self.name)
-
-                self.log(" start - Sending to '{}' the payload below\n{}".format(topic, self.payload))
-                self._mqtt_client.publish(topic, json.dumps(self.payload), 0)
-                self._next_message_time = current_time + datetime.timedelta(0, self._sampling_delay)
-
-            if self._next_device_defender_telemetry <= current_time and self.first_sample is not True:
-                self.log(" start - Device Defender telemetry delay {}".format(self._device_metrics_sampling_delay))
-                device_defender_metrics_topic = self.mqtt_device_defender_telemetry_topic.format(self.name)
-                self.device_defender_metrics_payload = self.collect_metrics()
-                self.log(" start - Sending to '{}' the payload below\n{}".format(device_defender_metrics_topic, self.device_defender_metrics_payload.to_json_string()))
-                self._mqtt_client.publish(device_defender_metrics_topic, self.device_defender_metrics_payload.to_json_string(),0)
-                self._next_device_defender_telemetry = current_time + datetime.timedelta(0, self._device_metrics_sampling_delay)
-            
-            if self.first_sample is True:
-                self.collect_metrics()
-                self.first_sample = False
+            # Sleeps until the next due event, stop() and force_reconnect() wake it up earlier
+            events = self._scheduler.wait()
 
-            if self._pending_payloads:
-                try:
-                    p = self._pending_payloads.pop()
-                    self._mqtt_client.publish(p.get("topic"), p.get("payload"), 0)
-                except Exception:
-                    self.log("Error")
+            if events:
+                self.instruments.tick_lag.observe(self._scheduler.last_lag)
+
+            for event in events:
+                self._event_handlers[event]()
 
-            if self._stop: # Using next_message to stop the thread properly
+            if self._stop:
                 self.log(" start - Stopping...")
+                self.flush_telemetry()
+                self.drain_publish_queue()
+                self._reconnect_policy.on_disconnected()
+
+                if self._scheduler.is_scheduled(EVENT_SHADOW_WRITE):
+                    self._scheduler.cancel(EVENT_SHADOW_WRITE)
+                    self.write_shadow_snapshot()
+
                 if self._clean_disconnect:
                     self.log(" start - Disconnecting from the broker...")
                     self._mqtt_client.disconnect()
@@ -691,11 +1332,209 @@ class VirtualDevice:
 
             if self._force_reconnect:
                 self.log(" start - Forcing reconnect...")
-                self._mqtt_client.configureCredentials("/tmp/rootCA.pem", "/tmp/key", "/tmp/cert")
+                self._mqtt_client.configure_credentials(self.file_path("rootCA.pem"), self.file_path("key"), self.file_path("cert"))
+                self._reconnect_policy.on_disconnected()
                 self.connect(self._mqtt_client)
                 self._force_reconnect = False
+                self._scheduler.schedule(EVENT_JOURNAL_REPLAY, 0)
+
+                if len(self._publish_queue):
+                    self._scheduler.schedule(EVENT_PENDING_PAYLOAD, 0)
+
 
-            time.sleep(0.5)
+    def schedule_events(self):
+        # Baseline sample, the first Device Defender report carries the deltas against it
+        self.collect_metrics()
+
+        self._scheduler.schedule(EVENT_TELEMETRY, 0)
+        self._scheduler.schedule(EVENT_DEVICE_DEFENDER, 0)
+
+
+    def send_telemetry(self):
+        self._scheduler.schedule(EVENT_TELEMETRY, self._sampling_delay)
+
+        payload = self.sample_payload()
+
+        if self.is_batching():
+            self._telemetry_batch.append((time.time(), payload))
+
+            if self._batch_size and len(self._telemetry_batch) >= self._batch_size:
+                self.flush_telemetry()
+            elif self._batch_window and len(self._telemetry_batch) == 1:
+                self._scheduler.schedule(EVENT_TELEMETRY_FLUSH, self._batch_window)
+
+            return
+
+        # Hot path: cached topic, and cached payload bytes unless a signal changes the payload on every sample
+        if payload is self._payload:
+            payload_bytes = self._payload_bytes
+        else:
+            payload_bytes = json.dumps(payload).encode("utf8")
+
+        self.log(" start - Sending to '{}'", self._telemetry_topic, level=device_log.DEBUG)
+        self.add_pending_payload(self._telemetry_topic, payload_bytes, publish_queue.PRIORITY_TELEMETRY, self._qos[TOPIC_CLASS_TELEMETRY])
+
+
+    def flush_telemetry(self):
+        self._scheduler.cancel(EVENT_TELEMETRY_FLUSH)
+
+        if not self._telemetry_batch:
+            return
+
+        topic = self._telemetry_topic
+        samples = self._telemetry_batch
+        self._telemetry_batch = []
+
+        self.log(" start - Sending to '{}' a batch of {} samples", topic, len(samples), level=device_log.DEBUG)
+        self.add_pending_payload(topic, telemetry_batch.encode_batch(samples), publish_queue.PRIORITY_TELEMETRY,
+                                 self._qos[TOPIC_CLASS_TELEMETRY])
+
+
+    def send_device_defender_metrics(self):
+        self.log(" start - Device Defender telemetry delay {}", self._device_metrics_sampling_delay, level=device_log.DEBUG)
+        device_defender_metrics_topic = self._device_defender_topic
+
+        if self._device_metrics_format == DEVICE_METRICS_FORMAT_CBOR:
+            self.device_defender_metrics_payload = self.collect_metrics(short_names=True)
+            payload = self.device_defender_metrics_payload.to_cbor()
+            self.log(" start - Sending to '{}' a {} bytes CBOR report", device_defender_metrics_topic, len(payload), level=device_log.DEBUG)
+        else:
+            self.device_defender_metrics_payload = self.collect_metrics()
+            payload = self.device_defender_metrics_payload.to_json_string()
+            self.log(" start - Sending to '{}' the payload below\n{}", device_defender_metrics_topic, payload, level=device_log.DEBUG)
+
+        self.add_pending_payload(device_defender_metrics_topic, payload, publish_queue.PRIORITY_EVENT, self._qos[TOPIC_CLASS_DEVICE_DEFENDER])
+        self._scheduler.schedule(EVENT_DEVICE_DEFENDER, self._device_metrics_sampling_delay)
+
+
+    def add_pending_payload(self, topic, payload, priority=publish_queue.PRIORITY_TELEMETRY, qos=0):
+        """
+        Publish through the bounded publish queue, right away when the queue is empty and the drain
+        rate allows it. While disconnected, messages wait in the queue, where its policy and
+        priorities apply, unless the journal keeps them.
+        """
+        now = time.monotonic()
+
+        if not len(self._publish_queue) and now >= self._next_drain and not self._inflight.is_full() and self._can_publish():
+            self._publish_pending(topic, payload, qos, now)
+            return
+
+        if not self._publish_queue.put(topic, payload, qos, priority):
+            self.log(" add_pending_payload - Queue full, dropped message to '{}'", topic, level=device_log.WARNING)
+
+        if not self._scheduler.is_scheduled(EVENT_PENDING_PAYLOAD):
+            self._scheduler.schedule(EVENT_PENDING_PAYLOAD, self._next_drain - now if self._can_publish() else QUEUE_RETRY_DELAY)
+
+
+    def _can_publish(self):
+        # The journal takes the messages published while disconnected, in order
+        return self._journal is not None or self._mqtt_client is not None and self._mqtt_client.is_connected()
+
+
+    def send_pending_payload(self):
+        if not self._can_publish():
+            # Drained once connected again
+            if len(self._publish_queue):
+                self._scheduler.schedule(EVENT_PENDING_PAYLOAD, QUEUE_RETRY_DELAY)
+
+            return
+
+        if self._inflight.is_full():
+            # Backpressure: the next PUBACK resumes draining, or the ack timeout frees the window
+            self._scheduler.schedule(EVENT_PENDING_PAYLOAD, self._inflight.timeout)
+            return
+
+        p = self._publish_queue.get()
+
+        if p is None:
+            return
+
+        now = time.monotonic()
+        self._publish_pending(p.topic, p.payload, p.qos, now)
+
+        if len(self._publish_queue):
+            self._scheduler.schedule(EVENT_PENDING_PAYLOAD, self._next_drain - now)
+
+
+    def drain_publish_queue(self):
+        """Publish the whole backlog now, whatever the drain rate."""
+        p = self._publish_queue.get()
+
+        while p is not None:
+            self._publish_pending(p.topic, p.payload, p.qos, time.monotonic())
+            p = self._publish_queue.get()
+
+
+    def _publish_pending(self, topic, payload, qos, now):
+        self._next_drain = now + (1.0 / self._drain_rate if self._drain_rate else 0)
+
+        # Behind a backlog, new messages also go to the journal, so the order is kept
+        if self._journal is not None and (len(self._journal) or not self._mqtt_client.is_connected()):
+            self._journal.append(topic, payload, qos)
+
+            if not self._scheduler.is_scheduled(EVENT_JOURNAL_REPLAY):
+                self._scheduler.schedule(EVENT_JOURNAL_REPLAY, JOURNAL_RETRY_DELAY)
+                self._replay_waiting = True
+            elif self._replay_waiting and self._mqtt_client.is_connected():
+                # Back online, no need to wait for the next check
+                self._scheduler.schedule(EVENT_JOURNAL_REPLAY, 0)
+                self._replay_waiting = False
+
+            return
+
+        try:
+            self._send(topic, payload, qos)
+        except Exception as e:
+            self.instruments.count_publish_error()
+            self.log(" send_pending_payload - Error publishing to '{}' '{}'", topic, e, level=device_log.ERROR)
+
+
+    def _send(self, topic, payload, qos):
+        ack_callback = self._inflight.track() if qos else None
+        self.instruments.count_published(topic, payload)
+
+        return self._mqtt_client.publish(topic, payload, qos, ack_callback)
+
+
+    def _on_publish_ack(self):
+        # Called from the transport threads
+        if len(self._publish_queue):
+            self._scheduler.schedule(EVENT_PENDING_PAYLOAD, max(0, self._next_drain - time.monotonic()))
+
+
+    def replay_journal(self):
+        """Send the next batch of the journal backlog, rate limited, and ack it message by message."""
+        if self._journal is None or not len(self._journal):
+            return
+
+        if self._mqtt_client is None or not self._mqtt_client.is_connected():
+            self._scheduler.schedule(EVENT_JOURNAL_REPLAY, JOURNAL_RETRY_DELAY)
+            self._replay_waiting = True
+            return
+
+        self._replay_waiting = False
+
+        batch = self._journal.pending(REPLAY_BATCH)
+        self.log(" replay_journal - Replaying {} of {} messages", len(batch), len(self._journal), level=device_log.DEBUG)
+
+        sent = 0
+
+        for offset, topic, payload, qos in batch:
+            if self._inflight.is_full():
+                break
+
+            try:
+                self._send(topic, payload, qos)
+            except Exception as e:
+                self.instruments.count_publish_error()
+                self.log(" replay_journal - Error publishing to '{}' '{}'", topic, e, level=device_log.ERROR)
+                break
+
+            # Acked one by one: after a crash, replay resumes right after the last message sent
+            self._journal.ack(offset)
+            sent += 1
+
+        self._scheduler.schedule(EVENT_JOURNAL_REPLAY, max(sent, 1) / float(self._replay_rate))
 
 
     def register_last_will_and_testament(self, topic, message):
@@ -762,9 +1601,9 @@ class VirtualDevice:
                     print('Failed to parse network info for protocol: ' + protocol)
                     print(ex)
 
-    def collect_metrics(self):
+    def collect_metrics(self, short_names=False):
         """Sample system metrics and populate a metrics object suitable for publishing to Device Defender."""
-        metrics_current = metrics.Metrics(last_metric=self._last_metric)
+        metrics_current = metrics.Metrics(short_names=short_names, last_metric=self._last_metric)
 
         self.network_stats(metrics_current)
         self.listening_ports(metrics_current)
@@ -777,124 +1616,260 @@ class VirtualDevice:
 class VirtualSwitch(VirtualDevice):
 
     target_device = "dev-NANN"
+    signal_profile = "step"
+
+    def __init__(self, name, endpoint, files_dir=None):
+        VirtualDevice.__init__(self, name, endpoint, files_dir)
+        # Presses within the window of the writer make a single, version checked, update of the target shadow
+        self._shadow_writer = shadow_writer.ShadowUpdateWriter(self._send_target_update, self._send_target_get)
+        self._event_handlers[EVENT_SHADOW_UPDATE] = self.flush_target_update
+
 
-    def __init__(self, name, endpoint):
-        VirtualDevice.__init__(self, name, endpoint)
+    def get_stats(self):
+        stats = VirtualDevice.get_stats(self)
+        stats.update(self._shadow_writer.get_counters())
+
+        return stats
 
 
     def set_target_device(self, target_device):
+        self.log(">set_target_device '{}'", target_device)
         self.target_device = target_device
+        # Changes and versions of the previous target mean nothing for the new one
+        self._shadow_writer.reset()
+
+        if self._mqtt_client is not None:
+            self.setup_target_callbacks()
+
+
+    def set_shadow_update_window(self, window):
+        """Coalesce the presses made within `window` seconds into a single update of the target shadow."""
+        self.log(">set_shadow_update_window '{}'", window)
+        self._shadow_writer.set_window(window)
+
+
+    def setup_shadow_callbacks(self, thing_name):
+        VirtualDevice.setup_shadow_callbacks(self, thing_name)
+        self.setup_target_callbacks()
+
+
+    def setup_target_callbacks(self):
+        # Replies to the updates of the switch, and to the gets for the version after a conflict
+        target = self.target_device
+        self.subscribe(self._thing_topic("shadow_update_accepted", target), self.handle_target_update_callback)
+        self.subscribe(self._thing_topic("shadow_update_rejected", target), self.handle_target_update_callback)
+        self.subscribe(self._thing_topic("shadow_get_replies", target), self.handle_target_get_callback)
 
 
     def press_on(self):
         self.log(">press_on")
-        payload = json.dumps({"state": {"desired": {"status": "on"}}})
-        self._mqtt_client.publish("$aws/things/{}/shadow/update".format(self.target_device), payload, 0)
+        self.update_target({"status": "on"})
 
         return
 
 
     def press_off(self):
         self.log(">press_off")
-        payload = json.dumps({"state": {"desired": {"status": "off"}}})
-        self._mqtt_client.publish("$aws/things/{}/shadow/update".format(self.target_device), payload, 0)
+        self.update_target({"status": "off"})
 
         return
 
 
-class VirtualBulb(VirtualDevice):
+    def update_target(self, desired):
+        self._shadow_writer.update(desired)
+        self._schedule_target_update()
 
-    is_on = False
 
-    def __init__(self, name, endpoint):
-        VirtualDevice.__init__(self, name, endpoint)
+    def _schedule_target_update(self):
+        # Recomputed after every press and reply: the end of the window, or of the wait for a reply
+        delay = self._shadow_writer.next_flush()
 
+        if delay is not None:
+            self._scheduler.schedule(EVENT_SHADOW_UPDATE, delay)
 
-class RogueDevice(VirtualDevice):
 
-    def __init__(self, name, endpoint):
-        VirtualDevice.__init__(self, name, endpoint)
-        self.log(self.__class__)
+    def flush_target_update(self):
+        self._shadow_writer.flush()
+        self._schedule_target_update()
 
-    def start(self):
-        self.log(">start")
 
-        # reporting current ip
-        self.publish_external_ip()
+    def _send_target_update(self, document):
+        self.log(" update_target - Publishing desired state {} at version {}", document["state"]["desired"], document.get("version"))
+        self._send(self._thing_topic("shadow_update", self.target_device), json.dumps(document), self._qos[TOPIC_CLASS_SHADOW])
 
-        # check any pending job
-        self.log(" start - Checking for pending jobs...")
-        self.get_jobs(self.name)
 
-        # get shadow status
-        self.log(" start - Getting shadow status...")
-        self.get_shadow(self.name)
+    def _send_target_get(self, document):
+        self.log(" update_target - Version conflict, getting the shadow of '{}'", self.target_device, level=device_log.WARNING)
+        self._send(self._thing_topic("shadow_get", self.target_device), json.dumps(document), self._qos[TOPIC_CLASS_SHADOW])
 
-        #moving to self to allow fast configuration change
-        self._next_message_time = datetime.datetime.now()
 
-        while True:
-            current_time = datetime.datetime.now()
-
-            if self._next_message_time <= current_time:
-                #payload = { "temp" : 30 }
-                self.log(" start - Sampling delay {}".format(self._sampling_delay))
-                topic = self.mqtt_telemetry_topic.format(self.name)
-
-                self.log(" start - Sending to '{}' the payload below\n{}".format(topic, self.payload))
-                self._mqtt_client.publish(topic, json.dumps(self.payload), 0)
-                self._next_message_time = current_time + datetime.timedelta(0, self._sampling_delay)
-
-            if random.randint(0, 1000) == 100:
-                # do random rogue stuff
-                act = random.randint(0, 2)
-
-                if act == 0:
-                    self.force_auth_error()
-                elif act == 1:
-                    letters = string.ascii_lowercase
-                    msg = ''.join(random.choice(letters) for i in range(500))
-                    payload = { "payload": msg }
-                    self.publish(payload)
-                elif act == 2:
-                    self.tamper()
-
-            if self._stop: # Using next_message to stop the thread properly
-                self.log(" start - Stopping...")
-                if self._clean_disconnect:
-                    self.log(" start - Disconnecting from the broker...")
-                    self._mqtt_client.disconnect()
-                    self.log("<start - Disconnected")
-                else:
-                    self.log("<start - Sudden disconnect...")
+    def _is_target_topic(self, topic):
+        # Subscriptions to previous targets stay, their messages are ignored
+        return topic.startswith("$aws/things/{}/".format(self.target_device))
 
-                break
 
-            if self._force_reconnect:
-                self.log(" start - Forcing reconnect...")
-                self._mqtt_client.configureCredentials("/tmp/rootCA.pem", "/tmp/key", "/tmp/cert")
-                self.connect(self._mqtt_client)
-                self._force_reconnect = False
+    def handle_target_update_callback(self, message):
+        topic = message.topic
 
-            time.sleep(0.5)
+        if not self._is_target_topic(topic):
+            return
 
-class MaxSizeList(object):
-    def __init__(self, size_limit):
-        self.list = [None] * size_limit
-        self.next = 0
+        payload = message.payload
 
+        if topic.endswith("/accepted"):
+            if self._shadow_writer.on_accepted(payload):
+                self.log(" handle_target_update_callback - Update accepted at version {}", payload.get("version"))
+        elif self._shadow_writer.on_rejected(payload):
+            self.log(" handle_target_update_callback - Update rejected '{}'", payload, level=device_log.WARNING)
 
-    def push(self, item):
-        self.list[self.next % len(self.list)] = item
-        self.next += 1
+        self._schedule_target_update()
 
 
-    def get_list(self):
-        if self.next < len(self.list):
-            return self.list[:self.next]
-        else:
-            split = self.next % len(self.list)
-            return self.list[split:] + self.list[:split]
+    def handle_target_get_callback(self, message):
+        topic = message.topic
+
+        if not self._is_target_topic(topic):
+            return
+
+        payload = message.payload
+
+        if self._shadow_writer.on_get_reply(payload, topic.endswith("/accepted")):
+            self._schedule_target_update()
+
+
+class VirtualActuator(VirtualDevice):
+    """Device whose actual state follows the desired state of its shadow, and is reported back."""
+
+    # Actual state at startup, reported once connected
+    initial_state = {}
+    # Shadow documents applied by the replica at the last sync of the reported state
+    _synced_documents = 0
+
+    def __init__(self, name, endpoint, files_dir=None):
+        VirtualDevice.__init__(self, name, endpoint, files_dir)
+        # Only the keys that changed since the last acknowledged report are published, batched
+        self._reported_state = reported_state.ReportedStateEngine(self._send_reported_state, self.initial_state)
+        self._event_handlers[EVENT_REPORTED_STATE] = self.flush_reported_state
+
+
+    def get_stats(self):
+        stats = VirtualDevice.get_stats(self)
+        stats.update(self._reported_state.get_counters())
+
+        return stats
+
+
+    @property
+    def actual_state(self):
+        return self._reported_state.actual
+
+
+    def set_actual_state(self, changes):
+        """Change the actual state locally, e.g. a button on the device, the change is reported."""
+        self._reported_state.apply(changes)
+        self._schedule_reported_state()
+
+
+    def setup_shadow_callbacks(self, thing_name):
+        VirtualDevice.setup_shadow_callbacks(self, thing_name)
+        self.subscribe(self._thing_topic("shadow_update_accepted", thing_name), self.handle_reported_update_callback)
+        self.subscribe(self._thing_topic("shadow_update_rejected", thing_name), self.handle_reported_update_callback)
+
+
+    def schedule_events(self):
+        VirtualDevice.schedule_events(self)
+        # The initial state is reported once the startup get had time to reply, even if the thing has no shadow yet
+        self._scheduler.schedule(EVENT_REPORTED_STATE, shadow_replica.GET_TIMEOUT)
+
+
+    def _on_shadow_change(self):
+        VirtualDevice._on_shadow_change(self)
+
+        if self._shadow.version is None:
+            return
+
+        # The actuator follows the desired delta. The reported state of the shadow is acknowledged when it
+        # comes from a whole document, a delta alone leaves it as of the previous document
+        state = self._shadow.get_document()["state"]
+        documents = self._shadow.documents
+        self._reported_state.sync(state["reported"] if documents != self._synced_documents else None, state["delta"])
+        self._synced_documents = documents
+        self._schedule_reported_state()
+
+
+    def _schedule_reported_state(self):
+        delay = self._reported_state.next_flush()
+
+        if delay is not None:
+            self._scheduler.schedule(EVENT_REPORTED_STATE, delay)
+
+
+    def flush_reported_state(self):
+        self._reported_state.flush()
+        self._schedule_reported_state()
+
+
+    def _send_reported_state(self, document):
+        self.log(" flush_reported_state - Reporting {}", document["state"]["reported"])
+        self._send(self._thing_topics["shadow_update"], json.dumps(document), self._qos[TOPIC_CLASS_SHADOW])
+
+
+    def handle_reported_update_callback(self, message):
+        payload = message.payload
+
+        # The replies to the updates of other clients carry their token, or none
+        if message.topic.endswith("/accepted"):
+            self._reported_state.on_accepted(payload)
+        elif self._reported_state.on_rejected(payload):
+            self.log(" handle_reported_update_callback - Report rejected '{}'", payload, level=device_log.WARNING)
+
+        self._schedule_reported_state()
+
+
+class VirtualBulb(VirtualActuator):
+
+    initial_state = {"status": "off"}
+    signal_profile = "drift"
+
+    def __init__(self, name, endpoint, files_dir=None):
+        VirtualActuator.__init__(self, name, endpoint, files_dir)
+
+
+    @property
+    def is_on(self):
+        return self.actual_state.get("status") == "on"
+
+
+class RogueDevice(VirtualDevice):
+
+    signal_profile = "anomaly"
+
+    def __init__(self, name, endpoint, files_dir=None):
+        VirtualDevice.__init__(self, name, endpoint, files_dir)
+        self.log(self.__class__)
+        self._event_handlers[EVENT_ROGUE_ACTION] = self.rogue_action
+
+
+    def schedule_events(self):
+        self._scheduler.schedule(EVENT_TELEMETRY, 0)
+        self._scheduler.schedule(EVENT_ROGUE_ACTION, random.expovariate(1.0 / ROGUE_ACTION_MEAN_DELAY))
+
+
+    def rogue_action(self):
+        # do random rogue stuff
+        act = random.randint(0, 2)
+
+        if act == 0:
+            self.force_auth_error()
+        elif act == 1:
+            letters = string.ascii_lowercase
+            msg = ''.join(random.choice(letters) for i in range(500))
+            payload = { "payload": msg }
+            self.publish(payload)
+        elif act == 2:
+            self.tamper()
+
+        self._scheduler.schedule(EVENT_ROGUE_ACTION, random.expovariate(1.0 / ROGUE_ACTION_MEAN_DELAY))
 
 
 # if __name__ == '__main__':